@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+    *******************************************************************************************
+    E2EBenchmark: Offline end-to-end benchmark of TradeDeskBot against the MockTradeDesk
+    Publishes orders through a fake PubNub into EventURLHandler and reports the URL-to-cart and
+    cart-to-proceed latencies and the orders per minute for 1..N instances
+    Usage: python BotBench/E2EBenchmark.py --instances 3 --orders 10 --rate 2 --arrival 2
+    *******************************************************************************************
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from types import SimpleNamespace
+from pathlib import Path
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__))).parent
+sys.path.insert(0, str(PROJECT_ROOT))
+sys.path.insert(0, str(PROJECT_ROOT / 'BotBench'))
+
+from MockTradeDesk import MockTradeDesk, InventoryGenerator
+
+
+# Stand-in for the PubNub publisher, delivers messages straight to the EventURLHandler
+class FakePubNub:
+    def __init__(self, handler):
+        self.handler = handler
+
+    def publish(self, message):
+        # PubNub timetokens are in 100 ns units
+        self.handler.message(self, SimpleNamespace(message=message, timetoken=int(time.time() * 1e7)))
+
+
+# Runs the bot with a number of instances against a fresh MockTradeDesk and returns its results
+def run(args):
+    from TradeDeskBot import TradeDeskBot, EventURLHandler
+
+    inventory = InventoryGenerator(noise=args.noise, arrival=args.arrival, churn=args.churn)
+    server = MockTradeDesk(inventory=inventory, widget_ms=args.widget_ms, auto_refresh_ms=args.auto_refresh_ms,
+                           cache_assets=args.cache_assets).start()
+    with open(PROJECT_ROOT / 'BotRes/Settings.json', 'r') as f:
+        settings = json.load(f)
+    settings["Settings"].update({"BaseURL": server.url, "Email": "bench@mocktradedesk", "Password": "bench",
+                                 "NumberOfInstancesToRun": args.instances, "DriverPoolSize": args.instances,
+                                 "WaitForTicket": args.wait_for_ticket, "OrderLedger": False})
+    settings["Settings"].update(json.loads(args.settings))
+    bot = TradeDeskBot(settings=settings)
+    bot.start_instances()
+    # Wait for the pool to be warm, browser startup is not part of the URL-to-cart latency
+    warm_up_deadline = time.time() + 120
+    while bot.driver_pool.idle.qsize() < args.instances:
+        if time.time() > warm_up_deadline:
+            return {"instances": args.instances, "error": "driver pool did not warm up"}
+        time.sleep(0.1)
+
+    publisher = FakePubNub(handler=EventURLHandler(dispatcher=bot.event_urls, tracer=bot.tracer))
+    published = {}
+    start = time.time()
+    for order_number in range(args.orders):
+        event_id = str(8000000 + order_number)
+        section, row, seats, price = "GOLD1", str(order_number + 1), "23-23", 233.00
+        inventory.add_event(event_id, section=section, row=row, seats=seats, price=price)
+        published[event_id] = time.time()
+        publisher.publish({"purchaseURLs": [server.event_url(event_id, section, row, seats, price - 5, price + 5)], "instances": 1})
+        time.sleep(1 / args.rate)
+
+    # Wait for every order to be confirmed, cancelled or expired
+    deadline = time.time() + args.wait_for_ticket * 60 + 30
+    while time.time() < deadline and len(server.hits["confirmed"]) + len(server.hits["cancelled"]) < args.orders:
+        time.sleep(0.1)
+    elapsed = time.time() - start
+
+    # URL-to-cart latency of every order which got to the cart
+    ticket_events = {ticket["id"]: event_id for event_id, (_, schedule) in inventory.events.items() for _, ticket in schedule}
+    latencies = sorted(hit - published[ticket_events[ticket_id]] for ticket_id, hit in server.hits["purchase"].items()
+                       if ticket_id in ticket_events)
+    # Cart-to-proceed latency, the cart page and payment widget initialization the warm standby works on
+    proceed_latencies = sorted(hit - server.hits["purchase"][ticket_id] for ticket_id, hit in server.hits["confirmed"].items()
+                               if ticket_id in server.hits["purchase"])
+    for driver in list(bot.driver_pool.drivers):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+    return {"instances": args.instances, "orders": args.orders, "carted": len(latencies),
+            "confirmed": len(server.hits["confirmed"]), "cancelled": len(server.hits["cancelled"]),
+            "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+            "max_ms": latencies[-1] * 1000 if latencies else None,
+            "proceed_p50_ms": proceed_latencies[len(proceed_latencies) // 2] * 1000 if proceed_latencies else None,
+            "orders_per_minute": len(server.hits["confirmed"]) / elapsed * 60,
+            "bytes_sent": server.bytes_sent}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of TradeDeskBot against the MockTradeDesk')
+    parser.add_argument('--instances', type=int, default=3, help='benchmark 1..N instances')
+    parser.add_argument('--orders', type=int, default=10, help='orders published per run')
+    parser.add_argument('--rate', type=float, default=2, help='orders published per second')
+    parser.add_argument('--arrival', type=float, default=2, help='seconds until the wanted listing arrives')
+    parser.add_argument('--noise', type=int, default=50, help='listings of the event from the start')
+    parser.add_argument('--churn', type=float, default=0.5, help='seconds between two arriving listings')
+    parser.add_argument('--widget-ms', type=int, default=300, help='payment widget initialization delay')
+    parser.add_argument('--auto-refresh-ms', type=int, default=0, help='refresh the tickets table in the page, 0 to disable')
+    parser.add_argument('--cache-assets', action='store_true', help='serve the static and payment assets as cacheable')
+    parser.add_argument('--wait-for-ticket', type=float, default=1, help='WaitForTicket in minutes')
+    parser.add_argument('--settings', default='{}', help='JSON of extra Settings, i.e. {"WatchMode": false}')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # A single run with args.instances instances, the instance threads run forever so the process exits hard
+    if args.run:
+        print(json.dumps(run(args)), flush=True)
+        os._exit(0)
+
+    print(f"{'Instances':>10}{'Orders':>8}{'Carted':>8}{'Confirmed':>11}{'p50 URL-to-cart ms':>20}{'Max ms':>10}"
+          f"{'p50 cart-to-proceed ms':>24}{'Orders/min':>12}")
+    for instances in range(1, args.instances + 1):
+        command = [sys.executable, os.path.abspath(__file__), '--run', '--instances', str(instances)]
+        for key, value in vars(args).items():
+            if key in ('run', 'instances'):
+                continue
+            if isinstance(value, bool):
+                command += [f"--{key.replace('_', '-')}"] if value else []
+            else:
+                command += [f"--{key.replace('_', '-')}", str(value)]
+        output = subprocess.run(command, capture_output=True, text=True).stdout.splitlines()
+        # The bot logs to stdout as well, the result is the line starting with the results JSON
+        results = [json.loads(line) for line in output if line.startswith('{"instances"')]
+        if not results or "error" in results[-1]:
+            print(f"{instances:>10} run failed: {results[-1]['error'] if results else 'no results'}")
+            continue
+        result = results[-1]
+        p50 = f"{result['p50_ms']:.0f}" if result['p50_ms'] is not None else "-"
+        max_ms = f"{result['max_ms']:.0f}" if result['max_ms'] is not None else "-"
+        proceed_p50 = f"{result['proceed_p50_ms']:.0f}" if result['proceed_p50_ms'] is not None else "-"
+        print(f"{instances:>10}{result['orders']:>8}{result['carted']:>8}{result['confirmed']:>11}{p50:>20}{max_ms:>10}"
+              f"{proceed_p50:>24}{result['orders_per_minute']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+    *******************************************************************************************
+    ListingServer: Local stand-in for the TradeDesk listings, serving recorded responses
+    Usage: python BotBench/ListingServer.py [seconds to poll] [polls per recording]
+    *******************************************************************************************
+"""
+import os
+import sys
+import time
+import threading
+from types import SimpleNamespace
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__))).parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from TradeDeskBot import TradeDeskBot, EventOrder, InventoryPoller, InventoryTracker
+
+DIR_RECORDINGS = PROJECT_ROOT / 'BotBench/Recordings'
+
+
+# Serves the recorded listings in order, moving to the next recording every step requests
+class ListingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, recordings, step=1, port=0):
+        super().__init__(("127.0.0.1", port), ListingHandler)
+        self.recordings = [(recording.read_bytes(), "application/json" if recording.suffix == ".json" else "text/html")
+                           for recording in recordings]
+        self.step = step
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    # Gets the recording for the next request, the last recording is served forever
+    def next_recording(self):
+        with self.lock:
+            index = min(self.requests // self.step, len(self.recordings) - 1)
+            self.requests += 1
+        return self.recordings[index]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class ListingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body, content_type = self.server.next_recording()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    step = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    server = ListingServer(recordings=sorted(DIR_RECORDINGS.glob('listings_*')), step=step).start()
+    # Stand-in for the bot, the poller only needs the session cookies and the user agents
+    bot = SimpleNamespace(base_url=server.url, user_agents=["TradeDeskBot ListingServer"],
+                          session=SimpleNamespace(cookies=[]), to_ticket_dicts=TradeDeskBot.to_ticket_dicts)
+    poller = InventoryPoller(bot=bot, listing_url="{base_url}marketplace/event/{event_id}/listings")
+    order = EventOrder("https://tradedesk.ticketmaster.com/marketplace/event/7365591?section=GOLD1&row=21&seats=23-23&priceFrom=230.30&priceTo=235.70")
+    inventory = InventoryTracker()
+    polls, matched_after = 0, None
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        new_tickets = inventory.update(poller.poll(order=order))
+        polls += 1
+        if matched_after is None and any(order.match(ticket) for ticket in new_tickets):
+            matched_after = polls
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    print(f"Polls: {polls} | {polls / elapsed:,.0f} polls/s | {elapsed / polls * 1000:.3f} ms per poll | "
+          f"Matched at poll: {matched_after} | {inventory}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+    *******************************************************************************************
+    MatchBenchmark: Micro-benchmark of the EventOrder match predicate
+    Usage: python BotBench/MatchBenchmark.py [number of rows] [number of passes]
+    *******************************************************************************************
+"""
+import os
+import sys
+import random
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__))).parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from TradeDeskBot import EventOrder
+
+EVENT_URL = "https://tradedesk.ticketmaster.com/marketplace/event/7365591?all_events=1&onlyrequest=1&section=GOLD1&row=21&seats=23-23&all_inv=1&refreshInterval=300&autocheckout=1&priceFrom=230.30&priceTo=235.70"
+
+
+# Generates ticket dicts like the ones extracted from the tickets table
+def get_ticket_rows(number_of_rows):
+    sections = ["GOLD1", "GOLD2", "GREEN1", "P-LOT", "205"]
+    rows = []
+    for ticket_id in range(number_of_rows):
+        seat = random.randint(1, 50)
+        rows.append({"ID": str(7000000 + ticket_id), "Qty": "1", "Section": random.choice(sections),
+                     "Row": str(random.randint(1, 50)), "Seats": f"{seat}-{seat + random.randint(0, 1)}",
+                     "Price": round(random.uniform(20, 400), 2)})
+    # Make sure there is a ticket to match
+    rows[-1].update({"Section": "GOLD1", "Row": "21", "Seats": "23-23", "Price": 233.00})
+    return rows
+
+
+# Matches every row on every pass and returns matched rows and rows matched per second
+def run(match, ticket_rows, passes):
+    matched = 0
+    start = time.perf_counter()
+    for _ in range(passes):
+        for ticket in ticket_rows:
+            if match(ticket):
+                matched += 1
+    elapsed = time.perf_counter() - start
+    return matched, len(ticket_rows) * passes / elapsed
+
+
+def main():
+    number_of_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    passes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    random.seed(1)
+    ticket_rows = get_ticket_rows(number_of_rows)
+
+    # Parse the order once, as get_ticket does
+    start = time.perf_counter()
+    order = EventOrder(event_url=EVENT_URL)
+    print(f"Order parsed in {(time.perf_counter() - start) * 1000:.3f} ms: {order}")
+
+    # Substring checks of the previous checkout_ticket for reference
+    def substring_match(ticket):
+        return (order.section in ticket["Section"]) and (order.row in ticket["Row"]) and (order.seats in ticket["Seats"])
+
+    for name, match in (("EventOrder.match", order.match), ("Substring match", substring_match)):
+        matched, rate = run(match=match, ticket_rows=ticket_rows, passes=passes)
+        print(f"{name:<18} | Rows: {number_of_rows} | Passes: {passes} | Matched: {matched // passes} per pass | "
+              f"{rate:,.0f} rows/s | {number_of_rows / rate * 1000:.3f} ms per pass")
+
+
+if __name__ == '__main__':
+    main()
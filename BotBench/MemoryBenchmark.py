@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+    *******************************************************************************************
+    MemoryBenchmark: Browser memory per order, one browser per instance vs tabs of shared browsers
+    Opens one MockTradeDesk event page per order and sums the memory of the Chrome processes
+    Usage: python BotBench/MemoryBenchmark.py [orders] [tabs per browser]
+    *******************************************************************************************
+"""
+import os
+import sys
+import json
+import math
+import time
+from pathlib import Path
+
+import psutil
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__))).parent
+sys.path.insert(0, str(PROJECT_ROOT))
+sys.path.insert(0, str(PROJECT_ROOT / 'BotBench'))
+
+from TradeDeskBot import TradeDeskBot, BrowserTabs
+from MockTradeDesk import MockTradeDesk, InventoryGenerator
+
+
+# Memory of the browsers launched by the drivers, PSS where available so the shared pages are not counted twice
+def get_browser_memory(drivers):
+    total = 0
+    for driver in drivers:
+        for process in psutil.Process(driver.service.process.pid).children(recursive=True):
+            try:
+                info = process.memory_full_info()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            total += getattr(info, 'pss', info.rss)
+    return total
+
+
+# Opens the event page of every order, each in a browser or tab of its own, and returns the browser memory
+def run(bot, event_urls, tabs_per_browser):
+    drivers = [bot.get_driver(headless=True) for _ in range(math.ceil(len(event_urls) / tabs_per_browser))]
+    try:
+        tabs = []
+        for driver in drivers:
+            browser = BrowserTabs(driver=driver)
+            tabs += [browser.open_tab() for _ in range(min(tabs_per_browser, len(event_urls) - len(tabs)))]
+        for tab, event_url in zip(tabs, event_urls):
+            bot.apply_resource_policy(driver=tab)
+            tab.get(event_url)
+        # Let the renderers settle
+        time.sleep(3)
+        return len(drivers), get_browser_memory(drivers)
+    finally:
+        for driver in drivers:
+            driver.quit()
+
+
+def main():
+    orders = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    tabs_per_browser = int(sys.argv[2]) if len(sys.argv) > 2 else orders
+    server = MockTradeDesk(inventory=InventoryGenerator(noise=200)).start()
+    event_urls = []
+    for order_number in range(orders):
+        event_id = str(8000000 + order_number)
+        server.inventory.add_event(event_id, section="GOLD1", row=str(order_number + 1), seats="23-23", price=233.00)
+        event_urls.append(server.event_url(event_id, "GOLD1", str(order_number + 1), "23-23", 228.00, 238.00))
+    with open(PROJECT_ROOT / 'BotRes/Settings.json', 'r') as f:
+        settings = json.load(f)
+    settings["Settings"].update({"BaseURL": server.url, "OrderLedger": False})
+    bot = TradeDeskBot(settings=settings)
+
+    print(f"{'Mode':<22}{'Orders':>8}{'Browsers':>10}{'Total MB':>10}{'MB per order':>14}")
+    for mode, tabs in (("Browser per instance", 1), (f"{tabs_per_browser} tabs per browser", tabs_per_browser)):
+        browsers, memory = run(bot=bot, event_urls=event_urls, tabs_per_browser=tabs)
+        print(f"{mode:<22}{orders:>8}{browsers:>10}{memory / 2 ** 20:>10.0f}{memory / 2 ** 20 / orders:>14.1f}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+    *******************************************************************************************
+    MockTradeDesk: Local mock of the TradeDesk marketplace with a scripted inventory
+    Reproduces the DOM the bot relies on: sign-in form, tmp_header_menu_left, filter_tm,
+    filter_ticket_* inputs, tr[id*="ticket_"] rows, #purchase, braintree-methods and #proceed,
+    plus the stylesheet, font, image and analytics a real page loads
+    Usage: python BotBench/MockTradeDesk.py [port]
+    *******************************************************************************************
+"""
+import json
+import random
+import sys
+import threading
+import time
+from html import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+PAGE_LOGIN = """<html><head><title>TradeDesk Sign In</title></head><body>
+<form onsubmit="return false;">
+    <input name="username" type="text">
+    <input name="password" type="password">
+    <button class="header_signup" onclick="document.cookie = 'mock_session=1; max-age=86400; path=/';">Sign In</button>
+</form>
+</body></html>"""
+
+PAGE_HOME = """<html><head><title>TradeDesk</title></head><body>
+<div id="tmp_header_menu_left">Marketplace</div>
+</body></html>"""
+
+PAGE_EVENT = """<html><head><title>TradeDesk Marketplace</title>
+<link rel="stylesheet" href="/assets/marketplace.css">
+<script async src="/analytics/collect.js"></script>
+</head><body>
+<div id="tmp_header_menu_left">Marketplace</div>
+<img src="/assets/banner.png" alt="">
+<div class="filters">
+    <button class="filter filter_tm">All Inventory</button>
+    <input name="filter_ticket_section" type="text">
+    <input name="filter_ticket_row" type="text">
+    <input name="filter_ticket_seat" type="text">
+</div>
+<table id="marketplace_list"><tbody>__ROWS__</tbody></table>
+<div id="cart_popup" style="display: none;">
+    <button class="button positive purchase_send_checkout">Checkout</button>
+</div>
+<script>
+var eventId = "__EVENT_ID__";
+var selected = null;
+var filterValue = function (name) {
+    return document.querySelector('[name="' + name + '"]').value.trim().toUpperCase();
+};
+var bindBuyButtons = function () {
+    var buttons = document.querySelectorAll('.to__cart');
+    for (var i = 0; i < buttons.length; i++) {
+        buttons[i].onclick = function () {
+            selected = this.getAttribute('data-ticket');
+            document.getElementById('cart_popup').style.display = 'block';
+        };
+    }
+};
+var render = function (tickets) {
+    var section = filterValue('filter_ticket_section'), row = filterValue('filter_ticket_row'), seats = filterValue('filter_ticket_seat');
+    var html = '';
+    for (var i = 0; i < tickets.length; i++) {
+        var t = tickets[i];
+        if ((section && t.section.toUpperCase().indexOf(section) < 0) || (row && t.row.toUpperCase().indexOf(row) < 0) ||
+                (seats && t.seats.toUpperCase().indexOf(seats) < 0)) {
+            continue;
+        }
+        html += '<tr id="ticket_' + t.id + '"><td class="column_quantity">' + t.quantity + '</td>' +
+            '<td class="column_section">' + t.section + '</td><td class="column_row">' + t.row + '</td>' +
+            '<td class="column_seats">' + t.seats + '</td><td class="column_price">' + t.price + '</td>' +
+            '<td><button class="button special no__border to__cart clickable" data-ticket="' + t.id + '">Buy</button></td></tr>';
+    }
+    document.querySelector('#marketplace_list tbody').innerHTML = html;
+    bindBuyButtons();
+};
+document.querySelector('.filter_tm').onclick = function () {
+    fetch('/api/event/' + eventId + '/listings').then(function (r) { return r.json(); }).then(function (d) { render(d.tickets); });
+};
+document.querySelector('.purchase_send_checkout').onclick = function () {
+    location.href = '/purchase?ticket=' + selected;
+};
+bindBuyButtons();
+if (__AUTO_REFRESH_MS__ > 0) {
+    setInterval(document.querySelector('.filter_tm').onclick, __AUTO_REFRESH_MS__);
+}
+</script>
+</body></html>"""
+
+PAGE_PURCHASE = """<html><head><title>TradeDesk Purchase</title>
+<link rel="stylesheet" href="/braintree/dropin.css">
+</head><body>
+<div id="tmp_header_menu_left">Marketplace</div>
+<div id="purchase">
+    <span dataformat="price">__PRICE__</span>
+    <button id="cancel">Cancel</button>
+    <div id="cancel_confirm" style="display: none;"><button class="action yes">Yes</button></div>
+    <div id="payment"></div>
+    <button id="proceed">Complete Transaction</button>
+</div>
+<script src="/braintree/dropin.js"></script>
+<script>
+document.getElementById('cancel').onclick = function () {
+    document.getElementById('cancel_confirm').style.display = 'block';
+};
+document.querySelector('.action.yes').onclick = function () {
+    location.href = '/cancelled?ticket=__TICKET_ID__';
+};
+document.getElementById('proceed').onclick = function () {
+    location.href = '/confirmed?ticket=__TICKET_ID__';
+};
+</script>
+</body></html>"""
+
+# The payment widget only shows up when its script loads
+BRAINTREE_JS = """setTimeout(function () {
+    document.getElementById('payment').innerHTML = '<div class="braintree-methods braintree-methods-initial">Paying with card</div>';
+}, __WIDGET_MS__);
+"""
+
+# Static assets with the weight of the real ones: path -> (body, content type)
+ASSETS = {
+    "/assets/marketplace.css": ("@font-face { font-family: Marketplace; src: url(/assets/marketplace.woff2); }\n"
+                                "body { font-family: Marketplace, sans-serif; }\n" + "/* padding */\n" * 2000, "text/css"),
+    "/assets/marketplace.woff2": (bytes(range(256)) * 320, "font/woff2"),
+    "/assets/banner.png": (b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 480, "image/png"),
+    "/analytics/collect.js": ("var analytics = [];\n" + "analytics.push(0);\n" * 3000, "application/javascript"),
+    "/braintree/dropin.css": (".braintree-methods { display: block; }\n" + "/* padding */\n" * 1000, "text/css"),
+}
+
+PAGE_DONE = """<html><head><title>TradeDesk</title></head><body>
+<div id="tmp_header_menu_left">Marketplace</div>
+<div class="__RESULT__">Order __RESULT__: __TICKET_ID__</div>
+</body></html>"""
+
+
+# Scripted inventory: noise listings from the start, more arriving over time and the wanted listing after a delay
+class InventoryGenerator:
+    SECTIONS = ["GOLD1", "GOLD2", "GREEN1", "P-LOT", "205"]
+
+    def __init__(self, noise=20, arrival=2.0, churn=1.0, seed=1):
+        self.noise = noise
+        # Seconds after the event is added until the wanted listing arrives
+        self.arrival = arrival
+        # Seconds between two arriving noise listings
+        self.churn = churn
+        self.random = random.Random(seed)
+        self.ticket_ids = iter(range(9000000, 99999999))
+        self.events = {}
+        self.tickets = {}
+        self.lock = threading.Lock()
+
+    def listing(self, section=None, row=None, seats=None, price=None):
+        seat = self.random.randint(1, 50)
+        return {"id": str(next(self.ticket_ids)), "quantity": "1/1",
+                "section": section or self.random.choice(self.SECTIONS),
+                "row": row or str(self.random.randint(1, 60)),
+                "seats": seats or f"{seat}-{seat}",
+                "price": f"${price if price is not None else self.random.uniform(20, 400):.2f}"}
+
+    # Scripts the inventory of an event, the wanted listing arrives after the arrival delay
+    def add_event(self, event_id, section, row, seats, price):
+        with self.lock:
+            schedule = [(0.0, self.listing()) for _ in range(self.noise)]
+            schedule += [(self.churn * (i + 1), self.listing()) for i in range(int(60 / self.churn))]
+            schedule.append((self.arrival, self.listing(section=section, row=row, seats=seats, price=price)))
+            schedule.sort(key=lambda arrival: arrival[0])
+            self.events[event_id] = (time.time(), schedule)
+            for _, listing in schedule:
+                self.tickets[listing["id"]] = listing
+
+    # Gets the listings of an event which arrived so far
+    def listings(self, event_id):
+        with self.lock:
+            if event_id not in self.events:
+                return []
+            created, schedule = self.events[event_id]
+        elapsed = time.time() - created
+        return [listing for arrive_at, listing in schedule if arrive_at <= elapsed]
+
+
+class MockTradeDesk(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, inventory=None, port=0, widget_ms=300, auto_refresh_ms=0, cache_assets=False):
+        super().__init__(("127.0.0.1", port), MockTradeDeskHandler)
+        self.inventory = inventory or InventoryGenerator()
+        # Delay of the payment widget initialization on the cart page
+        self.widget_ms = widget_ms
+        # Refreshes the tickets table by itself like the real marketplace, 0 to disable
+        self.auto_refresh_ms = auto_refresh_ms
+        # Lets the browsers cache the static and payment assets like a CDN does
+        self.cache_assets = cache_assets
+        # Timestamps of the cart, confirmed and cancelled hits per ticket id
+        self.hits = {"purchase": {}, "confirmed": {}, "cancelled": {}}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def event_url(self, event_id, section, row, seats, price_from, price_to):
+        return (f"{self.url}marketplace/event/{event_id}?all_events=1&onlyrequest=1&section={section}&row={row}&seats={seats}"
+                f"&all_inv=1&refreshInterval=300&autocheckout=1&priceFrom={price_from:.2f}&priceTo={price_to:.2f}")
+
+    def hit(self, kind, ticket_id):
+        with self.lock:
+            self.hits[kind].setdefault(ticket_id, time.time())
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class MockTradeDeskHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def send_body(self, body, content_type="text/html", cacheable=False):
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "public, max-age=86400" if cacheable else "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        logged_in = "mock_session=1" in (self.headers.get("Cookie") or "")
+        parts = url.path.strip("/").split("/")
+        inventory = self.server.inventory
+        if url.path == "/":
+            self.send_body(PAGE_HOME if logged_in else PAGE_LOGIN)
+        elif parts[:2] == ["marketplace", "event"] and len(parts) == 3:
+            # Render the inventory which arrived so far, like the server side rendered marketplace
+            rows = "".join(
+                f'<tr id="ticket_{t["id"]}"><td class="column_quantity">{t["quantity"]}</td><td class="column_section">{escape(t["section"])}</td>'
+                f'<td class="column_row">{escape(t["row"])}</td><td class="column_seats">{escape(t["seats"])}</td><td class="column_price">{t["price"]}</td>'
+                f'<td><button class="button special no__border to__cart clickable" data-ticket="{t["id"]}">Buy</button></td></tr>'
+                for t in inventory.listings(parts[2]))
+            self.send_body(PAGE_EVENT.replace("__EVENT_ID__", parts[2]).replace("__ROWS__", rows)
+                           .replace("__AUTO_REFRESH_MS__", str(self.server.auto_refresh_ms)))
+        elif parts[:2] == ["api", "event"] and len(parts) == 4:
+            self.send_body(json.dumps({"tickets": inventory.listings(parts[2])}), content_type="application/json")
+        elif url.path == "/purchase":
+            ticket_id = query.get("ticket", "")
+            self.server.hit("purchase", ticket_id)
+            ticket = inventory.tickets.get(ticket_id, {"price": "$0.00"})
+            self.send_body(PAGE_PURCHASE.replace("__PRICE__", ticket["price"]).replace("__TICKET_ID__", escape(ticket_id)))
+        elif url.path in ASSETS:
+            self.send_body(*ASSETS[url.path], cacheable=self.server.cache_assets)
+        elif url.path == "/braintree/dropin.js":
+            self.send_body(BRAINTREE_JS.replace("__WIDGET_MS__", str(self.server.widget_ms)), content_type="application/javascript",
+                           cacheable=self.server.cache_assets)
+        elif url.path in ("/confirmed", "/cancelled"):
+            ticket_id = query.get("ticket", "")
+            self.server.hit(url.path.strip("/"), ticket_id)
+            self.send_body(PAGE_DONE.replace("__RESULT__", url.path.strip("/")).replace("__TICKET_ID__", escape(ticket_id)))
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    server = MockTradeDesk(port=port)
+    server.inventory.add_event("7365591", section="GOLD1", row="21", seats="23-23", price=233.00)
+    print(f"MockTradeDesk running at: {server.url}")
+    print(f"Event URL: {server.event_url('7365591', 'GOLD1', '21', '23-23', 230.30, 235.70)}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
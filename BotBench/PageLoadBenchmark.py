@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+    *******************************************************************************************
+    PageLoadBenchmark: Event page load time and bytes transferred per resource profile
+    Loads the MockTradeDesk event page with and without the ResourcePolicy for each page load
+    strategy, and checks the payment widget still loads on the cart page
+    Usage: python BotBench/PageLoadBenchmark.py [loads per profile]
+    *******************************************************************************************
+"""
+import os
+import sys
+import json
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__))).parent
+sys.path.insert(0, str(PROJECT_ROOT))
+sys.path.insert(0, str(PROJECT_ROOT / 'BotBench'))
+
+from TradeDeskBot import TradeDeskBot, ResourcePolicy
+from MockTradeDesk import MockTradeDesk, InventoryGenerator
+
+
+# Loads the event page a number of times and returns the mean get() and ready times in ms and the bytes per load
+def run(bot, server, event_url, loads, resource_policy, page_load_strategy):
+    driver = bot.get_driver(headless=True, resource_policy=resource_policy, page_load_strategy=page_load_strategy)
+    try:
+        get_ms, ready_ms, sent = 0.0, 0.0, 0
+        for _ in range(loads):
+            sent_before = server.bytes_sent
+            start = time.perf_counter()
+            driver.get(event_url)
+            get_ms += (time.perf_counter() - start) * 1000
+            # The bot only needs the filters, whatever the strategy returned on
+            bot.wait_until_visible(driver=driver, css_selector='[class*="filter_tm"]', duration=10)
+            ready_ms += (time.perf_counter() - start) * 1000
+            # Let the asynchronous resources finish before counting the bytes
+            time.sleep(0.5)
+            sent += server.bytes_sent - sent_before
+        driver.get(f"{server.url}purchase?ticket=0")
+        try:
+            bot.wait_until_visible(driver=driver, css_selector='[class="braintree-methods braintree-methods-initial"]', duration=5)
+            payment_widget = "loaded"
+        except Exception:
+            payment_widget = "BLOCKED"
+        return get_ms / loads, ready_ms / loads, sent / loads, payment_widget
+    finally:
+        driver.quit()
+
+
+def main():
+    loads = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    server = MockTradeDesk(inventory=InventoryGenerator(noise=200), widget_ms=100).start()
+    server.inventory.add_event("7365591", section="GOLD1", row="21", seats="23-23", price=233.00)
+    event_url = server.event_url("7365591", "GOLD1", "21", "23-23", 230.30, 235.70)
+    with open(PROJECT_ROOT / 'BotRes/Settings.json', 'r') as f:
+        settings = json.load(f)
+    resource_policy = ResourcePolicy.from_settings(settings["Settings"])
+    # The profiles pass their policy explicitly
+    settings["Settings"].update({"BaseURL": server.url, "OrderLedger": False, "ResourcePolicy": {}})
+    bot = TradeDeskBot(settings=settings)
+
+    print(f"{'Profile':<10}{'Strategy':>10}{'get() ms':>10}{'Ready ms':>10}{'KB per load':>13}{'Payment widget':>16}")
+    for profile, policy in (("baseline", None), ("blocked", resource_policy)):
+        for page_load_strategy in ("normal", "eager", "none"):
+            get_ms, ready_ms, sent, payment_widget = run(bot=bot, server=server, event_url=event_url, loads=loads,
+                                                         resource_policy=policy, page_load_strategy=page_load_strategy)
+            print(f"{profile:<10}{page_load_strategy:>10}{get_ms:>10.0f}{ready_ms:>10.0f}{sent / 1024:>13.1f}{payment_widget:>16}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+    *******************************************************************************************
+    StartupBenchmark: Cold import time of TradeDeskBot, from python -X importtime
+    Reports the slowest imports and fails when the import exceeds the budget or a deferred
+    heavy module got imported at startup again
+    Usage: python BotBench/StartupBenchmark.py [--runs 5] [--budget-ms 150] [--top 15]
+    *******************************************************************************************
+"""
+import os
+import sys
+import argparse
+import subprocess
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__))).parent
+
+# Modules which must only be imported once used
+DEFERRED_MODULES = ["selenium.webdriver.remote.webdriver", "requests", "asyncio", "pubnub.pubnub", "ntplib", "pyfiglet",
+                    "websockets", "psutil"]
+
+# Imports the bot and prints the deferred modules which were really loaded
+IMPORT_SCRIPT = f"""
+import sys
+sys.path.insert(0, {str(PROJECT_ROOT)!r})
+import TradeDeskBot
+loaded = [name for name in {DEFERRED_MODULES!r} if name in sys.modules and type(sys.modules[name]).__name__ != '_LazyModule']
+print(','.join(loaded))
+"""
+
+
+# Imports the bot in a fresh interpreter and returns the cumulative import times in us per module and the loaded deferred modules
+def run():
+    # Run from an empty directory so nothing but the import is measured
+    with tempfile.TemporaryDirectory() as directory:
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT], capture_output=True, text=True,
+                                 cwd=directory)
+    rows = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        rows.append((module.strip(), module.startswith("  "), int(self_us), int(cumulative_us)))
+    # A module is listed after its imports: the imports of TradeDeskBot are the nested rows right before it
+    end = next(index for index, row in enumerate(rows) if row[0] == "TradeDeskBot")
+    start = end
+    while start > 0 and rows[start - 1][1]:
+        start -= 1
+    import_times = {module: (self_us, cumulative_us) for module, _, self_us, cumulative_us in rows[start:end + 1]}
+    loaded = [name for name in process.stdout.strip().split(",") if name]
+    return import_times, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold import time of TradeDeskBot')
+    parser.add_argument('--runs', type=int, default=5, help='imports to take the best time of')
+    parser.add_argument('--budget-ms', type=float, default=150, help='fail when the import takes longer')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to report')
+    args = parser.parse_args()
+
+    runs = [run() for _ in range(args.runs)]
+    # The best run is the least disturbed by the rest of the machine
+    import_times, loaded = min(runs, key=lambda result: result[0].get("TradeDeskBot", (0, float("inf")))[1])
+    total_ms = import_times["TradeDeskBot"][1] / 1000
+    print(f"TradeDeskBot import: {total_ms:.1f} ms (best of {args.runs}) | Budget: {args.budget_ms:.0f} ms")
+    print(f"{'Module':<50}{'Self ms':>10}{'Cumulative ms':>15}")
+    for module, (self_us, cumulative_us) in sorted(import_times.items(), key=lambda item: -item[1][1])[1:args.top + 1]:
+        print(f"{module:<50}{self_us / 1000:>10.1f}{cumulative_us / 1000:>15.1f}")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: deferred modules imported at startup: {', '.join(loaded)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"FAIL: import took {total_ms:.1f} ms, over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
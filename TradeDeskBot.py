@@ -7,44 +7,260 @@
     *******************************************************************************************
 """
 import os
-import pickle
+import sys
+import shutil
+import tempfile
+import subprocess
+import importlib.util
+import socket
+import socketserver
+import collections
+import copy
+import sqlite3
+import hashlib
+import hmac
+import uuid
+import argparse
+import queue
 import re
 import json
+import math
 import random
+import heapq
+import itertools
+import functools
+import fnmatch
+import atexit
+import contextlib
+import contextvars
 import logging.config
+import logging.handlers
 import threading
 import time
 from time import sleep
-import pandas as pd
-import requests
-import pyfiglet
-import ntplib
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs, urljoin
+from html.parser import HTMLParser
 from multiprocessing import freeze_support
 import concurrent.futures
 from selenium import webdriver
-from selenium.common import WebDriverException
+from selenium.common import WebDriverException, TimeoutException
 from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support.select import Select
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.remote.command import Command
 from pubnub.callbacks import SubscribeCallback
-from pubnub.enums import PNStatusCategory, PNOperationType
-from pubnub.pnconfiguration import PNConfiguration
-from pubnub.pubnub import PubNub
+from pubnub.enums import PNStatusCategory
 
-pnconfig = PNConfiguration()
 
-pnconfig.subscribe_key = 'sub-06059d87-ebbe-11e1-8247-37c456d16340'
-pnconfig.publish_key = 'pub-f59b296a-9c78-45fc-b592-d5e6f9e839b4'
-pnconfig.user_id = "Channel-TradeDeskBot"
-pubnub = PubNub(pnconfig)
+# Imports a module on its first attribute access instead of at startup
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# Heavy imports deferred until used: selenium's WebDriver stack by the drivers, requests by the fast path,
+# asyncio by the asyncio engine, the PubNub client by the listener, ntplib and pyfiglet by main
+asyncio = lazy_import("asyncio")
+requests = lazy_import("requests")
+EC = lazy_import("selenium.webdriver.support.expected_conditions")
+
 PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__)))
 
+# Reads a ticket row of the marketplace table as [ID, Section, Row, Seats, Qty, Price]
+JS_READ_TICKET = """
+var readTicket = function (row) {
+    var cell = function (column) {
+        var el = row.querySelector('[class*="' + column + '"]');
+        return el ? el.textContent.trim() : '';
+    };
+    return [row.id.slice(7), cell('column_section'), cell('column_row'),
+            cell('column_seats'), cell('column_quantity'), cell('column_price')];
+};
+"""
+
+# Reads every ticket row of the marketplace table in a single WebDriver round trip
+JS_TICKET_ROWS = JS_READ_TICKET + """
+var rows = document.querySelectorAll('tr[id*="ticket_"]');
+var snapshot = new Array(rows.length);
+for (var i = 0; i < rows.length; i++) {
+    snapshot[i] = readTicket(rows[i]);
+}
+return snapshot;
+"""
+
+# Installs a MutationObserver which buffers the IDs of added, changed or removed ticket rows
+JS_WATCH_INSTALL = """
+if (window.__tdWatch) {
+    return true;
+}
+var watch = {pending: {}, waiter: null};
+var mark = function (node, deep) {
+    if (!node) {
+        return;
+    }
+    if (node.nodeType !== 1) {
+        node = node.parentElement;
+        if (!node) {
+            return;
+        }
+    }
+    var row = node.closest('tr[id*="ticket_"]');
+    if (row) {
+        watch.pending[row.id] = true;
+    }
+    if (!deep) {
+        return;
+    }
+    var rows = node.querySelectorAll('tr[id*="ticket_"]');
+    for (var i = 0; i < rows.length; i++) {
+        watch.pending[rows[i].id] = true;
+    }
+};
+watch.observer = new MutationObserver(function (mutations) {
+    for (var i = 0; i < mutations.length; i++) {
+        var mutation = mutations[i];
+        mark(mutation.target, false);
+        for (var j = 0; j < mutation.addedNodes.length; j++) {
+            mark(mutation.addedNodes[j], true);
+        }
+        for (var k = 0; k < mutation.removedNodes.length; k++) {
+            mark(mutation.removedNodes[k], true);
+        }
+    }
+    if (watch.waiter && Object.keys(watch.pending).length) {
+        watch.waiter();
+    }
+});
+watch.observer.observe(document.body, {childList: true, subtree: true, characterData: true});
+window.__tdWatch = watch;
+return true;
+"""
+
+# Long-polls the inventory watcher until it has buffered changes or the timeout expires
+# Resolves to [ticket rows, removed ticket IDs] or null if the watcher is not installed
+JS_WATCH_DRAIN = JS_READ_TICKET + """
+var done = arguments[arguments.length - 1];
+var timeout = arguments[0];
+var watch = window.__tdWatch;
+if (!watch) {
+    done(null);
+    return;
+}
+var drain = function () {
+    var rows = [], removed = [];
+    for (var id in watch.pending) {
+        var row = document.getElementById(id);
+        if (row) {
+            rows.push(readTicket(row));
+        } else {
+            removed.push(id.slice(7));
+        }
+    }
+    watch.pending = {};
+    done([rows, removed]);
+};
+if (Object.keys(watch.pending).length) {
+    drain();
+    return;
+}
+var timer = setTimeout(function () {
+    watch.waiter = null;
+    drain();
+}, timeout);
+watch.waiter = function () {
+    clearTimeout(timer);
+    watch.waiter = null;
+    drain();
+};
+"""
+
+# Tells whether the transaction went through after clicking proceed: "confirmed", "failed" or null while pending.
+# Only the confirmation page counts, its URL containing arguments[0] and showing the element of selector arguments[1]
+JS_CHECKOUT_RESULT = """
+var url = arguments[0], selector = arguments[1];
+var popup = document.getElementById('messages-popup-content');
+if (popup && popup.offsetParent !== null && popup.textContent.trim()) {
+    return 'failed';
+}
+if ((url || selector) && (!url || location.href.indexOf(url) !== -1) && (!selector || document.querySelector(selector))) {
+    return 'confirmed';
+}
+return null;
+"""
+
+# Fills the inputs given as {input name: value} which do not hold their value yet, and fires the events the page listens to
+JS_FILL_INPUTS = """
+var values = arguments[0] || {}, filled = 0;
+for (var name in values) {
+    var input = document.querySelector('[name="' + name + '"]');
+    if (!input || input.value === values[name]) {
+        continue;
+    }
+    input.value = values[name];
+    ['input', 'change', 'keyup'].forEach(function (type) {
+        input.dispatchEvent(new Event(type, {bubbles: true}));
+    });
+    filled++;
+}
+"""
+
+# Fills the filter inputs and returns the number of inputs filled
+JS_FILL_FILTERS = JS_FILL_INPUTS + """
+return filled;
+"""
+
+# Refills the filter inputs the page cleared, then toggles the All Inventory filter twice to refresh the tickets table
+JS_REFRESH_INVENTORY = JS_FILL_INPUTS + """
+var filter = document.querySelector('[class*="filter_tm"]');
+if (filter) {
+    filter.click();
+    filter.click();
+}
+return !!filter;
+"""
+
+# Waits in the page for an element to be visible and clicks it, one round trip instead of one per poll
+JS_CLICK_WHEN_VISIBLE = """
+var selector = arguments[0], deadline = Date.now() + arguments[1], done = arguments[arguments.length - 1];
+(function poll() {
+    var element = document.querySelector(selector);
+    if (element && (element.offsetWidth || element.offsetHeight || element.getClientRects().length)) {
+        element.click();
+        done(true);
+    } else if (Date.now() > deadline) {
+        done(false);
+    } else {
+        setTimeout(poll, 5);
+    }
+})();
+"""
+
+# Fetches the given asset URLs into the HTTP cache of the browser and returns how many loaded
+JS_PRELOAD_ASSETS = """
+var done = arguments[arguments.length - 1];
+Promise.all(arguments[0].map(function (url) {
+    return fetch(url, {mode: 'no-cors', credentials: 'include'}).then(function () { return 1; }, function () { return 0; });
+})).then(function (loaded) {
+    done(loaded.reduce(function (total, count) { return total + count; }, 0));
+});
+"""
+
+# Lists the scripts and stylesheets the page loaded
+JS_PAGE_ASSETS = """
+return performance.getEntriesByType('resource').filter(function (entry) {
+    return ['script', 'link', 'css'].indexOf(entry.initiatorType) >= 0;
+}).map(function (entry) {
+    return entry.name;
+});
+"""
+
 
 # Publishes a message to a pubnub channel with channel name
 def my_publish_callback(envelope, status):
@@ -82,43 +298,2672 @@ class EventURLHandler(SubscribeCallback):
             # Handle message decryption error. Probably client configured to
             # encrypt messages and on live data feed it received plain text.
 
+    def __init__(self, dispatcher, tracer):
+        self.dispatcher = dispatcher
+        self.tracer = tracer
+
     def message(self, pubnub, message):
-        file_event_urls = PROJECT_ROOT / 'BotRes/EventURLs.csv'
         # Handle new message stored in message.message
         # Get EventURLs from the dictionary format: {'purchaseURLs': [], 'instances': 1}
         if "purchaseURLs" in message.message:
-            event_url = message.message["purchaseURLs"][0]
-            data_dict = {"EventURL": event_url, "Processed": "No"}
-            # self.LOGGER.info(data_dict)
-            df = pd.DataFrame([data_dict])
-            # if file does not exist write headers
-            if not os.path.isfile(file_event_urls):
-                df.to_csv(file_event_urls, index=False)
-            else:  # else if exists, append without writing the headers
-                df.to_csv(file_event_urls, mode='a', header=False, index=False)
-            # self.LOGGER.info(f'EVentURL saved successfully')
+            # Every EventURL is an order of its own, watched by that many instances in parallel
+            try:
+                instances = max(int(message.message.get("instances") or 1), 1)
+            except (TypeError, ValueError):
+                instances = 1
+            # The trace starts when the message was published, timetoken is in 100 ns units
+            published_at = int(message.timetoken) / 1e7 if getattr(message, "timetoken", None) else None
+            for event_url in message.message["purchaseURLs"]:
+                trace = self.tracer.start(event_url=event_url, started_at=published_at)
+                trace.mark("pubnub")
+                # Hand the EventURL straight to the waiting instances
+                self.dispatcher.put(event_url, trace=trace, instances=instances)
+
+
+# Hands EventURLs from the PubNub listener to the idle instances without polling
+class EventURLDispatcher:
+    def __init__(self, ledger=None):
+        self.event_urls = queue.Queue()
+        # Optional OrderLedger dropping the EventURLs which were already received
+        self.ledger = ledger
+        self.duplicates = 0
+
+    # Pushes a received EventURL, its trace and the number of instances to watch it to the instances
+    def put(self, event_url, trace=None, instances=1):
+        if self.ledger is not None and not self.ledger.record(event_url):
+            self.duplicates += 1
+            return
+        self.event_urls.put((event_url, trace, instances))
+
+    # Pushes an EventURL recovered from the ledger, it is already recorded
+    def resume(self, event_url):
+        self.event_urls.put((event_url, None, 1))
+
+    # Blocks until an EventURL is available, each EventURL is handed to exactly one dispatcher
+    def get(self, timeout=None):
+        """
+        :return: (event_url, trace, instances) or (None, None, None) on timeout
+        """
+        try:
+            return self.event_urls.get(timeout=timeout)
+        except queue.Empty:
+            return None, None, None
+
+
+# Durable ledger of the orders in SQLite (WAL), one row per EventURL keyed by its hash, shared by
+# the threads and the processes of the bot. Every lookup and claim goes through the primary key
+class OrderLedger:
+    RECEIVED = "received"
+    CLAIMED = "claimed"
+    DONE = "done"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS orders (
+        url_hash TEXT PRIMARY KEY,
+        event_url TEXT NOT NULL,
+        received_at REAL NOT NULL,
+        claimed_by TEXT,
+        claimed_at REAL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        outcome TEXT
+    );
+    CREATE INDEX IF NOT EXISTS orders_state ON orders (state) WHERE state != 'done';
+    """
+
+    def __init__(self, file_ledger):
+        self.file_ledger = str(file_ledger)
+        # SQLite connections are per thread
+        self.local = threading.local()
+        self.connect().executescript(self.SCHEMA)
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # Autocommit, every statement is a transaction of its own
+            connection = sqlite3.connect(self.file_ledger, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @staticmethod
+    def hash_url(event_url):
+        return hashlib.sha1(event_url.strip().encode()).hexdigest()
+
+    # Identifies the claiming instance, host and process included so a restart can tell its own dead claims
+    @staticmethod
+    def get_worker(instance_id):
+        return f"{socket.gethostname()}:{os.getpid()}:{instance_id}"
+
+    # Records a received EventURL
+    def record(self, event_url, received_at=None):
+        """
+        An EventURL which is pending, being worked on or ended with a purchase, a held cart or an
+        unconfirmed proceed is a duplicate, one which finished without any of them is received again
+        :return: True if the order is new, False if it is a duplicate
+        """
+        url_hash = self.hash_url(event_url)
+        received_at = received_at or time.time()
+        connection = self.connect()
+        inserted = connection.execute("INSERT OR IGNORE INTO orders (url_hash, event_url, received_at, state) VALUES (?, ?, ?, ?)",
+                                      (url_hash, event_url, received_at, self.RECEIVED)).rowcount
+        if inserted:
+            return True
+        # A done row without an outcome ended without a purchase as well, NOT IN is never true for NULL
+        ended = ", ".join("?" * len(CheckoutFlow.ENDED))
+        return connection.execute("UPDATE orders SET state = ?, received_at = ?, claimed_by = NULL, outcome = NULL "
+                                  f"WHERE url_hash = ? AND state = ? AND (outcome IS NULL OR outcome NOT IN ({ended}))",
+                                  (self.RECEIVED, received_at, url_hash, self.DONE, *CheckoutFlow.ENDED)).rowcount == 1
+
+    # Claims a received order for an instance, only one thread or process can win it
+    def claim(self, url_hash, worker):
+        """
+        :return: True if claimed by the worker
+        """
+        return self.connect().execute("UPDATE orders SET state = ?, claimed_by = ?, claimed_at = ?, attempts = attempts + 1 "
+                                      "WHERE url_hash = ? AND state = ?",
+                                      (self.CLAIMED, worker, time.time(), url_hash, self.RECEIVED)).rowcount == 1
+
+    # Records the outcome of an order, i.e. confirmed, cancelled, expired, failed or invalid
+    def finish(self, url_hash, outcome):
+        self.connect().execute("UPDATE orders SET state = ?, outcome = ? WHERE url_hash = ?", (self.DONE, outcome, url_hash))
+
+    def get(self, url_hash):
+        """
+        :return: the row of the order as a dict, None if unknown
+        """
+        cursor = self.connect().execute("SELECT * FROM orders WHERE url_hash = ?", (url_hash,))
+        row = cursor.fetchone()
+        return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    # Gets the orders to resume after a restart
+    def recover(self, max_age, is_running):
+        """
+        Orders older than max_age are finished as expired, the claims of dead processes on this host
+        are released
+        :param is_running: callable telling if a process id of this host is still running
+        :return: list of the EventURLs to dispatch again, oldest first
+        """
+        connection = self.connect()
+        now = time.time()
+        host = socket.gethostname()
+        event_urls = []
+        rows = connection.execute("SELECT url_hash, event_url, received_at, claimed_by, state FROM orders WHERE state != 'done' "
+                                  "ORDER BY received_at").fetchall()
+        for url_hash, event_url, received_at, claimed_by, state in rows:
+            if now - received_at > max_age:
+                self.finish(url_hash, "expired")
+                continue
+            if state == self.CLAIMED:
+                claim_host, pid, _ = (claimed_by or "::").split(":", 2)
+                # Another process or host is still working on it
+                if claim_host != host or (pid.isdigit() and is_running(int(pid))):
+                    continue
+                # Release the claim of the dead process, only one of the restarting processes wins it
+                released = connection.execute("UPDATE orders SET state = ?, claimed_by = NULL WHERE url_hash = ? AND state = ? "
+                                              "AND claimed_by = ?", (self.RECEIVED, url_hash, self.CLAIMED, claimed_by)).rowcount
+                if not released:
+                    continue
+            event_urls.append(event_url)
+        return event_urls
+
+
+# In-memory broker of a consumer group of workers: the coordinator publishes the orders and every
+# worker fetches one whenever it has an idle instance, so the orders are balanced by capacity.
+# The orders of a worker which stops sending heartbeats are requeued for the others
+class MemoryBroker:
+    def __init__(self, worker_timeout=10, on_ack=None):
+        self.worker_timeout = worker_timeout
+        # Called with (event_url, outcome) when a worker finishes an order
+        self.on_ack = on_ack
+        self.pending = collections.deque()
+        self.queued = set()
+        # event_url -> (worker_id, message)
+        self.in_flight = {}
+        # worker_id -> {"capacity": idle instances, "last_seen": time}
+        self.workers = {}
+        self.condition = threading.Condition()
+        self.failovers = 0
+
+    # Queues an order for the workers
+    def publish(self, event_url, received_at=None, instances=1):
+        with self.condition:
+            if event_url in self.queued or event_url in self.in_flight:
+                return
+            self.pending.append({"event_url": event_url, "received_at": received_at or time.time(), "instances": instances})
+            self.queued.add(event_url)
+            self.condition.notify()
+
+    # Reports the capacity of a worker and the orders it is working on, i.e. after the coordinator restarted
+    def heartbeat(self, worker_id, capacity, in_flight=()):
+        with self.condition:
+            self.workers[worker_id] = {"capacity": capacity, "last_seen": time.time()}
+            for event_url in in_flight:
+                if event_url in self.queued:
+                    self.queued.discard(event_url)
+                    self.pending = collections.deque(message for message in self.pending if message["event_url"] != event_url)
+                if event_url not in self.in_flight:
+                    self.in_flight[event_url] = (worker_id, {"event_url": event_url, "received_at": time.time()})
+            self.check_workers()
+
+    # Takes the next order for a worker, blocks up to timeout seconds
+    def fetch(self, worker_id, capacity=1, timeout=1.0):
+        """
+        :return: message dict of the order with its event_url, received_at and instances, None on timeout
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            self.workers[worker_id] = {"capacity": capacity, "last_seen": time.time()}
+            self.check_workers()
+            while not self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            message = self.pending.popleft()
+            self.queued.discard(message["event_url"])
+            self.in_flight[message["event_url"]] = (worker_id, message)
+            return message
+
+    # Records a finished order
+    def ack(self, worker_id, event_url, outcome):
+        with self.condition:
+            self.in_flight.pop(event_url, None)
+        if self.on_ack is not None:
+            self.on_ack(event_url, outcome)
+
+    # Removes a worker which stops, its orders go to the others
+    def leave(self, worker_id):
+        with self.condition:
+            self.workers.pop(worker_id, None)
+            self.requeue(worker_id)
+
+    # Fails over the orders of the workers which missed their heartbeats, the condition must be held
+    def check_workers(self):
+        now = time.time()
+        for worker_id, worker in list(self.workers.items()):
+            if now - worker["last_seen"] > self.worker_timeout:
+                del self.workers[worker_id]
+                self.failovers += self.requeue(worker_id)
+
+    # Puts the orders of a worker back at the front of the queue, the condition must be held
+    def requeue(self, worker_id):
+        messages = [message for owner, message in self.in_flight.values() if owner == worker_id]
+        for message in reversed(messages):
+            del self.in_flight[message["event_url"]]
+            self.pending.appendleft(message)
+            self.queued.add(message["event_url"])
+        if messages:
+            self.condition.notify_all()
+        return len(messages)
+
+    def status(self):
+        """
+        :return: dict of the workers with their capacity and orders in flight
+        """
+        with self.condition:
+            self.check_workers()
+            return {worker_id: {"capacity": worker["capacity"], "in_flight": sum(owner == worker_id for owner, _ in self.in_flight.values())}
+                    for worker_id, worker in self.workers.items()}
+
+    def __str__(self):
+        workers = self.status()
+        return (f"Workers: {len(workers)} | Capacity: {sum(worker['capacity'] for worker in workers.values())} | "
+                f"Pending: {len(self.pending)} | In flight: {len(self.in_flight)} | Failovers: {self.failovers}")
+
+
+# Serves a MemoryBroker to the workers on other processes or hosts, one JSON request per line
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Operations of the workers, the coordinator publishes the orders in process
+    OPERATIONS = ("heartbeat", "fetch", "ack", "leave", "status")
+    LOOPBACK = ("127.0.0.1", "localhost", "::1")
+
+    def __init__(self, broker, address="127.0.0.1:7465", secret=None, logger=None):
+        """
+        :param secret: shared secret every request must carry
+        :raises ValueError: if the address is reachable from other hosts and there is no secret
+        """
+        host, port = address.rsplit(":", 1)
+        if not secret and host not in self.LOOPBACK:
+            raise ValueError(f"BrokerSecret is required to listen on: {address}")
+        super().__init__((host, int(port)), BrokerRequestHandler)
+        self.broker = broker
+        self.secret = secret
+        self.logger = logger or logging.getLogger()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            operation = None
+            try:
+                request = json.loads(line)
+                if self.server.secret and not hmac.compare_digest(str(request.pop("secret", "")).encode(), self.server.secret.encode()):
+                    self.wfile.write(json.dumps({"error": "Invalid broker secret"}).encode() + b"\n")
+                    return
+                request.pop("secret", None)
+                operation = request.pop("op")
+                if operation not in BrokerServer.OPERATIONS:
+                    raise ValueError(f"Unknown broker operation: {operation}")
+                response = {"result": getattr(self.server.broker, operation)(**request)}
+            except (ValueError, TypeError, KeyError) as exc:
+                response = {"error": str(exc)}
+            except Exception as exc:
+                # A failed operation, i.e. a ledger error, is answered so the worker does not take the broker for dead
+                self.server.logger.exception(f"Error in broker operation: {operation}")
+                response = {"error": f"{type(exc).__name__}: {exc}"}
+            try:
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+            except OSError as exc:
+                self.server.logger.warning(f"Error while answering broker operation: {operation}, {exc}")
+                return
+
+
+# Client of a BrokerServer with the same interface as the MemoryBroker, publish aside
+class SocketBroker:
+    def __init__(self, address="127.0.0.1:7465", timeout=10, secret=None):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.timeout = timeout
+        self.secret = secret
+        # One connection per thread, a fetch blocks its connection
+        self.local = threading.local()
+
+    def call(self, operation, **arguments):
+        """
+        :raises ConnectionError: if the broker can't be reached
+        :raises ValueError: if the broker answered with an error
+        """
+        connection = getattr(self.local, "connection", None)
+        try:
+            if connection is None:
+                connection = socket.create_connection(self.address, timeout=self.timeout + arguments.get("timeout", 0))
+                self.local.connection = connection
+                self.local.file = connection.makefile("rb")
+            connection.sendall(json.dumps(dict(arguments, op=operation, secret=self.secret)).encode() + b"\n")
+            line = self.local.file.readline()
+            if not line:
+                raise ConnectionError("Broker closed the connection")
+        except OSError as exc:
+            self.local.connection = None
+            if connection is not None:
+                connection.close()
+            raise ConnectionError(f"Broker {self.address[0]}:{self.address[1]} unreachable: {exc}")
+        response = json.loads(line)
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["result"]
+
+    def heartbeat(self, worker_id, capacity, in_flight=()):
+        return self.call("heartbeat", worker_id=worker_id, capacity=capacity, in_flight=list(in_flight))
+
+    def fetch(self, worker_id, capacity=1, timeout=1.0):
+        return self.call("fetch", worker_id=worker_id, capacity=capacity, timeout=timeout)
+
+    def ack(self, worker_id, event_url, outcome):
+        return self.call("ack", worker_id=worker_id, event_url=event_url, outcome=outcome)
+
+    def leave(self, worker_id):
+        return self.call("leave", worker_id=worker_id)
+
+    def status(self):
+        return self.call("status")
+
+
+# Nearest-rank percentile of the values, i.e. the smallest value with at least p% of the values at or below it
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p * len(values) / 100) - 1)]
+
+
+# Writes the stage spans of every order to a JSONL file and reports latency percentiles per stage
+class Tracer:
+    STAGES = ("pubnub", "broker", "queue pickup", "assigned", "page load", "filters", "first row", "match",
+              "buy", "checkout", "cart", "price verify", "payment ready", "proceed")
+
+    def __init__(self, file_traces=None):
+        # Tracing is disabled without a file
+        self.file_traces = file_traces
+        self.spans = queue.Queue()
+        self.writer = None
+        if file_traces is not None:
+            self.writer = threading.Thread(target=self.write_spans, daemon=True)
+            self.writer.start()
+            # The spans of the last orders are still queued at exit
+            atexit.register(self.close)
+
+    # Starts the trace of an order
+    def start(self, event_url, started_at=None):
+        return OrderTrace(tracer=self, event_url=event_url, started_at=started_at)
+
+    # Queues a span to be written off the hot path
+    def write(self, span):
+        if self.file_traces is not None:
+            self.spans.put(span)
+
+    # Appends the spans to the traces file in the background
+    def write_spans(self):
+        closed = False
+        while not closed:
+            spans = [self.spans.get()]
+            while not self.spans.empty():
+                spans.append(self.spans.get_nowait())
+            # None is queued by close, after the last spans
+            closed = None in spans
+            with open(self.file_traces, 'a') as f:
+                f.writelines(json.dumps(span) + "\n" for span in spans if span is not None)
+
+    # Writes the queued spans and stops the writer
+    def close(self, timeout=5):
+        if self.writer is None or not self.writer.is_alive():
+            return
+        self.spans.put(None)
+        self.writer.join(timeout)
+
+    # Prints p50/p95/p99 of every stage across all the traced orders
+    @classmethod
+    def report(cls, file_traces):
+        durations = {}
+        with open(file_traces, 'r') as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                durations.setdefault(span["stage"], []).append(span["duration_ms"])
+        if not durations:
+            print(f"No spans found in: {file_traces}")
+            return
+
+        stages = [stage for stage in cls.STAGES if stage in durations] + sorted(set(durations) - set(cls.STAGES))
+        print(f"{'Stage':<16}{'Count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}{'Max ms':>12}")
+        for stage in stages:
+            values = sorted(durations[stage])
+            print(f"{stage:<16}{len(values):>8}{percentile(values, 50):>12.1f}{percentile(values, 95):>12.1f}"
+                  f"{percentile(values, 99):>12.1f}{values[-1]:>12.1f}")
+
+
+# Trace of one order, every mark closes the span of a stage since the previous mark
+class OrderTrace:
+    def __init__(self, tracer, event_url, started_at=None):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.event_url = event_url
+        self.last_mark = started_at or time.time()
+
+    # Starts a trace of its own for another watcher of the order, from the last mark
+    def fork(self):
+        return OrderTrace(tracer=self.tracer, event_url=self.event_url, started_at=self.last_mark)
+
+    def mark(self, stage, **fields):
+        now = time.time()
+        span = {"trace_id": self.trace_id, "stage": stage, "start": round(self.last_mark, 6), "end": round(now, 6),
+                "duration_ms": round((now - self.last_mark) * 1000, 3)}
+        span.update(fields)
+        self.tracer.write(span)
+        self.last_mark = now
+
+
+# Shared by the watchers of one order: the first watcher to reach the cart checks it out while the others keep
+# watching, they stop once the order is bought. The order finishes with its last watcher
+class OrderRace:
+    def __init__(self, instances=1):
+        self.instances = instances
+        self.lock = threading.Lock()
+        # Result of the claim of the order, made once for all the watchers
+        self.claimed = None
+        # Replica of the watcher holding the cart, released when its checkout fails or is cancelled
+        self.winner = None
+        # Replica of the last watcher which held the cart, its outcome is the outcome of the order
+        self.carted = None
+        # Set once a watcher bought the order or held its cart
+        self.ended = False
+        self.running = instances
+        self.outcome = None
+
+    # Claims the order for all the watchers, the first watcher runs the claim
+    def claim(self, claim):
+        """
+        :param claim: callable returning True if the order was claimed
+        :return: True if the order is claimed by this process
+        """
+        with self.lock:
+            if self.claimed is None:
+                self.claimed = claim()
+            return self.claimed
+
+    # Takes the checkout for a watcher which reached the cart page
+    def checkout(self, order):
+        """
+        :return: True if the watcher got to the cart first, False if another watcher holds the cart
+        """
+        with self.lock:
+            if self.winner is None and not self.ended:
+                self.winner = self.carted = order.replica
+            return self.winner == order.replica
+
+    # Gives the cart back once the checkout of its watcher is over, the order ends if it was bought
+    def release(self, order, state):
+        with self.lock:
+            if self.winner != order.replica:
+                return
+            self.winner = None
+            self.ended = state in CheckoutFlow.ENDED
+
+    # Checks if another watcher bought the order, so this one can give its instance back
+    def is_lost(self, order):
+        return self.ended and self.carted != order.replica
+
+    # Records the outcome of a watcher
+    def finish(self, order, outcome):
+        """
+        :return: outcome of the order once its last watcher finished, confirmed if any watcher confirmed,
+                 otherwise the outcome of the winner. None while watchers are running or if the claim failed
+        """
+        with self.lock:
+            self.running -= 1
+            if self.outcome not in CheckoutFlow.ENDED and (self.outcome is None or outcome in CheckoutFlow.ENDED
+                                                           or order.replica == self.carted):
+                self.outcome = outcome
+            if self.running > 0 or self.claimed is False:
+                return None
+            return self.outcome
+
+
+# Order to buy tickets, parsed and validated once from an EventURL
+class EventOrder:
+    RE_EVENT_ID = re.compile(r'/event/(\d+)')
+    RE_NUMBER = re.compile(r'\d+')
+
+    def __init__(self, event_url):
+        """
+        Parses the EventURL query regardless of the parameters order
+        :raises ValueError: if the EventURL is missing or has an invalid parameter
+        """
+        self.event_url = event_url
+        self.url_hash = OrderLedger.hash_url(event_url)
+        self.received_at = time.time()
+        # Final state of the last checkout attempt, recorded in the OrderLedger
+        self.outcome = None
+        # Set by the OrderScheduler when the order is assigned to an instance
+        self.instance_id = None
+        self.deadline = None
+        # Set when the instance of the order got stuck or its driver crashed, until the order runs again
+        self.failed_at = None
+        self.requeues = 0
+        self.trace = None
+        # Watchers of the order racing to the cart, see fan_out
+        self.race = OrderRace()
+        self.replica = 0
+        url = urlparse(event_url)
+        event_id = self.RE_EVENT_ID.search(url.path)
+        if url.scheme not in ("http", "https") or event_id is None:
+            raise ValueError(f"Invalid EventURL: {event_url}")
+        self.event_id = event_id.group(1)
+        # Keep the last value of a repeated parameter
+        query = {key: values[-1].strip() for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        for key in ("section", "row", "seats"):
+            if not query.get(key):
+                raise ValueError(f"Missing {key} in EventURL: {event_url}")
+        self.section = query["section"]
+        self.row = query["row"]
+        self.seats = query["seats"]
+        self.seat_range = self.parse_seats(self.seats)
+        # Without autocheckout the checkout stops once the payment is ready and leaves the cart to a human
+        auto_checkout = query.get("autocheckout", "0") or "0"
+        if auto_checkout not in ("0", "1"):
+            raise ValueError(f"Invalid autocheckout={auto_checkout} in EventURL: {event_url}")
+        self.auto_checkout = auto_checkout == "1"
+        try:
+            self.refresh_interval = int(query.get("refreshInterval") or 0)
+            self.price_from = float(query["priceFrom"]) if query.get("priceFrom") else None
+            self.price_to = float(query["priceTo"]) if query.get("priceTo") else None
+            # Tickets to buy, a listing must offer at least as many
+            self.quantity = int(query.get("qty") or 1)
+        except ValueError:
+            raise ValueError(f"Invalid refreshInterval, price or qty in EventURL: {event_url}")
+        if self.refresh_interval < 0:
+            raise ValueError(f"Invalid refreshInterval in EventURL: {event_url}")
+        if self.quantity < 1:
+            raise ValueError(f"Invalid qty in EventURL: {event_url}")
+        if self.price_from is not None and self.price_to is not None and self.price_from > self.price_to:
+            raise ValueError(f"priceFrom is greater than priceTo in EventURL: {event_url}")
+        # Compile the match predicate once for every ticket row of every pass
+        self.match = self.compile_match()
+
+    # Closes the span of a stage on the trace of the order, if traced
+    def mark(self, stage, **fields):
+        if self.trace is not None:
+            self.trace.mark(stage, instance=self.instance_id, **fields)
+
+    # Copies the order for a number of watchers racing to the cart, each with a trace of its own
+    def fan_out(self, instances):
+        race = OrderRace(instances=instances)
+        watchers = []
+        for replica in range(instances):
+            order = copy.copy(self)
+            order.race = race
+            order.replica = replica
+            if replica and self.trace is not None:
+                order.trace = self.trace.fork()
+            watchers.append(order)
+        return watchers
+
+    # Offsets the refreshes of a watcher, so the watchers of an order spread over the refresh period
+    def get_phase(self, period):
+        return period * self.replica / self.race.instances
+
+    # Every other watcher watches the whole inventory, in case the filters of the page miss a ticket
+    def is_filtered(self):
+        return self.replica % 2 == 0
+
+    # Values of the filter inputs of the event page, none for the watchers of the whole inventory
+    def get_filters(self):
+        if not self.is_filtered():
+            return {}
+        return {"filter_ticket_section": self.section, "filter_ticket_row": self.row, "filter_ticket_seat": self.seats}
+
+    # Normalizes section and row texts, i.e. "Gold 1" to "GOLD1"
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def normalize(text):
+        return "".join(str(text).split()).upper()
+
+    # Parses seats like "21-22", "21 - 22" or "21" into a (from, to) range or a normalized text
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def parse_seats(cls, seats):
+        numbers = cls.RE_NUMBER.findall(str(seats))
+        if not numbers or len(numbers) > 2:
+            return cls.normalize(seats)
+        return int(numbers[0]), int(numbers[-1])
+
+    # Parses the quantity of a listing, None if the table does not show it
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def parse_quantity(cls, qty):
+        numbers = cls.RE_NUMBER.findall(str(qty))
+        return int(numbers[0]) if numbers else None
+
+    # Builds the predicate matching a ticket dict against this order
+    def compile_match(self):
+        normalize, parse_seats, parse_quantity = self.normalize, self.parse_seats, self.parse_quantity
+        section, row, seat_range, quantity = normalize(self.section), normalize(self.row), self.seat_range, self.quantity
+        price_from = self.price_from if self.price_from is not None else float("-inf")
+        price_to = self.price_to if self.price_to is not None else float("inf")
+        check_price = self.price_from is not None or self.price_to is not None
+
+        def match(ticket):
+            if normalize(ticket["Section"]) != section or normalize(ticket["Row"]) != row:
+                return False
+            if parse_seats(ticket["Seats"]) != seat_range:
+                return False
+            # A listing of unknown quantity is left to the cart
+            if quantity > 1 and (parse_quantity(ticket["Qty"]) or quantity) < quantity:
+                return False
+            if check_price:
+                price = ticket["Price"]
+                return price is not None and price_from <= price <= price_to
+            return True
+        return match
+
+    # Filters the tickets matching the order from the listing data, the cheapest first
+    def rank(self, tickets):
+        """
+        The price window and quantity are checked before any cart action, the cart price is a final check
+        :return: list of the matched ticket dicts sorted by price
+        """
+        return sorted(filter(self.match, tickets), key=lambda ticket: ticket["Price"] if ticket["Price"] is not None else float("inf"))
+
+    def __str__(self):
+        return (f"Event: {self.event_id} | Section: {self.section} | Row: {self.row} | Seats: {self.seats} | "
+                f"Price: {self.price_from} - {self.price_to} | Qty: {self.quantity}")
+
+
+# Keeps an index of the tickets seen on the marketplace table between passes
+class InventoryTracker:
+    def __init__(self):
+        # ticket_id -> (price, qty, section, row, seats) as last seen
+        self.seen = {}
+        self.added = 0
+        self.removed = 0
+        self.repriced = 0
+        self.changed = 0
+
+    def update(self, ticket_rows):
+        """
+        Diffs a snapshot of the tickets table against the last seen inventory
+        :return: list of the ticket dicts which were added or changed since the last pass
+        """
+        current_ids = {ticket["ID"] for ticket in ticket_rows}
+        return self.merge(ticket_rows, removed_ids=[ticket_id for ticket_id in self.seen if ticket_id not in current_ids])
+
+    def merge(self, ticket_rows, removed_ids=()):
+        """
+        Applies a partial update of the tickets table, i.e. only the rows reported as changed
+        :return: list of the ticket dicts which were added or changed since the last pass
+        """
+        fresh = []
+        added = repriced = changed = removed = 0
+        for ticket_id in removed_ids:
+            if self.seen.pop(ticket_id, None) is not None:
+                removed += 1
+        for ticket in ticket_rows:
+            ticket_id = ticket["ID"]
+            state = (ticket["Price"], ticket["Qty"], ticket["Section"], ticket["Row"], ticket["Seats"])
+            last_state = self.seen.get(ticket_id)
+            if last_state == state:
+                continue
+            if last_state is None:
+                added += 1
+            elif last_state[0] != state[0]:
+                repriced += 1
+            else:
+                changed += 1
+            self.seen[ticket_id] = state
+            fresh.append(ticket)
+        self.added, self.removed, self.repriced, self.changed = added, removed, repriced, changed
+        return fresh
+
+    def __str__(self):
+        return f"Tickets: {len(self.seen)} | Added: {self.added} | Removed: {self.removed} | Repriced: {self.repriced} | Changed: {self.changed}"
+
+
+# Parses the ticket rows out of a marketplace page, the same rows JS_TICKET_ROWS reads in the browser
+class TicketTableParser(HTMLParser):
+    COLUMNS = {"column_section": "Section", "column_row": "Row", "column_seats": "Seats",
+               "column_quantity": "Qty", "column_price": "Price"}
+
+    def __init__(self):
+        super().__init__()
+        self.ticket_rows = []
+        self.ticket = None
+        self.column = None
+        self.column_tag = None
+        self.column_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "tr" and "ticket_" in (attrs.get("id") or ""):
+            self.ticket = {"ID": attrs["id"][7:], "Section": "", "Row": "", "Seats": "", "Qty": "", "Price": ""}
+        elif self.ticket is not None and self.column is not None:
+            if tag == self.column_tag:
+                self.column_depth += 1
+        elif self.ticket is not None:
+            class_name = attrs.get("class") or ""
+            for column, key in self.COLUMNS.items():
+                if column in class_name:
+                    self.column, self.column_tag, self.column_depth = key, tag, 0
+                    break
+
+    def handle_endtag(self, tag):
+        if self.column is not None and tag == self.column_tag:
+            if self.column_depth:
+                self.column_depth -= 1
+            else:
+                self.column = None
+        elif tag == "tr" and self.ticket is not None:
+            self.ticket_rows.append([self.ticket[key].strip() for key in ("ID", "Section", "Row", "Seats", "Qty", "Price")])
+            self.ticket = None
+
+    def handle_data(self, data):
+        if self.column is not None:
+            self.ticket[self.column] += data
+
+
+# Polls the marketplace listings over HTTP with the shared session cookies, no browser involved
+class InventoryPoller:
+    FIELDS = {"id": "ID", "section": "Section", "row": "Row", "seats": "Seats", "quantity": "Qty", "qty": "Qty", "price": "Price"}
+
+    def __init__(self, bot, listing_url="{event_url}", timeout=5):
+        self.bot = bot
+        # Listing URL template, formatted with event_url, event_id and base_url of the order
+        self.listing_url = listing_url
+        self.timeout = timeout
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.http.headers.update({"User-Agent": random.choice(bot.user_agents)})
+        self.cookies = None
+
+    # Copies the session cookies of the signed in drivers whenever they change
+    def update_cookies(self):
+        cookies = self.bot.session.cookies
+        if cookies is self.cookies:
+            return
+        self.http.cookies.clear()
+        for cookie in cookies or []:
+            self.http.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain", ""), path=cookie.get("path", "/"))
+        self.cookies = cookies
+
+    # Fetches the listings of an order
+    def poll(self, order):
+        """
+        Gets the listings as JSON, i.e. [{"id", "section", "row", "seats", "quantity", "price"}] or
+        {"tickets": [...]}, or as the marketplace HTML page with the tickets table
+        :return: list of ticket dicts
+        """
+        self.update_cookies()
+        url = self.listing_url.format(event_url=order.event_url, event_id=order.event_id, base_url=self.bot.base_url)
+        response = self.http.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        if "json" in response.headers.get("Content-Type", ""):
+            listings = response.json()
+            if isinstance(listings, dict):
+                listings = listings.get("tickets") or listings.get("listings") or []
+            ticket_rows = []
+            for listing in listings:
+                ticket = {self.FIELDS[key.lower()]: str(value) for key, value in listing.items() if key.lower() in self.FIELDS}
+                ticket_rows.append([ticket.get(key, "") for key in ("ID", "Section", "Row", "Seats", "Qty", "Price")])
+        else:
+            parser = TicketTableParser()
+            parser.feed(response.text)
+            ticket_rows = parser.ticket_rows
+        return self.bot.to_ticket_dicts(ticket_rows)
+
+
+# Token bucket of the inventory refreshes of all the instances, shared by the processes of the host
+# through SQLite so the bot stays under the rate the server throttles at. The hot events may take
+# the last tokens, the others leave HotReserve of the burst to them until they waited a full refill
+class RequestBudget:
+    SCHEMA = "CREATE TABLE IF NOT EXISTS budget (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+
+    def __init__(self, rate=10, burst=20, hot_reserve=0.5, file_budget=None):
+        # Refreshes per second and the most refreshes in a row
+        self.rate = rate
+        self.burst = burst
+        self.hot_reserve = hot_reserve
+        # Shared across the processes when set, only across the threads otherwise
+        self.file_budget = str(file_budget) if file_budget is not None else None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated_at = time.time()
+        self.granted = 0
+
+    @classmethod
+    def from_settings(cls, settings, file_budget=None):
+        refresh = settings.get("Refresh") or {}
+        return cls(rate=refresh.get("BudgetRate", 10), burst=refresh.get("BudgetBurst", 20), hot_reserve=refresh.get("HotReserve", 0.5),
+                   file_budget=file_budget if refresh.get("SharedBudget", True) else None)
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.file_budget, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(self.SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    # Refills the tokens for the time elapsed and takes one if there are enough
+    def take(self, needed):
+        """
+        :return: seconds to wait for enough tokens, 0 if a token was taken
+        """
+        if self.file_budget is None:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens < needed:
+                    return (needed - self.tokens) / self.rate
+                self.tokens -= 1
+                self.granted += 1
+                return 0
+        connection = self.connect()
+        # The write lock is taken up front so the processes update the bucket one at a time
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated_at FROM budget WHERE name = 'refresh'").fetchone()
+            now = time.time()
+            tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+            wait = 0 if tokens >= needed else (needed - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            connection.execute("INSERT OR REPLACE INTO budget (name, tokens, updated_at) VALUES ('refresh', ?, ?)", (tokens, now))
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        if not wait:
+            self.granted += 1
+        return wait
+
+    # Tokens a refresh needs, the cold events leave the reserve to the hot ones but are not starved
+    def get_needed(self, hot, waited=0):
+        return 1 if hot or waited >= self.burst / self.rate else 1 + self.hot_reserve * self.burst
+
+    # Blocks until a refresh is allowed
+    def acquire(self, hot=False):
+        """
+        :return: seconds waited
+        """
+        waited = 0
+        while True:
+            wait = self.take(self.get_needed(hot, waited))
+            if not wait:
+                return waited
+            sleep(wait)
+            waited += wait
+
+    # Same as acquire, on the event loop
+    async def acquire_async(self, hot=False):
+        waited = 0
+        while True:
+            wait = self.take(self.get_needed(hot, waited))
+            if not wait:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+
+# Refresh period of one watcher: fast right after the order arrives, during a drop window or while
+# the inventory changes, backing off with jitter while the event stays empty
+class RefreshScheduler:
+    def __init__(self, order, interval=0.5, min_interval=0.25, max_interval=5, backoff=1.5, jitter=0.2, fast_window=30,
+                 hot_window=60, drop_windows=()):
+        # The refreshInterval of the EventURL in ms overrides the interval
+        self.interval = max(order.refresh_interval / 1000 if order.refresh_interval else interval, min_interval)
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, self.interval)
+        self.backoff = backoff
+        self.jitter = jitter
+        self.fast_window = fast_window
+        self.hot_window = hot_window
+        # List of (start, end) minutes of the day
+        self.drop_windows = drop_windows
+        self.received_at = order.received_at
+        self.last_change = None
+        self.delay = self.min_interval
+
+    @classmethod
+    def from_settings(cls, order, settings, interval=None):
+        refresh = settings.get("Refresh") or {}
+        return cls(order=order, interval=interval or refresh.get("Interval", 0.5), min_interval=refresh.get("MinInterval", 0.25),
+                   max_interval=refresh.get("MaxInterval", 5), backoff=refresh.get("Backoff", 1.5), jitter=refresh.get("Jitter", 0.2),
+                   fast_window=refresh.get("FastWindow", 30), hot_window=refresh.get("HotWindow", 60),
+                   drop_windows=cls.parse_drop_windows(refresh.get("DropWindows") or ()))
+
+    # Parses drop windows like "10:00-10:15", local time
+    @staticmethod
+    def parse_drop_windows(drop_windows):
+        """
+        :raises ValueError: if a drop window is invalid
+        """
+        windows = []
+        for window in drop_windows:
+            try:
+                start, end = (datetime.strptime(text.strip(), '%H:%M') for text in window.split("-"))
+            except ValueError:
+                raise ValueError(f"Invalid DropWindows entry: {window}")
+            windows.append((start.hour * 60 + start.minute, end.hour * 60 + end.minute))
+        return tuple(windows)
+
+    def in_drop_window(self, now):
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        # A window may go past midnight
+        return any(start <= minute < end if start <= end else minute >= start or minute < end for start, end in self.drop_windows)
+
+    # Hot events get the fastest refreshes and the reserve of the RequestBudget
+    def is_hot(self, now=None):
+        now = now or time.time()
+        return (now - self.received_at < self.fast_window or self.in_drop_window(now)
+                or (self.last_change is not None and now - self.last_change < self.hot_window))
+
+    # Gets the seconds until the next refresh
+    def next_delay(self, changed=False):
+        now = time.time()
+        if changed:
+            self.last_change = now
+        if self.is_hot(now):
+            self.delay = self.min_interval
+        elif changed:
+            self.delay = self.interval
+        else:
+            self.delay = min(max(self.delay, self.interval) * self.backoff, self.max_interval)
+        return self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+# Resources the browsers do not load, as Chrome blocked URL patterns
+class ResourcePolicy:
+    # Chrome blocked URL patterns only match URLs, so the resource types are blocked by their file extensions
+    TYPE_EXTENSIONS = {
+        "Image": ("png", "jpg", "jpeg", "gif", "webp", "svg", "ico"),
+        "Font": ("woff", "woff2", "ttf", "otf", "eot"),
+        "Media": ("mp4", "webm", "mp3", "ogg"),
+        "Stylesheet": ("css",),
+    }
+
+    def __init__(self, blocked_urls=(), blocked_types=(), allowed_urls=()):
+        self.blocked_urls = list(blocked_urls)
+        self.blocked_types = list(blocked_types)
+        # The payment widget and the listing endpoints always load
+        self.allowed_urls = list(allowed_urls)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        :return: ResourcePolicy of the ResourcePolicy setting, None if there is nothing to block
+        """
+        policy = settings.get("ResourcePolicy") or {}
+        if not policy.get("BlockedURLs") and not policy.get("BlockedResourceTypes"):
+            return None
+        return cls(blocked_urls=policy.get("BlockedURLs", []), blocked_types=policy.get("BlockedResourceTypes", []),
+                   allowed_urls=policy.get("AllowedURLs", []))
+
+    # The patterns to block on the site at base_url
+    def get_blocked_patterns(self, base_url):
+        """
+        Blocked URL patterns can't express exceptions: the resource types are only blocked on the site itself
+        and a pattern matching an allowed pattern, or matched by one, is dropped
+        :return: list of URL patterns for Network.setBlockedURLs
+        """
+        site = base_url.rstrip("/")
+        patterns = list(self.blocked_urls)
+        for resource_type in self.blocked_types:
+            for extension in self.TYPE_EXTENSIONS.get(resource_type, ()):
+                patterns += [f"{site}/*.{extension}", f"{site}/*.{extension}?*"]
+        return [pattern for pattern in patterns
+                if not any(fnmatch.fnmatchcase(pattern, allowed) or fnmatch.fnmatchcase(allowed, pattern)
+                           for allowed in self.allowed_urls)]
+
+
+# One Chrome process hosting many orders, one tab each, over a single driver and login
+class BrowserTabs:
+    def __init__(self, driver, max_script_wait=0.5):
+        self.driver = driver
+        # A tab holds the driver for the whole of an async script, so the tabs watch in short turns
+        self.max_script_wait = max_script_wait
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.tabs = []
+        self.alive = True
+        # A browser over its memory threshold takes no more tabs and quits with its last one
+        self.retiring = False
+        # The window the browser opened with serves the first tab
+        self.free_handles = [driver.current_window_handle]
+        self.current = self.free_handles[0]
+        # Every command, the WebElement ones included, goes through driver.execute
+        self.execute = driver.execute
+        driver.execute = self.execute_in_tab
+
+    # Switches to the tab of the calling thread before running its command
+    def execute_in_tab(self, driver_command, params=None):
+        with self.lock:
+            handle = getattr(self.local, 'handle', None)
+            if handle is not None and handle != self.current and driver_command not in (Command.SWITCH_TO_WINDOW, Command.NEW_WINDOW):
+                self.execute(Command.SWITCH_TO_WINDOW, {"handle": handle})
+                self.current = handle
+            response = self.execute(driver_command, params)
+            if driver_command == Command.SWITCH_TO_WINDOW:
+                self.current = params["handle"]
+            return response
+
+    def open_tab(self):
+        with self.lock:
+            self.local.handle = None
+            if self.free_handles:
+                handle = self.free_handles.pop()
+            else:
+                self.driver.switch_to.new_window('tab')
+                handle = self.current
+            tab = BrowserTab(browser=self, handle=handle)
+            self.tabs.append(tab)
+        return tab
+
+    # Closes a tab, the browser quits with its last tab
+    def close_tab(self, tab):
+        with self.lock:
+            if tab in self.tabs:
+                self.tabs.remove(tab)
+            if not self.tabs:
+                self.alive = False
+                try:
+                    self.driver.quit()
+                except Exception:
+                    pass
+                return
+            self.local.handle = tab.handle
+            try:
+                self.driver.close()
+            except WebDriverException:
+                # Crashed browser, its other tabs get discarded by the health checks
+                self.alive = False
+            self.local.handle = None
+            self.current = None
+
+
+# Driver of one tab, binds the calling thread to its tab on every use
+class BrowserTab:
+    def __init__(self, browser, handle):
+        self.browser = browser
+        self.handle = handle
+        self.max_script_wait = browser.max_script_wait
+
+    def __getattr__(self, name):
+        self.browser.local.handle = self.handle
+        return getattr(self.browser.driver, name)
+
+    def quit(self):
+        self.browser.close_tab(self)
+
+
+# Pool of pre-warmed Chrome drivers, logged in and parked on the TradeDesk home page
+class DriverPool:
+    def __init__(self, bot, size, health_check_interval=30, max_latency=5, tabs_per_browser=1, max_script_wait=0.5,
+                 acquire_timeout=60, max_launch_backoff=60):
+        self.bot = bot
+        self.size = size
+        # Seconds an instance waits for a driver before it gives its order back
+        self.acquire_timeout = acquire_timeout
+        # A failed launch is retried, waiting twice as long every time up to max_launch_backoff seconds
+        self.max_launch_backoff = max_launch_backoff
+        # More than one tab per browser hands out tabs of shared browsers instead of whole drivers
+        self.tabs_per_browser = tabs_per_browser
+        self.max_script_wait = max_script_wait
+        self.browsers = []
+        self.browsers_lock = threading.Lock()
+        self.health_check_interval = health_check_interval
+        # A driver slower than max_latency seconds to answer a script is considered degraded
+        self.max_latency = max_latency
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.drivers = set()
+        self.launched = 0
+        self.replaced = 0
+        self.recycled = 0
+
+    # Launches all the drivers in parallel and starts the background health checks
+    def start(self):
+        for _ in range(self.size):
+            self.replace()
+        threading.Thread(target=self.check_idle_drivers, daemon=True).start()
+
+    # Launches a driver, signs it in and parks it on the home page, retrying until it launches so the pool keeps its size
+    def launch(self):
+        backoff = 1
+        while True:
+            try:
+                driver = self.open_tab() if self.tabs_per_browser > 1 else self.new_driver()
+                break
+            except Exception as exc:
+                self.bot.LOGGER.warning(f"Error while launching driver, retrying in {backoff}s: {exc}")
+                sleep(backoff)
+                backoff = min(backoff * 2, self.max_launch_backoff)
+        with self.lock:
+            self.drivers.add(driver)
+            self.launched += 1
+        self.idle.put(driver)
+
+    # Launches a signed in driver, a driver which fails to sign in is quit so the pool never hands it out
+    def new_driver(self):
+        """
+        :raises RuntimeError: if the driver could not sign in, launch retries it
+        """
+        driver = self.bot.get_driver(headless=self.bot.settings["Settings"].get("Headless", False))
+        try:
+            signed_in = self.bot.session.sign_in(driver=driver)
+        except Exception as exc:
+            self.bot.LOGGER.warning(f"Error while signing in driver: {exc}")
+            signed_in = False
+        if not signed_in:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+            raise RuntimeError("Driver could not sign in")
+        self.warm_up(driver)
+        return driver
+
+    # Preloads the warm standby assets in the browser, a browser of tabs is only warmed up at launch
+    def warm_up(self, driver):
+        if not self.bot.warm_standby:
+            return
+        try:
+            self.bot.warm_up(driver=driver)
+        except WebDriverException as exc:
+            self.bot.LOGGER.warning(f"Error while warming up driver: {exc.msg}")
+
+    # Opens a tab in a browser with room left, launching and signing in a new browser when all are full
+    def open_tab(self):
+        with self.browsers_lock:
+            self.browsers = [browser for browser in self.browsers if browser.alive]
+            browser = next((browser for browser in self.browsers if len(browser.tabs) < self.tabs_per_browser and not browser.retiring), None)
+            if browser is None:
+                browser = BrowserTabs(driver=self.new_driver(), max_script_wait=self.max_script_wait)
+                self.browsers.append(browser)
+            tab = browser.open_tab()
+        # The blocked URLs of the browser only apply to the tab it launched with
+        self.bot.apply_resource_policy(driver=tab)
+        tab.get(self.bot.base_url)
+        return tab
+
+    # Launches a new driver in the background
+    def replace(self):
+        threading.Thread(target=self.launch, daemon=True).start()
+
+    # Checks that a driver answers quickly and is still signed in
+    def is_healthy(self, driver):
+        start = time.time()
+        logged_in = self.bot.session.is_logged_in(driver)
+        return logged_in and time.time() - start < self.max_latency
+
+    # Hands a healthy driver to an instance, blocks until one is available or the timeout expires
+    def acquire(self, timeout=None):
+        """
+        :return: the driver, None on timeout
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        while True:
+            try:
+                driver = self.idle.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if self.is_healthy(driver):
+                return driver
+            self.discard(driver)
+
+    # Parks a driver back on the home page once an instance is done with it
+    def release(self, driver):
+        # Killed by the Watchdog and replaced already
+        with self.lock:
+            if driver not in self.drivers:
+                return
+        try:
+            driver.get(self.bot.base_url)
+        except Exception:
+            pass
+        # Preload the assets learned since the driver was warmed up
+        if not isinstance(driver, BrowserTab) and getattr(driver, "warm_assets", 0) < len(self.bot.warm_assets):
+            self.warm_up(driver)
+        reason = self.bot.resource_monitor.should_recycle(driver)
+        if reason is not None:
+            self.recycle(driver, reason=reason)
+        elif self.is_healthy(driver):
+            self.idle.put(driver)
+        else:
+            self.discard(driver)
+
+    # Renews the shared session with one parked driver and injects it into the others
+    def refresh_session(self):
+        if not self.bot.session.is_expiring():
+            return
+        try:
+            driver = self.idle.get_nowait()
+        except queue.Empty:
+            return
+        self.bot.session.refresh(driver=driver)
+        self.idle.put(driver)
+        for _ in range(self.idle.qsize() - 1):
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.bot.session.inject(driver=driver)
+            self.idle.put(driver)
+
+    # Quits a crashed or degraded driver and launches its replacement
+    def discard(self, driver, reason="crashed or degraded"):
+        self.bot.LOGGER.info(f"Replacing {reason} driver")
+        with self.lock:
+            self.drivers.discard(driver)
+            self.replaced += 1
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        self.replace()
+
+    # Replaces an idle driver grown over the memory or CPU thresholds with a fresh one
+    def recycle(self, driver, reason):
+        with self.lock:
+            self.recycled += 1
+        # The tabs of the browser are recycled in turn as they go idle, the browser quits with the last one
+        if isinstance(driver, BrowserTab):
+            driver.browser.retiring = True
+        self.discard(driver, reason=f"worn ({reason})")
+
+    # Leaves a driver to a human, i.e. on a held cart, and launches its replacement
+    def hand_over(self, driver):
+        with self.lock:
+            self.drivers.discard(driver)
+        self.replace()
+
+    # Health checks the parked drivers and keeps their session fresh in the background
+    def check_idle_drivers(self):
+        while True:
+            sleep(self.health_check_interval)
+            self.refresh_session()
+            idle = []
+            for _ in range(self.idle.qsize()):
+                try:
+                    idle.append(self.idle.get_nowait())
+                except queue.Empty:
+                    break
+            # Only the idle drivers are recycled, the largest first while the browsers are over the host cap
+            over_cap = self.bot.resource_monitor.get_over_cap(idle)
+            for driver in idle:
+                reason = over_cap.get(driver) or self.bot.resource_monitor.should_recycle(driver)
+                if reason is not None:
+                    self.recycle(driver, reason=reason)
+                elif self.is_healthy(driver):
+                    self.idle.put(driver)
+                else:
+                    self.discard(driver)
+
+
+# Samples the memory and CPU of the chromedriver and Chrome processes of every browser, flags the browsers to recycle
+# once idle and keeps the browsers of the host under a soft memory cap. The samples go to a file for capacity planning
+class ResourceMonitor:
+    MB = 1024 * 1024
+
+    def __init__(self, bot, interval=30, max_rss=1024, max_cpu=80, host_cap=8192, file_resources=None):
+        self.bot = bot
+        self.interval = interval
+        # MB of a browser and CPU % averaged over a sample interval above which it gets recycled, None to disable
+        self.max_rss = max_rss
+        self.max_cpu = max_cpu
+        # MB all the browsers of the host should stay under
+        self.host_cap = host_cap
+        self.file_resources = file_resources
+        # psutil keeps the previous CPU times of a process, so the processes are kept across samples
+        self.processes = {}
+        # Last (RSS bytes, CPU %) of every browser driver
+        self.usage = {}
+        # Smallest browser ever sampled, about the size of a freshly launched one
+        self.fresh_rss = None
+        self.lock = threading.Lock()
+        self.last_sample = None
+
+    @classmethod
+    def from_settings(cls, bot, settings, file_resources=None):
+        resources = settings.get("Resources", {})
+        return cls(bot=bot, interval=resources.get("SampleInterval", 30), max_rss=resources.get("RecycleRSS", 1024),
+                   max_cpu=resources.get("RecycleCPU", 80), host_cap=resources.get("HostBrowserMemory", 8192),
+                   file_resources=file_resources)
+
+    # The driver running the browser, shared by all the tabs of a browser
+    @staticmethod
+    def get_browser(driver):
+        return driver.browser.driver if isinstance(driver, BrowserTab) else driver
+
+    # Sums the RSS and CPU % of the process tree of a driver, chromedriver included
+    def sample_driver(self, driver):
+        import psutil
+        try:
+            root = psutil.Process(driver.service.process.pid)
+            pids = [root.pid] + [child.pid for child in root.children(recursive=True)]
+        except (AttributeError, psutil.Error):
+            return None
+        rss, cpu = 0, 0.0
+        for pid in pids:
+            process = self.processes.get(pid)
+            try:
+                if process is None:
+                    process = self.processes[pid] = psutil.Process(pid)
+                with process.oneshot():
+                    rss += process.memory_info().rss
+                    cpu += process.cpu_percent(interval=None)
+            except psutil.Error:
+                self.processes.pop(pid, None)
+        return rss, cpu, len(pids)
+
+    # Samples every browser of the pool with the instances using it
+    def sample(self):
+        import psutil
+        instances = {}
+        if self.bot.watchdog is not None:
+            with self.bot.watchdog.lock:
+                for instance_id, entry in self.bot.watchdog.instances.items():
+                    if entry["driver"] is not None:
+                        instances.setdefault(self.get_browser(entry["driver"]), []).append(instance_id)
+        with self.bot.driver_pool.lock:
+            drivers = list(self.bot.driver_pool.drivers)
+        browsers, usage = [], {}
+        for browser in {self.get_browser(driver) for driver in drivers}:
+            result = self.sample_driver(browser)
+            if result is None:
+                continue
+            rss, cpu, processes = result
+            usage[browser] = (rss, cpu)
+            tabs = sum(1 for driver in drivers if self.get_browser(driver) is browser)
+            browsers.append({"instances": sorted(instances.get(browser, [])), "tabs": tabs, "processes": processes,
+                             "rss_mb": round(rss / self.MB, 1), "cpu": round(cpu, 1)})
+        # Forget the processes which are gone
+        alive = set(psutil.pids())
+        for pid in [pid for pid in self.processes if pid not in alive]:
+            del self.processes[pid]
+        with self.lock:
+            self.usage = usage
+            if usage:
+                self.fresh_rss = min([rss for rss, _ in usage.values()] + ([self.fresh_rss] if self.fresh_rss else []))
+        total_rss = sum(rss for rss, _ in usage.values())
+        self.last_sample = {"time": round(time.time(), 3), "browsers": browsers, "total_rss_mb": round(total_rss / self.MB, 1),
+                            "total_cpu": round(sum(cpu for _, cpu in usage.values()), 1),
+                            "available_mb": round(psutil.virtual_memory().available / self.MB, 1),
+                            "recycled": self.bot.driver_pool.recycled}
+        return self.last_sample
+
+    # Checks if an idle driver crossed the thresholds, a tab of a retiring browser is always recycled
+    def should_recycle(self, driver):
+        """
+        :return: the reason to recycle the driver, None to keep it
+        """
+        if isinstance(driver, BrowserTab) and driver.browser.retiring:
+            return "retiring browser"
+        with self.lock:
+            usage = self.usage.get(self.get_browser(driver))
+        if usage is None:
+            return None
+        rss, cpu = usage
+        if self.max_rss is not None and rss > self.max_rss * self.MB:
+            return f"RSS {rss / self.MB:.0f} MB over {self.max_rss} MB"
+        if self.max_cpu is not None and cpu > self.max_cpu:
+            return f"CPU {cpu:.0f}% over {self.max_cpu}%"
+        return None
+
+    # Picks the largest idle drivers to recycle until the browsers of the host would be back under the cap
+    def get_over_cap(self, idle):
+        """
+        :return: the drivers to recycle with their reason
+        """
+        with self.lock:
+            usage = dict(self.usage)
+            fresh = self.fresh_rss
+        total = sum(rss for rss, _ in usage.values())
+        if self.host_cap is None or total <= self.host_cap * self.MB:
+            return {}
+        over_cap, retired = {}, set()
+        for driver in sorted(idle, key=lambda driver: -usage.get(self.get_browser(driver), (0, 0))[0]):
+            browser = self.get_browser(driver)
+            # The idle tabs of a browser picked already go with it
+            if browser not in retired and total <= self.host_cap * self.MB:
+                continue
+            over_cap[driver] = f"host browsers {total / self.MB:.0f} MB over {self.host_cap} MB"
+            if browser not in retired:
+                retired.add(browser)
+                # A browser not sampled yet is not counted in the total
+                if browser in usage:
+                    total -= usage[browser][0] - fresh
+        if total > self.host_cap * self.MB:
+            self.bot.LOGGER.warning(f"Browsers over the host cap of {self.host_cap} MB with no idle driver left to recycle")
+        return over_cap
+
+    # Samples the browsers every interval seconds, logs the capacity numbers and appends the samples to the file
+    def run(self):
+        while True:
+            sleep(self.interval)
+            sample = self.sample()
+            self.bot.LOGGER.info(f"Resources: {self}")
+            if self.file_resources is not None:
+                with open(self.file_resources, 'a') as f:
+                    f.write(json.dumps(sample) + "\n")
+
+    # Prints the memory and CPU per browser and the browsers the host has room for across all the samples
+    @classmethod
+    def report(cls, file_resources):
+        rss, cpu, totals, room = [], [], [], []
+        with open(file_resources, 'r') as f:
+            for line in f:
+                try:
+                    sample = json.loads(line)
+                except ValueError:
+                    continue
+                for browser in sample["browsers"]:
+                    rss.append(browser["rss_mb"] / max(browser["tabs"], 1))
+                    cpu.append(browser["cpu"] / max(browser["tabs"], 1))
+                totals.append(sample["total_rss_mb"])
+                room.append(sample["available_mb"])
+        if not rss:
+            print(f"No samples found in: {file_resources}")
+            return
+
+        print(f"{'Per order':<16}{'Samples':>8}{'p50':>10}{'p95':>10}{'Max':>10}")
+        print(f"{'RSS MB':<16}{len(rss):>8}{percentile(rss, 50):>10.1f}{percentile(rss, 95):>10.1f}{max(rss):>10.1f}")
+        print(f"{'CPU %':<16}{len(cpu):>8}{percentile(cpu, 50):>10.1f}{percentile(cpu, 95):>10.1f}{max(cpu):>10.1f}")
+        print(f"Peak browsers RSS: {max(totals):.0f} MB | Least available: {min(room):.0f} MB | "
+              f"Orders the host has room for at p95: {int(min(room) / percentile(rss, 95))}")
+
+    def __str__(self):
+        sample = self.last_sample
+        if not sample or not sample["browsers"]:
+            return "No browsers sampled"
+        rss = [browser["rss_mb"] for browser in sample["browsers"]]
+        average = sum(rss) / len(rss)
+        return (f"Browsers: {len(rss)} | RSS: {sample['total_rss_mb']:.0f} MB (avg {average:.0f}, max {max(rss):.0f}) | "
+                f"CPU: {sample['total_cpu']:.0f}% | Available: {sample['available_mb']:.0f} MB | "
+                f"Room for: {int(sample['available_mb'] / average)} browsers | Recycled: {sample['recycled']}")
+
+
+# Shares one authenticated TradeDesk session across all the drivers
+class SessionManager:
+    VERSION = 1
+
+    def __init__(self, bot, email_id, password, refresh_margin=600):
+        self.bot = bot
+        self.email_id = email_id
+        self.password = password
+        # Cookies are refreshed refresh_margin seconds before the first of them expires
+        self.refresh_margin = refresh_margin
+        self.file_session = bot.PROJECT_ROOT / 'BotRes' / f'session_{email_id}.json'
+        self.lock = threading.Lock()
+        self.cookies = None
+        self.logins = 0
+
+    # Loads the cookies saved by a previous session, if any and of the current version
+    def load(self):
+        try:
+            with open(self.file_session, 'r') as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if session.get("version") != self.VERSION or session.get("email") != self.email_id:
+            return None
+        return session.get("cookies") or None
+
+    # Saves the cookies as versioned JSON, replacing the previous file atomically
+    def save(self, cookies):
+        file_tmp = self.file_session.with_suffix('.tmp')
+        with open(file_tmp, 'w') as f:
+            json.dump({"version": self.VERSION, "email": self.email_id, "saved_at": int(time.time()), "cookies": cookies}, f, indent=4)
+        os.replace(file_tmp, self.file_session)
+
+    # Seconds until the first of the session cookies expires, None if there is no expiry
+    def expires_in(self):
+        expiries = [cookie["expiry"] for cookie in self.cookies or [] if "expiry" in cookie]
+        return min(expiries) - time.time() if expiries else None
+
+    # Checks if the session cookies are missing or about to expire
+    def is_expiring(self):
+        if not self.cookies:
+            return True
+        expires_in = self.expires_in()
+        return expires_in is not None and expires_in < self.refresh_margin
+
+    # Cheaply checks that a driver is signed in
+    @staticmethod
+    def is_logged_in(driver):
+        try:
+            return driver.execute_script("return !!document.getElementById('tmp_header_menu_left');")
+        except Exception:
+            return False
+
+    # Injects the session cookies into a driver and validates the session
+    def inject(self, driver, cookies=None):
+        cookies = cookies or self.cookies
+        if not cookies:
+            return False
+        try:
+            driver.get(self.bot.base_url)
+            driver.delete_all_cookies()
+            for cookie in cookies:
+                try:
+                    driver.add_cookie(cookie)
+                except WebDriverException:
+                    pass
+            driver.get(self.bot.base_url)
+            self.bot.wait_until_visible(driver=driver, css_selector='[id="tmp_header_menu_left"]', duration=5)
+            return True
+        except Exception:
+            return False
+
+    # Signs in a driver, doing a real login only when there is no valid session to share
+    def sign_in(self, driver):
+        with self.lock:
+            if self.cookies and not self.is_expiring() and self.inject(driver):
+                return True
+            # Try the session saved by a previous run
+            cookies = self.load()
+            if cookies and self.inject(driver, cookies=cookies):
+                self.bot.LOGGER.info(f"Session restored for: {self.email_id}")
+                self.cookies = cookies
+                if not self.is_expiring():
+                    return True
+            return self.login(driver)
+
+    # Does a real login with the driver and saves its cookies as the shared session
+    def login(self, driver):
+        self.logins += 1
+        if not self.bot.login_trade_desk(driver=driver, email_id=self.email_id, password=self.password):
+            return False
+        self.cookies = driver.get_cookies()
+        try:
+            self.save(self.cookies)
+            self.bot.LOGGER.info(f"Session saved for: {self.email_id}")
+        except OSError as exc:
+            self.bot.LOGGER.warning(f"Error while saving session: {exc}")
+        return True
+
+    # Renews the session with a signed in driver before its cookies expire
+    def refresh(self, driver):
+        with self.lock:
+            if not self.is_expiring():
+                return False
+            self.bot.LOGGER.info(f"Refreshing session for: {self.email_id}")
+            try:
+                driver.get(self.bot.base_url)
+                if self.is_logged_in(driver):
+                    self.cookies = driver.get_cookies()
+                    # The server did not extend the cookies, login again
+                    if self.is_expiring():
+                        return self.login(driver)
+                    self.save(self.cookies)
+                    return True
+            except Exception as exc:
+                self.bot.LOGGER.warning(f"Error while refreshing session: {exc}")
+            return self.login(driver)
+
+
+# Assigns incoming orders to idle instances and tracks the state of every instance
+class OrderScheduler:
+    IDLE = "idle"
+    LOADING = "loading"
+    WATCHING = "watching"
+    CHECKING_OUT = "checking out"
+
+    def __init__(self, number_of_instances, wait_for_ticket, priority="deadline", on_expired=None):
+        # Seconds an order may be queued or watched before it expires
+        self.wait_for_ticket = wait_for_ticket
+        # "deadline" serves the orders expiring first, "price" the orders with the highest priceTo first
+        self.priority = priority
+        # Called with the orders which expired while queued, out of the lock of the queue
+        self.on_expired = on_expired
+        self.states = {instance_id: self.IDLE for instance_id in range(number_of_instances)}
+        # Time every instance entered its state, read by the Watchdog
+        self.since = {instance_id: time.time() for instance_id in range(number_of_instances)}
+        self.orders = []
+        self.sequence = itertools.count()
+        lock = threading.Lock()
+        self.condition = threading.Condition(lock)
+        # Notified when an instance goes idle, waited on by the broker consumer
+        self.idle = threading.Condition(lock)
+        self.assigned = 0
+        self.expired = 0
+
+    # Queues an order, waking up an idle instance if any
+    def submit(self, order):
+        if self.priority == "price":
+            key = -(order.price_to if order.price_to is not None else float("inf"))
+        else:
+            key = order.received_at + self.wait_for_ticket
+        with self.condition:
+            heapq.heappush(self.orders, (key, next(self.sequence), order))
+            self.condition.notify()
+
+    # Blocks an idle instance until an order is assigned to it
+    def next_order(self, instance_id):
+        while True:
+            with self.condition:
+                while not self.orders:
+                    self.condition.wait()
+                order = heapq.heappop(self.orders)[2]
+                # Drop the orders which expired while queued, a requeued order keeps its deadline
+                expired = time.time() - order.received_at > self.wait_for_ticket or self.is_expired(order)
+                if not expired:
+                    return self.assign(order=order, instance_id=instance_id)
+                self.expired += 1
+            # The ledger and the acks of the expired order are written without holding up the other instances
+            if self.on_expired is not None:
+                self.on_expired(order)
+
+    # Assigns an order to an instance, called with the lock held
+    def assign(self, order, instance_id):
+        order.instance_id = instance_id
+        order.deadline = order.deadline or time.time() + self.wait_for_ticket
+        self.states[instance_id] = self.LOADING
+        self.since[instance_id] = time.time()
+        self.assigned += 1
+        return order
+
+    # Updates the state of the instance an order is assigned to
+    def set_state(self, order, state):
+        if order.instance_id is not None:
+            with self.condition:
+                self.states[order.instance_id] = state
+                self.since[order.instance_id] = time.time()
+                if state == self.IDLE:
+                    self.idle.notify_all()
+
+    # Checks if the order ran out of its WaitForTicket time, so its instance can be reclaimed
+    @staticmethod
+    def is_expired(order):
+        return order.deadline is not None and time.time() > order.deadline
+
+    # Returns the instance of a finished order to the idle instances
+    def finish(self, order):
+        self.set_state(order, self.IDLE)
+
+    # Returns an instance to the idle instances once its order was requeued to another instance
+    def release(self, instance_id):
+        with self.condition:
+            self.states[instance_id] = self.IDLE
+            self.since[instance_id] = time.time()
+            self.idle.notify_all()
+
+    # Counts the idle instances no queued order is waiting for, the orders a worker can take
+    def capacity(self):
+        with self.condition:
+            return list(self.states.values()).count(self.IDLE) - len(self.orders)
+
+    # Blocks until an instance is free to take an order or the timeout expires
+    def wait_capacity(self, timeout=None):
+        """
+        :return: the capacity, 0 or less on timeout
+        """
+        with self.idle:
+            self.idle.wait_for(lambda: list(self.states.values()).count(self.IDLE) > len(self.orders), timeout=timeout)
+            return list(self.states.values()).count(self.IDLE) - len(self.orders)
+
+    def __str__(self):
+        with self.condition:
+            states = [state for state in self.states.values()]
+            queued = len(self.orders)
+        counts = " | ".join(f"{state.title()}: {states.count(state)}" for state in (self.IDLE, self.LOADING, self.WATCHING, self.CHECKING_OUT))
+        return f"{counts} | Queued: {queued} | Assigned: {self.assigned} | Expired: {self.expired}"
+
+
+# Tracks the heartbeat of every instance and the time it spends in its stage. The driver of an instance stuck in a call
+# or a stage is killed so the call returns, the instance then requeues its order and the pool respawns a signed in driver
+class Watchdog:
+    def __init__(self, bot, heartbeat_timeout=90, stage_timeouts=None, grace=30, check_interval=5, max_requeues=2):
+        self.bot = bot
+        # Seconds an instance may go without a heartbeat, longer than the longest wait of a checkout stage
+        self.heartbeat_timeout = heartbeat_timeout
+        # Seconds an instance may stay in a stage, a watcher is stuck once its order is overdue by grace seconds
+        self.stage_timeouts = stage_timeouts or {}
+        self.grace = grace
+        self.check_interval = check_interval
+        # Times an order is requeued before it fails, i.e. on a bug failing every run of the order
+        self.max_requeues = max_requeues
+        self.instances = {}
+        self.lock = threading.Lock()
+        self.recoveries = 0
+        # Seconds from the last heartbeat of a failed instance until its order ran again on a fresh driver
+        self.recovery_times = []
+
+    @classmethod
+    def from_settings(cls, bot, settings):
+        watchdog = settings.get("Watchdog", {})
+        # The checkout stages of one ticket run back to back in the checking out state
+        deadlines = dict(CheckoutFlow.DEADLINES, **settings.get("CheckoutDeadlines", {}))
+        grace = watchdog.get("Grace", 30)
+        return cls(bot=bot, heartbeat_timeout=watchdog.get("HeartbeatTimeout", 90), grace=grace,
+                   stage_timeouts={OrderScheduler.LOADING: watchdog.get("LoadingTimeout", 60),
+                                   OrderScheduler.CHECKING_OUT: sum(deadlines.values()) + grace},
+                   check_interval=watchdog.get("CheckInterval", 5), max_requeues=watchdog.get("MaxRequeues", 2))
+
+    # Starts watching an instance working on an order, with the driver it holds if any
+    def start(self, instance_id, order, driver=None):
+        """
+        :return: event set once the order was taken away from the instance, checked by the HTTP poll loop
+        """
+        now = time.time()
+        with self.lock:
+            self.instances[instance_id] = {"order": order, "driver": driver, "started": now, "beat": now, "stuck": False,
+                                           "stop": threading.Event()}
+            if order.failed_at is not None:
+                self.recovery_times.append(now - order.failed_at)
+                order.failed_at = None
+            return self.instances[instance_id]["stop"]
+
+    # Swaps the driver an instance holds, i.e. the fast path only holds one to checkout
+    def attach(self, order, driver):
+        with self.lock:
+            if order.instance_id in self.instances:
+                self.instances[order.instance_id]["driver"] = driver
+
+    # Records that the instance of an order is alive and making progress
+    def beat(self, order):
+        entry = self.instances.get(order.instance_id)
+        if entry is not None:
+            entry["beat"] = time.time()
+
+    def stop(self, instance_id):
+        with self.lock:
+            self.instances.pop(instance_id, None)
+
+    # Flags an order to be requeued, once per failure
+    def fail(self, order, failed_at=None):
+        with self.lock:
+            if order.failed_at is not None:
+                return
+            order.failed_at = failed_at or time.time()
+            self.recoveries += 1
+
+    # Checks if an instance missed its heartbeat or overran its stage
+    def is_stuck(self, instance_id, entry, now):
+        """
+        :return: the reason the instance is stuck, None if it is not
+        """
+        if now - entry["beat"] > self.heartbeat_timeout:
+            return f"no heartbeat for {now - entry['beat']:.0f}s"
+        state = self.bot.scheduler.states.get(instance_id)
+        order = entry["order"]
+        if state == OrderScheduler.WATCHING:
+            if order.deadline is not None and now > order.deadline + self.grace:
+                return f"watching {now - order.deadline:.0f}s past the deadline"
+            return None
+        # The time waited for a driver does not count
+        elapsed = now - max(self.bot.scheduler.since.get(instance_id, now), entry["started"])
+        if elapsed > self.stage_timeouts.get(state, float("inf")):
+            return f"{state} for {elapsed:.0f}s"
+        return None
+
+    # Recovers the stuck instances every check_interval seconds
+    def run(self):
+        while True:
+            sleep(self.check_interval)
+            self.check()
+
+    def check(self):
+        now = time.time()
+        with self.lock:
+            stuck = []
+            for instance_id, entry in self.instances.items():
+                reason = None if entry["stuck"] else self.is_stuck(instance_id, entry, now)
+                if reason is not None:
+                    entry["stuck"] = True
+                    stuck.append((instance_id, entry, reason))
+        for instance_id, entry, reason in stuck:
+            self.recover(instance_id=instance_id, entry=entry, reason=reason)
+
+    # Kills the driver of a stuck instance, its blocked call fails and the instance requeues its order
+    def recover(self, instance_id, entry, reason):
+        driver = entry["driver"]
+        self.bot.LOGGER.warning(f"Instance {instance_id} stuck: {reason}, {entry['order'].event_url}")
+        self.fail(entry["order"], failed_at=entry["beat"])
+        if driver is None:
+            # A hung HTTP poll can't be killed, its instance drops the order once the call returns and the order
+            # is requeued right away to another instance
+            entry["stop"].set()
+            self.bot.end_order(order=entry["order"], outcome="error")
+            return
+        # The other tabs of the browser go down with it, their orders are requeued too
+        if isinstance(driver, BrowserTab):
+            with self.lock:
+                tabs = [other for other in self.instances.values() if other is not entry and isinstance(other["driver"], BrowserTab)
+                        and other["driver"].browser is driver.browser]
+                for other in tabs:
+                    other["stuck"] = True
+            for other in tabs:
+                self.fail(other["order"])
+        self.kill_driver(driver)
+        self.bot.driver_pool.discard(driver)
+
+    # Kills chromedriver and its browser, a hung driver would not answer quit
+    @staticmethod
+    def kill_driver(driver):
+        import psutil
+        if isinstance(driver, BrowserTab):
+            driver.browser.alive = False
+            driver = driver.browser.driver
+        try:
+            process = psutil.Process(driver.service.process.pid)
+            processes = process.children(recursive=True) + [process]
+        except (AttributeError, psutil.Error):
+            return
+        for process in processes:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+
+    def __str__(self):
+        with self.lock:
+            mttr = sum(self.recovery_times) / len(self.recovery_times) if self.recovery_times else 0
+            return f"Recoveries: {self.recoveries} | Recovered: {len(self.recovery_times)} | MTTR: {mttr:.1f}s"
+
+
+# Checkout of a matched ticket as a state machine, every stage moves on as soon as its
+# DOM condition shows up or fails when its own deadline from Settings expires
+class CheckoutFlow:
+    BUY = "buy"
+    CHECKOUT = "checkout"
+    CART = "cart"
+    PRICE_VERIFY = "price verify"
+    PAYMENT_READY = "payment ready"
+    PROCEED = "proceed"
+    CONFIRMED = "confirmed"
+    HELD = "held"
+    # Proceed was clicked but the confirmation page did not show up, the payment may have gone through
+    UNCONFIRMED = "unconfirmed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    # Outcomes which end the order, no other ticket is tried after them
+    ENDED = (CONFIRMED, HELD, UNCONFIRMED)
+    # Seconds each stage may take, overridden by CheckoutDeadlines in Settings
+    DEADLINES = {BUY: 5, CHECKOUT: 10, CART: 15, PRICE_VERIFY: 5, PAYMENT_READY: 20, PROCEED: 60, CANCELLED: 20}
+
+    def __init__(self, bot, driver, order, ticket_dict, deadlines=None, warm_standby=False, confirmation=None):
+        self.bot = bot
+        self.driver = driver
+        # Waits and clicks in the page, a tab would hold its shared browser for the whole wait
+        self.warm_standby = warm_standby and not isinstance(driver, BrowserTab)
+        self.order = order
+        self.ticket_dict = ticket_dict
+        self.ticket_id = ticket_dict["ID"]
+        self.deadlines = dict(self.DEADLINES, **(deadlines or {}))
+        # URL and selector of the confirmation page, any other page after proceed is pending until the deadline
+        confirmation = confirmation or {}
+        self.confirmation_url = confirmation.get("URL")
+        self.confirmation_selector = confirmation.get("Selector")
+        self.state = self.BUY
+        self.price = None
+        # Seconds spent in every stage
+        self.timings = {}
+        self.stages = {self.BUY: self.buy, self.CHECKOUT: self.checkout, self.CART: self.cart,
+                       self.PRICE_VERIFY: self.price_verify, self.PAYMENT_READY: self.payment_ready,
+                       self.PROCEED: self.proceed}
+
+    # Runs the stages until the checkout is confirmed, held, failed or cancelled
+    def run(self):
+        try:
+            self.run_stages()
+        finally:
+            # The other watchers of the order may take the cart again unless it was bought
+            self.order.race.release(self.order, self.state)
+        return self.state
+
+    def run_stages(self):
+        while self.state in self.stages:
+            state, start = self.state, time.time()
+            self.bot.watchdog.beat(self.order)
+            try:
+                self.state = self.stages[state]()
+                self.order.mark(state, ticket_id=self.ticket_id)
+            except TimeoutException:
+                self.bot.LOGGER.warning(f"Checkout timed out at stage: {state}, ticket: {self.ticket_id}")
+                self.state = self.FAILED
+            except WebDriverException as exc:
+                self.bot.LOGGER.warning(f"Error at checkout stage: {state}, ticket: {self.ticket_id}, {exc.msg}")
+                self.state = self.FAILED
+            self.timings[state] = round(time.time() - start, 3)
+        self.bot.LOGGER.info(f"Checkout {self.state}: {self.ticket_id} | {self.timings}")
+        self.order.mark(self.state, ticket_id=self.ticket_id)
+
+    # Waits until the condition returns a truthy value or the deadline of the stage expires
+    def wait(self, stage, condition):
+        from selenium.webdriver.support.wait import WebDriverWait
+        return WebDriverWait(self.driver, self.deadlines[stage], 0.01).until(condition)
+
+    # Waits for a visible element and returns it
+    def wait_visible(self, stage, css_selector):
+        return self.wait(stage, EC.visibility_of_element_located((By.CSS_SELECTOR, css_selector)))
+
+    # Waits in the page for a visible element and clicks it in the same round trip
+    def click_when_visible(self, stage, css_selector):
+        self.driver.set_script_timeout(self.deadlines[stage] + 5)
+        if not self.driver.execute_async_script(JS_CLICK_WHEN_VISIBLE, css_selector, int(self.deadlines[stage] * 1000)):
+            raise TimeoutException(f"Element not visible: {css_selector}")
+
+    # Clicks the buy button of the ticket row
+    def buy(self):
+        if self.warm_standby:
+            self.click_when_visible(self.BUY, f'tr[id="ticket_{self.ticket_id}"] [class="button special no__border to__cart clickable"]')
+            return self.CHECKOUT
+        ticket = self.wait(self.BUY, EC.presence_of_element_located((By.CSS_SELECTOR, f'tr[id="ticket_{self.ticket_id}"]')))
+        self.driver.execute_script("arguments[0].scrollIntoView();", ticket)
+        ticket.find_element(By.CSS_SELECTOR, '[class="button special no__border to__cart clickable"]').click()
+        return self.CHECKOUT
+
+    # Clicks the checkout button as soon as it shows up
+    def checkout(self):
+        if self.warm_standby:
+            self.click_when_visible(self.CHECKOUT, '[class="button positive purchase_send_checkout"]')
+            return self.CART
+        self.wait_visible(self.CHECKOUT, '[class="button positive purchase_send_checkout"]').click()
+        return self.CART
+
+    # Waits for the cart page, the first watcher of the order to get there checks it out
+    def cart(self):
+        self.wait_visible(self.CART, '[id="purchase"]')
+        if not self.order.race.checkout(self.order):
+            self.bot.LOGGER.info(f"Another watcher holds the cart of the order, cancelling order of the ticket: {self.ticket_id}")
+            return self.cancel()
+        return self.PRICE_VERIFY
+
+    # Verifies the price in the cart page, cancels the order if it is out of the price window
+    def price_verify(self):
+        price = self.wait_visible(self.PRICE_VERIFY, '[dataformat="price"]')
+        self.price = self.bot.parse_price(price.text)
+        # Scroll to the end of the cart page
+        self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        if not self.order.match(dict(self.ticket_dict, Price=self.price)):
+            self.bot.LOGGER.info(f"Cart price {self.price} is out of range, cancelling order of the ticket: {self.ticket_id}")
+            return self.cancel()
+        return self.PAYMENT_READY
+
+    # Cancels the order and waits until the cart is gone
+    def cancel(self):
+        cancel_order_btn = self.wait_visible(self.CANCELLED, '[id="cancel"]')
+        self.driver.execute_script("arguments[0].click();", cancel_order_btn)
+        # Click Yes to confirm cancellation of the order
+        cancel_order_btn = self.wait_visible(self.CANCELLED, '[class="action yes"]')
+        self.driver.execute_script("arguments[0].click();", cancel_order_btn)
+        self.wait(self.CANCELLED, EC.staleness_of(cancel_order_btn))
+        return self.CANCELLED
+
+    # Waits for the "Paying with card" to be visible on the cart page
+    def payment_ready(self):
+        self.wait_visible(self.PAYMENT_READY, '[class="braintree-methods braintree-methods-initial"]')
+        # The first cart page tells the warm standby which assets to preload
+        if self.warm_standby and not self.bot.cart_assets_learned:
+            self.bot.learn_assets(driver=self.driver)
+        if not self.order.auto_checkout:
+            self.bot.LOGGER.info(f"Autocheckout is off, cart of the ticket held for a manual checkout: {self.ticket_id}")
+            return self.HELD
+        return self.PROCEED
+
+    # Completes the transaction and waits for its result
+    def proceed(self):
+        proceed_btn = self.wait_visible(self.PROCEED, '[id="proceed"]')
+        self.driver.execute_script("arguments[0].click();", proceed_btn)
+        # From here on the payment may have gone through, no other ticket is tried for the order
+        try:
+            result = self.wait(self.PROCEED, lambda driver: driver.execute_script(JS_CHECKOUT_RESULT, self.confirmation_url,
+                                                                                  self.confirmation_selector))
+        except WebDriverException as exc:
+            self.bot.LOGGER.error(f"Checkout unconfirmed after proceed, check the account manually: {self.order.event_url}, "
+                                  f"ticket: {self.ticket_id}, {exc.msg}")
+            return self.UNCONFIRMED
+        return self.CONFIRMED if result == "confirmed" else self.FAILED
+
+
+# Minimal Chrome DevTools protocol client of one page target over its websocket
+class CDPSession:
+    # Events a navigation waits for, per page load strategy
+    LOAD_EVENTS = {"normal": "Page.loadEventFired", "eager": "Page.domContentEventFired", "none": "Page.frameNavigated"}
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.load_event = self.LOAD_EVENTS["normal"]
+        self.ids = itertools.count(1)
+        self.results = {}
+        self.events = {}
+        self.reader = asyncio.ensure_future(self.read())
+
+    @classmethod
+    async def connect(cls, ws_url):
+        # Optional dependency of the asyncio engine only
+        import websockets
+        return cls(await websockets.connect(ws_url, max_size=None))
+
+    # Dispatches the command results and the awaited events
+    async def read(self):
+        try:
+            async for raw in self.websocket:
+                message = json.loads(raw)
+                if "id" in message:
+                    future = self.results.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        if "error" in message:
+                            future.set_exception(RuntimeError(f"{message['error'].get('message')}"))
+                        else:
+                            future.set_result(message.get("result", {}))
+                else:
+                    for future in self.events.pop(message.get("method"), []):
+                        if not future.done():
+                            future.set_result(message.get("params", {}))
+        finally:
+            for future in self.results.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("DevTools connection closed"))
+
+    async def send(self, method, **params):
+        command_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.results[command_id] = future
+        await self.websocket.send(json.dumps({"id": command_id, "method": method, "params": params}))
+        return await future
+
+    # Returns a future of the next event with the method name, register before triggering it
+    def expect(self, method):
+        future = asyncio.get_running_loop().create_future()
+        self.events.setdefault(method, []).append(future)
+        return future
+
+    # Runs a script written for execute_script, or for execute_async_script when is_async
+    async def execute(self, script, *args, is_async=False):
+        args_json = json.dumps(list(args))
+        if is_async:
+            expression = f"new Promise(function (resolve) {{ (function () {{\n{script}\n}}).apply(null, {args_json}.concat([resolve])); }})"
+        else:
+            expression = f"(function () {{\n{script}\n}}).apply(null, {args_json})"
+        result = await self.send("Runtime.evaluate", expression=expression, returnByValue=True, awaitPromise=True)
+        if "exceptionDetails" in result:
+            raise RuntimeError(result["exceptionDetails"].get("text", "Script error"))
+        return result.get("result", {}).get("value")
+
+    # Navigates and waits for the load event of the page load strategy
+    async def navigate(self, url, timeout=30):
+        loaded = self.expect(self.load_event)
+        await self.send("Page.navigate", url=url)
+        await asyncio.wait_for(loaded, timeout)
+
+    # Waits until a script condition returns a truthy value
+    async def wait_for(self, script, timeout, *args):
+        deadline = time.time() + timeout
+        while True:
+            value = await self.execute(script, *args)
+            if value:
+                return value
+            if time.time() > deadline:
+                raise asyncio.TimeoutError(script)
+            await asyncio.sleep(0.01)
+
+    # Waits until an element is visible
+    async def wait_visible(self, css_selector, timeout):
+        return await self.wait_for("var el = document.querySelector(arguments[0]); return !!(el && el.offsetParent !== null);",
+                                   timeout, css_selector)
+
+    # Clicks an element from inside the page
+    async def click(self, css_selector):
+        return await self.execute("var el = document.querySelector(arguments[0]); if (el) { el.click(); } return !!el;", css_selector)
+
+    async def close(self):
+        self.reader.cancel()
+        await self.websocket.close()
+
+
+# Chrome process driven directly over the DevTools protocol, one page target per order
+class CDPBrowser:
+    def __init__(self, binary=None, headless=True):
+        self.binary = binary or next((shutil.which(name) for name in ("google-chrome", "chrome", "chromium", "chromium-browser")
+                                      if shutil.which(name)), None)
+        self.headless = headless
+        self.process = None
+        self.user_data_dir = None
+        self.port = None
+        # Order pages open in this browser
+        self.pages = 0
+
+    async def start(self, timeout=30):
+        if self.binary is None:
+            raise RuntimeError("Chrome binary not found, set ChromeBinary in Settings")
+        self.user_data_dir = tempfile.mkdtemp(prefix="TradeDeskBot_")
+        command = [self.binary, "--remote-debugging-port=0", f"--user-data-dir={self.user_data_dir}", "--no-first-run",
+                   "--no-default-browser-check", "--disable-extensions", "--disable-notifications",
+                   "--disable-background-timer-throttling", "--disable-backgrounding-occluded-windows",
+                   "--disable-renderer-backgrounding", "about:blank"]
+        if self.headless:
+            command.append("--headless=new")
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Chrome writes the port it picked to DevToolsActivePort
+        file_port = Path(self.user_data_dir) / "DevToolsActivePort"
+        deadline = time.time() + timeout
+        while not file_port.is_file() or not file_port.read_text().strip():
+            if time.time() > deadline:
+                raise RuntimeError("Chrome did not open its DevTools port")
+            await asyncio.sleep(0.05)
+        self.port = int(file_port.read_text().split()[0])
+
+    # Calls the DevTools HTTP endpoint without blocking the event loop
+    async def http(self, path, method="GET"):
+        import urllib.request
+        request = urllib.request.Request(f"http://127.0.0.1:{self.port}{path}", method=method)
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, lambda: urllib.request.urlopen(request, timeout=10).read())
+        return json.loads(response) if response.strip().startswith(b"{") else None
+
+    # Opens a page target and connects to it
+    async def new_page(self):
+        target = await self.http("/json/new?about:blank", method="PUT")
+        page = await CDPSession.connect(target["webSocketDebuggerUrl"])
+        page.target_id = target["id"]
+        await page.send("Page.enable")
+        return page
+
+    async def close_page(self, page):
+        await page.close()
+        await self.http(f"/json/close/{page.target_id}")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+        if self.user_data_dir is not None:
+            shutil.rmtree(self.user_data_dir, ignore_errors=True)
+
+
+# Optional asyncio engine running the listener, the inventory watchers and the checkouts as coroutines
+# of one event loop, driving Chrome over the DevTools protocol instead of chromedriver
+class AsyncEngine:
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = bot.settings["Settings"]
+        # Orders watched in the pages of one browser before another browser is launched
+        self.tabs_per_browser = self.settings.get("TabsPerBrowser", 1)
+        self.browsers = []
+        self.browsers_lock = asyncio.Lock()
+        self.orders = None
+        self.slots = asyncio.Semaphore(self.settings.get("AsyncMaxOrders", 20))
+        # The event loop only keeps weak references to its tasks
+        self.tasks = set()
+
+    # Receives the EventURLs on the event loop, same interface as the EventURLDispatcher, recorded in the ledger by run
+    def put(self, event_url, trace=None, instances=1):
+        self.orders.put_nowait((event_url, trace, instances, True))
+
+    # Runs the sqlite ledger calls in a thread, off the event loop
+    async def run_ledger(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+    # Starts a watcher as a task of its own
+    def start_watcher(self, order):
+        task = asyncio.ensure_future(self.get_ticket(order))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, ready=None):
+        """
+        :param ready: future of the startup checks, the orders wait for it while the browser warms up
+        """
+        self.orders = asyncio.Queue()
+        try:
+            # Warm up the first browser before any EventURL arrives
+            await self.launch_browser()
+            if self.bot.ledger is not None:
+                for event_url in await self.run_ledger(self.bot.ledger.recover, max_age=self.settings["WaitForTicket"] * 60,
+                                                       is_running=self.bot.is_process_running):
+                    self.orders.put_nowait((event_url, None, 1, False))
+            await self.start_listener()
+            if ready is not None and not await asyncio.get_running_loop().run_in_executor(None, ready.result):
+                return
+            while True:
+                event_url, trace, instances, record = await self.orders.get()
+                if record and self.bot.ledger is not None and not await self.run_ledger(self.bot.ledger.record, event_url):
+                    continue
+                self.bot.LOGGER.info(f"EvenURL Received: {event_url}")
+                try:
+                    order = EventOrder(event_url=event_url)
+                except ValueError as exc:
+                    self.bot.LOGGER.warning(f"Error while parsing event URL: {exc}")
+                    continue
+                order.trace = trace
+                order.mark("queue pickup")
+                for watcher in order.fan_out(min(instances, self.settings.get("AsyncMaxOrders", 20))):
+                    self.start_watcher(watcher)
+        finally:
+            for browser in self.browsers:
+                browser.stop()
+
+    # Subscribes with the asyncio PubNub client so the messages arrive on the event loop
+    async def start_listener(self):
+        from pubnub.pubnub_asyncio import PubNubAsyncio
+        channel_machine = self.bot.get_channel()
+        self.bot.LOGGER.info(f'Starting PubNub Listener for: {channel_machine}')
+        pubnub_asyncio = PubNubAsyncio(self.bot.get_pnconfig())
+        pubnub_asyncio.add_listener(EventURLHandler(dispatcher=self, tracer=self.bot.tracer))
+        pubnub_asyncio.subscribe().channels(channel_machine).execute()
+
+    async def launch_browser(self):
+        browser = CDPBrowser(binary=self.settings.get("ChromeBinary"), headless=self.settings.get("Headless", True))
+        self.browsers.append(browser)
+        await browser.start()
+        await self.sign_in(browser)
+        return browser
+
+    # Opens the page of an order in a browser with room left, launching a new browser when all are full
+    async def new_page(self):
+        async with self.browsers_lock:
+            # Drop the browsers which crashed
+            for browser in [browser for browser in self.browsers if browser.process.poll() is not None]:
+                browser.stop()
+                self.browsers.remove(browser)
+            browser = next((browser for browser in self.browsers if browser.pages < self.tabs_per_browser), None)
+            if browser is None:
+                browser = await self.launch_browser()
+            browser.pages += 1
+        page = await browser.new_page()
+        page.browser = browser
+        page.load_event = page.LOAD_EVENTS.get(self.settings.get("PageLoadStrategy", "normal"), page.load_event)
+        if self.bot.resource_policy is not None:
+            await page.send("Network.enable")
+            await page.send("Network.setBlockedURLs", urls=self.bot.resource_policy.get_blocked_patterns(self.bot.base_url))
+        return page
+
+    async def close_page(self, page):
+        import websockets
+        page.browser.pages -= 1
+        try:
+            await page.browser.close_page(page)
+        except (OSError, websockets.ConnectionClosed):
+            # The browser is gone with its pages
+            pass
+
+    # Injects the shared session cookies, signing in once in a page if there is no valid session
+    async def sign_in(self, browser):
+        session = self.bot.session
+        page = await browser.new_page()
+        try:
+            cookies = session.cookies or session.load()
+            if cookies:
+                await page.send("Network.setCookies", cookies=[
+                    {key: value for key, value in dict(cookie, url=self.bot.base_url, expires=cookie.get("expiry")).items()
+                     if key in ("name", "value", "url", "domain", "path", "secure", "httpOnly", "expires") and value is not None}
+                    for cookie in cookies])
+            await page.navigate(self.bot.base_url)
+            if await page.execute("return !!document.getElementById('tmp_header_menu_left');"):
+                session.cookies = cookies
+                return
+            self.bot.LOGGER.info(f"Signing in using email id")
+            await page.wait_visible('[name="username"]', timeout=30)
+            await page.execute(JS_FILL_FILTERS, {"username": session.email_id, "password": session.password})
+            await page.click('[class="header_signup"]')
+            await asyncio.sleep(1)
+            await page.navigate(self.bot.base_url)
+            await page.wait_visible('[id="tmp_header_menu_left"]', timeout=30)
+            cookies = (await page.send("Network.getAllCookies"))["cookies"]
+            session.cookies = [dict(cookie, expiry=int(cookie["expires"])) if cookie.get("expires", -1) > 0 else cookie
+                               for cookie in cookies]
+            session.save(session.cookies)
+            self.bot.LOGGER.info(f"Email login successful")
+        finally:
+            await browser.close_page(page)
+
+    # Claims an order in the ledger, watches it and records its outcome
+    async def get_ticket(self, order):
+        LOG_CONTEXT.set({"order": order.event_id})
+        ledger = self.bot.ledger
+        if ledger is not None and not await self.run_ledger(
+                order.race.claim, lambda: ledger.claim(order.url_hash, worker=OrderLedger.get_worker("async"))):
+            return
+        try:
+            await self.watch_order(order)
+        finally:
+            # A watcher whose page went down starts over in a new page until its order expires
+            if (order.failed_at is not None and order.outcome not in CheckoutFlow.ENDED and not OrderScheduler.is_expired(order)
+                    and order.requeues < (self.settings.get("Watchdog") or {}).get("MaxRequeues", 2)):
+                self.bot.LOGGER.warning(f"Watcher {order.replica} requeued: {order.event_url}")
+                order.failed_at = None
+                order.requeues += 1
+                self.start_watcher(order)
+            else:
+                outcome = order.race.finish(order, order.outcome if order.outcome in CheckoutFlow.ENDED else "expired")
+                if ledger is not None and outcome is not None:
+                    await self.run_ledger(ledger.finish, order.url_hash, outcome)
+
+    # Same flow as get_ticket/checkout_ticket on a page of its own
+    async def watch_order(self, order):
+        import websockets
+        async with self.slots:
+            self.bot.LOGGER.info(f"Checking out tickets from event: {order.event_url}")
+            # A requeued watcher keeps the deadline of its first run
+            order.deadline = order.deadline or time.time() + self.settings["WaitForTicket"] * 60
+            page = None
+            try:
+                page = await self.new_page()
+                await page.navigate(order.event_url)
+                order.mark("page load")
+                await page.wait_visible('[class*="filter_tm"]', timeout=30)
+                await page.click('[class*="filter_tm"]')
+                await page.execute(JS_FILL_FILTERS, order.get_filters())
+                order.mark("filters")
+                watch_timeout = self.settings.get("WatchTimeout", 10)
+                refresh = RefreshScheduler.from_settings(order=order, settings=self.settings)
+                # The watchers of an order refresh in turns
+                await asyncio.sleep(order.get_phase(refresh.interval))
+                next_refresh = time.time() + refresh.next_delay()
+                await page.execute(JS_WATCH_INSTALL)
+                inventory = InventoryTracker()
+                new_tickets = inventory.update(self.bot.to_ticket_dicts(await page.execute(JS_TICKET_ROWS) or []))
+                while time.time() < order.deadline:
+                    if order.race.is_lost(order):
+                        self.bot.LOGGER.info(f"Another instance is checking out the order, watcher {order.replica} stopped")
+                        return
+                    # The cheapest matched ticket is tried first, the next one if its checkout fails
+                    for ticket_dict in order.rank(new_tickets):
+                        if order.race.is_lost(order):
+                            break
+                        order.mark("match", ticket_id=ticket_dict["ID"])
+                        self.bot.LOGGER.info(f"Ticket: {ticket_dict['ID']} | {ticket_dict} | Ticket matched: True", extra={"ticket_id": ticket_dict["ID"]})
+                        with log_context(ticket_id=ticket_dict["ID"]):
+                            order.outcome = await self.checkout(page, order, ticket_dict)
+                        if order.outcome in CheckoutFlow.ENDED:
+                            return
+                        # Back to the event page to watch for the next ticket
+                        await page.navigate(order.event_url)
+                        await page.wait_visible('[class*="filter_tm"]', timeout=30)
+                        await page.click('[class*="filter_tm"]')
+                        await page.execute(JS_WATCH_INSTALL)
+                    changes = await page.execute(JS_WATCH_DRAIN, int(min(watch_timeout, max(next_refresh - time.time(), 0.05),
+                                                                         max(order.deadline - time.time(), 0.1)) * 1000), is_async=True)
+                    if changes is None:
+                        await page.execute(JS_WATCH_INSTALL)
+                        new_tickets = inventory.update(self.bot.to_ticket_dicts(await page.execute(JS_TICKET_ROWS) or []))
+                    elif changes[0] or changes[1]:
+                        new_tickets = inventory.merge(self.bot.to_ticket_dicts(changes[0]), removed_ids=changes[1])
+                        next_refresh = time.time() + refresh.next_delay(changed=True)
+                    else:
+                        new_tickets = []
+                        # Refresh once the next refresh is due and the RequestBudget allows it
+                        if time.time() >= next_refresh:
+                            await self.bot.request_budget.acquire_async(hot=refresh.is_hot())
+                            await page.execute(JS_REFRESH_INVENTORY, order.get_filters())
+                            next_refresh = time.time() + refresh.next_delay()
+                self.bot.LOGGER.info(f"Timeout while waiting for the ticket !")
+            except (asyncio.TimeoutError, RuntimeError) as exc:
+                self.bot.LOGGER.warning(f"Error while checking out tickets from event: {order.event_url}, {exc!r}")
+            except (OSError, websockets.ConnectionClosed) as exc:
+                # The page or its browser went down, the watcher starts over
+                self.bot.LOGGER.warning(f"Page lost while checking out tickets from event: {order.event_url}, {exc!r}")
+                order.failed_at = time.time()
+            finally:
+                # The held cart stays open for a human
+                if page is not None and order.outcome != CheckoutFlow.HELD:
+                    await self.close_page(page)
+
+    # Same stages as CheckoutFlow, each waiting for its DOM condition up to its deadline
+    async def checkout(self, page, order, ticket_dict):
+        result = CheckoutFlow.FAILED
+        try:
+            result = await self.run_checkout(page, order, ticket_dict)
+        finally:
+            # The other watchers of the order may take the cart again unless it was bought
+            order.race.release(order, result)
+        return result
+
+    async def run_checkout(self, page, order, ticket_dict):
+        import websockets
+        deadlines = dict(CheckoutFlow.DEADLINES, **(self.settings.get("CheckoutDeadlines") or {}))
+        ticket_id = ticket_dict["ID"]
+        state = CheckoutFlow.BUY
+        try:
+            await page.wait_for("return !!document.querySelector(arguments[0]);", deadlines[state],
+                                f'tr[id="ticket_{ticket_id}"] [class="button special no__border to__cart clickable"]')
+            await page.click(f'tr[id="ticket_{ticket_id}"] [class="button special no__border to__cart clickable"]')
+            order.mark(state, ticket_id=ticket_id)
+            state = CheckoutFlow.CHECKOUT
+            await page.wait_visible('[class="button positive purchase_send_checkout"]', deadlines[state])
+            cart_loaded = page.expect(page.load_event)
+            await page.click('[class="button positive purchase_send_checkout"]')
+            order.mark(state, ticket_id=ticket_id)
+            state = CheckoutFlow.CART
+            await asyncio.wait_for(cart_loaded, deadlines[state])
+            await page.wait_visible('[id="purchase"]', deadlines[state])
+            order.mark(state, ticket_id=ticket_id)
+            # The first watcher of the order to get to the cart checks it out
+            if not order.race.checkout(order):
+                self.bot.LOGGER.info(f"Another watcher holds the cart of the order, cancelling order of the ticket: {ticket_id}")
+                state = CheckoutFlow.CANCELLED
+                await self.cancel(page, order, ticket_id, deadlines[state])
+                return CheckoutFlow.CANCELLED
+            state = CheckoutFlow.PRICE_VERIFY
+            await page.wait_visible('[dataformat="price"]', deadlines[state])
+            price = self.bot.parse_price(await page.execute("return document.querySelector('[dataformat=\"price\"]').textContent;"))
+            order.mark(state, ticket_id=ticket_id)
+            if not order.match(dict(ticket_dict, Price=price)):
+                self.bot.LOGGER.info(f"Cart price {price} is out of range, cancelling order of the ticket: {ticket_id}")
+                state = CheckoutFlow.CANCELLED
+                await self.cancel(page, order, ticket_id, deadlines[state])
+                return CheckoutFlow.CANCELLED
+            state = CheckoutFlow.PAYMENT_READY
+            await page.wait_visible('[class="braintree-methods braintree-methods-initial"]', deadlines[state])
+            order.mark(state, ticket_id=ticket_id)
+            if not order.auto_checkout:
+                self.bot.LOGGER.info(f"Autocheckout is off, cart of the ticket held for a manual checkout: {ticket_id}")
+                order.mark(CheckoutFlow.HELD, ticket_id=ticket_id)
+                return CheckoutFlow.HELD
+            state = CheckoutFlow.PROCEED
+            await page.wait_visible('[id="proceed"]', deadlines[state])
+            await page.click('[id="proceed"]')
+            # From here on the payment may have gone through, no other ticket is tried for the order
+            confirmation = self.settings.get("Confirmation") or {}
+            try:
+                result = await page.wait_for(JS_CHECKOUT_RESULT, deadlines[state], confirmation.get("URL"), confirmation.get("Selector"))
+            except (asyncio.TimeoutError, OSError, websockets.ConnectionClosed) as exc:
+                self.bot.LOGGER.error(f"Checkout unconfirmed after proceed, check the account manually: {order.event_url}, "
+                                      f"ticket: {ticket_id}, {exc!r}")
+                result = CheckoutFlow.UNCONFIRMED
+            order.mark(state, ticket_id=ticket_id)
+        except asyncio.TimeoutError:
+            self.bot.LOGGER.warning(f"Checkout timed out at stage: {state}, ticket: {ticket_id}")
+            result = CheckoutFlow.FAILED
+        order.mark(result, ticket_id=ticket_id)
+        self.bot.LOGGER.info(f"Checkout {result}: {ticket_id}")
+        return result
+
+    # Cancels the order of the cart and waits until the cart is gone
+    async def cancel(self, page, order, ticket_id, timeout):
+        await page.wait_visible('[id="cancel"]', timeout)
+        await page.click('[id="cancel"]')
+        await page.wait_visible('[class="action yes"]', timeout)
+        cancelled = page.expect(page.load_event)
+        await page.click('[class="action yes"]')
+        await asyncio.wait_for(cancelled, timeout)
+        order.mark(CheckoutFlow.CANCELLED, ticket_id=ticket_id)
+
+
+# Instance, order and ticket of the running thread or task, added to its log records
+LOG_CONTEXT = contextvars.ContextVar("log_context", default={})
+
+
+# Adds fields to the log records of the running thread or task for the duration of the block
+@contextlib.contextmanager
+def log_context(**fields):
+    token = LOG_CONTEXT.set(dict(LOG_CONTEXT.get(), **fields))
+    try:
+        yield
+    finally:
+        LOG_CONTEXT.reset(token)
+
+
+# Stamps the log context on the record, on the logging thread before it is queued
+class LogContextFilter(logging.Filter):
+    def filter(self, record):
+        for field, value in LOG_CONTEXT.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+
+# Lets through the first burst records of every logging call site per interval, the next record let
+# through carries the number of records suppressed in between. Only the INFO records of the hot loops
+# opting in with extra={"sample": True} are sampled, never the ones of a ticket. The count of a call
+# site gone quiet is logged by flush, every interval and at exit
+class LogSampler(logging.Filter):
+    def __init__(self, interval=10, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        # (pathname, lineno) -> (interval start, records, suppressed records, last suppressed record)
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not getattr(record, "sample", False) or hasattr(record, "ticket_id"):
+            return True
+        site = (record.pathname, record.lineno)
+        with self.lock:
+            started, records, suppressed, last = self.sites.get(site, (record.created, 0, 0, None))
+            if record.created - started >= self.interval:
+                if suppressed:
+                    self.summarize(record, suppressed=suppressed, seconds=record.created - started)
+                started, records, suppressed, last = record.created, 0, 0, None
+            records += 1
+            if records > self.burst:
+                suppressed += 1
+                last = record
+            self.sites[site] = (started, records, suppressed, last)
+        return records <= self.burst
+
+    @staticmethod
+    def summarize(record, suppressed, seconds):
+        record.msg = f"{record.getMessage()} | {suppressed} similar messages suppressed in the last {seconds:.0f}s"
+        record.args = None
+        record.suppressed = suppressed
+
+    # Logs the counts no later record of their call site carried, once their interval is over or all of them
+    def flush(self, force=False):
+        now = time.time()
+        summaries = []
+        with self.lock:
+            for site, (started, records, suppressed, last) in list(self.sites.items()):
+                if suppressed and (force or now - started >= self.interval):
+                    # The last suppressed record carries the count, it is let through as it is no longer sampled
+                    record = logging.makeLogRecord(dict(last.__dict__, sample=False))
+                    self.summarize(record, suppressed=suppressed, seconds=now - started)
+                    summaries.append(record)
+                    del self.sites[site]
+        for record in summaries:
+            logging.getLogger(record.name).handle(record)
+
+    # Flushes the counts of the quiet call sites every interval seconds
+    def run(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+
+# Formats the records as JSON lines with the log context fields
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("instance", "order", "ticket_id", "suppressed")
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "line": record.lineno,
+                 "thread": record.threadName, "message": record.getMessage()}
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry, default=str)
 
 
 # Main TradeDeskBot class
 class TradeDeskBot:
-    def __init__(self):
+    # Writes the queued log records to the console and the log file
+    log_listener = None
+    log_sampler = None
+
+    def __init__(self, settings=None):
         self.PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__)))
         self.file_settings = str(self.PROJECT_ROOT / 'BotRes/Settings.json')
-        self.file_event_urls = self.PROJECT_ROOT / 'BotRes/EventURLs.csv'
+        self.file_ledger = self.PROJECT_ROOT / 'BotRes/Orders.db'
         # self.proxies = self.get_proxies()
         self.user_agents = self.get_user_agents()
-        self.settings = self.get_settings()
-        self.LOGGER = self.get_logger()
-        self.logged_in = False
+        # Settings can be given instead of loaded, i.e. by the benchmarks
+        self.settings = settings or self.get_settings()
+        self.LOGGER = self.get_logger(settings=self.settings["Settings"])
+        # Per order stage spans, reported with: python TradeDeskBot.py --trace-report
+        self.file_traces = self.PROJECT_ROOT / 'BotRes/Traces.jsonl'
+        self.tracer = Tracer(file_traces=self.file_traces if self.settings["Settings"].get("Tracing", True) else None)
+        # "standalone" runs everything in this process, a "coordinator" also hands the orders to the "worker" processes
+        self.role = self.settings["Settings"].get("Role", "standalone")
+        self.worker_id = self.settings["Settings"].get("WorkerId") or f"{socket.gethostname()}:{os.getpid()}"
+        # Consumer group of the coordinator and the workers, set up by start_instances
+        self.broker = None
+        # Orders fetched from the broker and not acked yet, re-announced with every heartbeat
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+        self.acks = queue.Queue()
+        # Dedupes the EventURLs and tracks every order across restarts, the coordinator keeps it for the workers
+        self.ledger = None
+        if self.settings["Settings"].get("OrderLedger", True) and self.role != "worker":
+            self.ledger = OrderLedger(file_ledger=self.file_ledger)
+        self.event_urls = EventURLDispatcher(ledger=self.ledger)
         self.driver = None
+        self.base_url = self.settings["Settings"].get("BaseURL", "https://tradedesk.ticketmaster.com/")
+        # Fonts, stylesheets, analytics and other resources the bot does not need
+        self.resource_policy = ResourcePolicy.from_settings(self.settings["Settings"])
+        # Keeps the payment and cart assets cached in a standby tab and clicks through the checkout in the page
+        self.warm_standby = self.settings["Settings"].get("WarmStandby", False)
+        # Assets preloaded by the warm standby, relative to BaseURL or absolute, the ones of the cart pages are added
+        self.warm_assets = set(self.settings["Settings"].get("WarmAssets", []))
+        self.warm_assets_lock = threading.Lock()
+        self.cart_assets_learned = False
+        # Inventory refreshes per second of all the instances and processes of this host
+        self.request_budget = RequestBudget.from_settings(self.settings["Settings"], file_budget=self.PROJECT_ROOT / 'BotRes/Budget.db')
+        # One login shared by all the drivers
+        self.session = SessionManager(bot=self, email_id=self.settings["Settings"]["Email"], password=self.settings["Settings"]["Password"],
+                                      refresh_margin=self.settings["Settings"].get("SessionRefreshMargin", 600))
+        self.driver_pool = None
+        self.scheduler = None
+        # Kills and replaces the drivers of the stuck instances, set up by start_instances
+        self.watchdog = None
+        # Browser memory and CPU samples, reported with: python TradeDeskBot.py --resource-report
+        self.file_resources = self.PROJECT_ROOT / 'BotRes/Resources.jsonl'
+        self.resource_monitor = ResourceMonitor.from_settings(bot=self, settings=self.settings["Settings"], file_resources=self.file_resources)
+        # Polls the inventory over HTTP instead of the browser when FastPath is enabled
+        self.inventory_poller = None
+        if self.settings["Settings"].get("FastPath", False):
+            self.inventory_poller = InventoryPoller(bot=self, listing_url=self.settings["Settings"].get("ListingURL", "{event_url}"))
 
     # Loads LOGGER
-    @staticmethod
-    def get_logger():
+    @classmethod
+    def get_logger(cls, settings=None):
         """
-        Get logger file handler
+        Get logger file handler, the handlers run on a QueueListener thread off the hot loops
         :return: LOGGER
         """
+        settings = settings or {}
         logging.config.dictConfig({
             "version": 1,
             "disable_existing_loggers": False,
@@ -135,8 +2980,8 @@ class TradeDeskBot:
                         'CRITICAL': 'bold_red',
                     },
                 },
-                'simple': {
-                    'format': '[%(asctime)s,%(lineno)s] [%(message)s]',
+                'json': {
+                    '()': JsonFormatter,
                 },
             },
             "handlers": {
@@ -149,7 +2994,7 @@ class TradeDeskBot:
                 "file": {
                     "class": "logging.handlers.RotatingFileHandler",
                     "level": "INFO",
-                    "formatter": "simple",
+                    "formatter": "json",
                     "filename": "TradeDeskBot.log",
                     "maxBytes": 5 * 1024 * 1024,
                     "backupCount": 1
@@ -159,7 +3004,29 @@ class TradeDeskBot:
                      "handlers": ["console", "file"]
                      }
         })
-        return logging.getLogger()
+        root = logging.getLogger()
+        if cls.log_listener is not None:
+            cls.stop_logging()
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(LogContextFilter())
+        cls.log_sampler = LogSampler(interval=settings.get("LogSampleInterval", 10), burst=settings.get("LogSampleBurst", 5))
+        queue_handler.addFilter(cls.log_sampler)
+        threading.Thread(target=cls.log_sampler.run, daemon=True).start()
+        cls.log_listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+        cls.log_listener.start()
+        root.handlers = [queue_handler]
+        atexit.register(cls.stop_logging)
+        return root
+
+    # Logs the pending suppressed counts and writes out the queued log records
+    @classmethod
+    def stop_logging(cls):
+        if cls.log_listener is None:
+            return
+        cls.log_sampler.flush(force=True)
+        cls.log_listener.stop()
+        cls.log_listener = None
 
     # Enables CMD color
     @staticmethod
@@ -174,6 +3041,7 @@ class TradeDeskBot:
     # Prints ASCII Art Banner
     @staticmethod
     def banner():
+        import pyfiglet
         pyfiglet.print_figlet(text='____________ TradeDeskBot\n', colors='RED')
         print('TradeDeskBot: A TradeDesk Ticket Checkout Bot\n'
               'Developer: Ali Toori, Full-Stack Python Developer\n'
@@ -183,6 +3051,7 @@ class TradeDeskBot:
     # Trial version logic
     @staticmethod
     def trial(trial_date):
+        import ntplib
         ntp_client = ntplib.NTPClient()
         try:
             response = ntp_client.request('pool.ntp.org')
@@ -234,9 +3103,11 @@ class TradeDeskBot:
         return [x.strip() for x in content]
 
     # Get web driver
-    def get_driver(self, proxy=False, headless=False):
+    def get_driver(self, proxy=False, headless=False, resource_policy=None, page_load_strategy=None):
+        from selenium.webdriver.chrome.service import Service
         driver_bin = str(self.PROJECT_ROOT / "BotRes/bin/chromedriver.exe")
-        service = Service(executable_path=driver_bin)
+        # Let Selenium find the chromedriver when the bundled one is not there
+        service = Service(executable_path=driver_bin) if os.path.isfile(driver_bin) else Service()
         options = webdriver.ChromeOptions()
         options.add_argument("--start-maximized")
         options.add_argument("--disable-extensions")
@@ -246,6 +3117,10 @@ class TradeDeskBot:
         options.add_argument("--no-sandbox")
         options.add_argument("--disable-gpu")
         options.add_argument("--dns-prefetch-disable")
+        # Keep the timers and observers of the tabs in the background running at full speed
+        options.add_argument("--disable-background-timer-throttling")
+        options.add_argument("--disable-backgrounding-occluded-windows")
+        options.add_argument("--disable-renderer-backgrounding")
         options.add_argument('--ignore-ssl-errors')
         options.add_argument('--ignore-certificate-errors')
         options.add_argument("--disable-blink-features=AutomationControlled")
@@ -265,13 +3140,24 @@ class TradeDeskBot:
         if proxy:
             options.add_argument(f"--proxy-server={self.get_proxy()}")
         if headless:
-            options.add_argument('--headless')
+            options.add_argument('--headless=new')
+        # eager returns once the DOM is ready, none as soon as the navigation is committed
+        options.page_load_strategy = page_load_strategy or self.settings["Settings"].get("PageLoadStrategy", "normal")
         driver = webdriver.Chrome(service=service, options=options)
+        self.apply_resource_policy(driver=driver, resource_policy=resource_policy)
         return driver
 
+    # Blocks the resources of the policy in the current tab of a driver, every tab opened later needs it too
+    def apply_resource_policy(self, driver, resource_policy=None):
+        resource_policy = resource_policy or self.resource_policy
+        if resource_policy is not None:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": resource_policy.get_blocked_patterns(self.base_url)})
+
     # Waits until an element is present on the DOM
     @staticmethod
-    def wait_until_present(driver, css_selector=None, element_id=None, name=None, class_name=None, tag_name=None, duration=10000, frequency=0.01):
+    def wait_until_present(driver, css_selector=None, element_id=None, name=None, class_name=None, tag_name=None, duration=10, frequency=0.01):
+        from selenium.webdriver.support.wait import WebDriverWait
         if css_selector:
             WebDriverWait(driver, duration, frequency).until(EC.presence_of_element_located((By.CSS_SELECTOR, css_selector)))
         elif element_id:
@@ -285,7 +3171,8 @@ class TradeDeskBot:
 
     # Waits until an element is visible on the DOM
     @staticmethod
-    def wait_until_visible(driver, css_selector=None, element_id=None, name=None, class_name=None, tag_name=None, duration=10000, frequency=0.01):
+    def wait_until_visible(driver, css_selector=None, element_id=None, name=None, class_name=None, tag_name=None, duration=10, frequency=0.01):
+        from selenium.webdriver.support.wait import WebDriverWait
         if css_selector:
             WebDriverWait(driver, duration, frequency).until( EC.visibility_of_element_located((By.CSS_SELECTOR, css_selector)))
         elif element_id:
@@ -297,30 +3184,55 @@ class TradeDeskBot:
         elif tag_name:
             WebDriverWait(driver, duration, frequency).until(EC.visibility_of_element_located((By.TAG_NAME, tag_name)))
 
+    # Parses a price text like "$1,234.50" into float
+    @staticmethod
+    def parse_price(price_text):
+        try:
+            return float(str(price_text).strip().strip("$").replace(",", ""))
+        except ValueError:
+            return None
+
+    # Gets all ticket rows of the marketplace table as a list of dicts
+    def get_ticket_rows(self, driver):
+        """
+        Extracts the whole tickets table with one execute_script call instead of
+        several find_element calls per row
+        :return: list of ticket dicts
+        """
+        snapshot = driver.execute_script(JS_TICKET_ROWS) or []
+        return self.to_ticket_dicts(snapshot)
+
+    # Converts raw ticket rows from the page into ticket dicts
+    @classmethod
+    def to_ticket_dicts(cls, ticket_rows):
+        return [{"ID": ticket_id, "Qty": qty, "Section": section, "Row": row, "Seats": seats,
+                 "Price": cls.parse_price(price)}
+                for ticket_id, section, row, seats, qty, price in ticket_rows]
+
+    # Waits for new or changed tickets pushed by the in-page inventory watcher
+    def watch_new_tickets(self, driver, inventory, timeout):
+        """
+        Long-polls the MutationObserver buffer installed on the marketplace page, the
+        watcher is (re)installed with a full snapshot whenever the page has been loaded
+        :return: list of the ticket dicts which were added or changed
+        """
+        changes = driver.execute_async_script(JS_WATCH_DRAIN, int(timeout * 1000))
+        if changes is None:
+            driver.set_script_timeout(timeout + 5)
+            driver.execute_script(JS_WATCH_INSTALL)
+            return inventory.update(self.get_ticket_rows(driver=driver))
+        ticket_rows, removed_ids = changes
+        return inventory.merge(self.to_ticket_dicts(ticket_rows), removed_ids=removed_ids)
+
     # Gets you sign-in to the website
     def login_trade_desk(self, driver, email_id, password):
+        """
+        Signs in with email and password, the cookies are saved and shared by the SessionManager
+        :return: True if signed in
+        """
         self.LOGGER.info(f"Signing in to the website")
-        base_url = "https://tradedesk.ticketmaster.com/"
-        # Try to sign-in with saved cookies from previous session
-        cookies = 'cookies_' + email_id + '.pkl'
-        file_path_cookies = self.PROJECT_ROOT / 'BotRes' / cookies
+        base_url = self.base_url
         driver.get(base_url)
-        # if os.path.isfile(file_path_cookies):
-        #     self.LOGGER.info(f"Loading cookies for: {email_id}")
-        #     with open(file_path_cookies, 'rb') as cookies_file:
-        #         cookies = pickle.load(cookies_file)
-        #         for cookie in cookies:
-        #             driver.add_cookie(cookie)
-        #     try:
-        #         self.LOGGER.info(f"Waiting for profile")
-        #         driver.refresh()
-        #         # Wait for Upload button to confirm that we are logged-in
-        #         self.wait_until_visible(driver=driver, css_selector='[id="tmp_header_menu_left"]', duration=3)
-        #         self.LOGGER.info(f"Cookies login successful")
-        #         return True
-        #     except:
-        #         self.LOGGER.info(f"Cookies login failed")
-        #         os.remove(file_path_cookies)
 
         # Signing-in using Email or Username
         try:
@@ -332,7 +3244,7 @@ class TradeDeskBot:
             self.LOGGER.info(f"Filling password")
             driver.find_element(By.CSS_SELECTOR, '[name="password"]').send_keys(password)
         except:
-            self.LOGGER.info(f"Error while filling username and password")
+            self.LOGGER.warning(f"Error while filling username and password")
             pass
 
         # Submitting sign-in form
@@ -342,7 +3254,7 @@ class TradeDeskBot:
             self.wait_until_visible(driver=driver, css_selector='[class="header_signup"]')
             driver.find_element(By.CSS_SELECTOR, '[class="header_signup"]').click()
         except:
-            self.LOGGER.info(f"Error while submitting sign-in form")
+            self.LOGGER.warning(f"Error while submitting sign-in form")
             pass
         try:
             self.LOGGER.info(f"Waiting for profile")
@@ -350,299 +3262,222 @@ class TradeDeskBot:
             # Wait for Upload button to confirm that we are logged-in
             self.wait_until_visible(driver=driver, css_selector='[id="tmp_header_menu_left"]', duration=30)
             self.LOGGER.info(f"Email login successful")
+            return True
         except:
-            self.LOGGER.info(f"Email login failed")
+            self.LOGGER.error(f"Email login failed")
+            return False
 
-        # Store user cookies with cookies_email.pkl for later use
+    # Adds a matched ticket to the cart and completes the transaction
+    def cart_ticket(self, driver, order, ticket_dict):
+        """
+        Runs the checkout state machine of a matched ticket
+        :return: final state, i.e. CheckoutFlow.CONFIRMED, HELD, UNCONFIRMED, FAILED or CANCELLED
+        """
+        with log_context(ticket_id=ticket_dict["ID"]):
+            order.outcome = CheckoutFlow(bot=self, driver=driver, order=order, ticket_dict=ticket_dict,
+                                         deadlines=self.settings["Settings"].get("CheckoutDeadlines"),
+                                         warm_standby=self.warm_standby,
+                                         confirmation=self.settings["Settings"].get("Confirmation")).run()
+        # The held cart stays open in its driver for a human, the pool replaces the driver
+        if order.outcome == CheckoutFlow.HELD:
+            self.driver_pool.hand_over(driver)
+        return order.outcome
+
+    # Refreshes the inventory of the page once the RequestBudget allows it, keeping the filters of the order filled
+    def refresh_inventory(self, driver, order, refresh):
+        self.request_budget.acquire(hot=refresh.is_hot())
+        driver.execute_script(JS_REFRESH_INVENTORY, order.get_filters())
+
+    # Preloads the cart and payment assets into the browser cache from a standby tab, the tab of the order is untouched
+    def warm_up(self, driver):
+        """
+        :return: number of the assets loaded
+        """
+        with self.warm_assets_lock:
+            assets = sorted(self.warm_assets)
+        driver.warm_assets = len(assets)
+        if not assets:
+            return 0
+        main_handle = driver.current_window_handle
+        standby_handle = getattr(driver, "standby_handle", None)
         try:
-            self.LOGGER.info(f"Saving cookies for: {email_id}")
-            cookies = 'cookies_' + email_id + '.pkl'
-            file_path_cookies = self.PROJECT_ROOT / 'BotRes' / cookies
-            with open(file_path_cookies, 'wb') as cookies_file:
-                pickle.dump(driver.get_cookies(), cookies_file)
-            self.LOGGER.info(f"Cookies have been saved")
-            return True
-        except:
-            self.LOGGER.info(f"Error while saving cookies")
+            if standby_handle is None or standby_handle not in driver.window_handles:
+                driver.switch_to.new_window('tab')
+                driver.standby_handle = driver.current_window_handle
+                self.apply_resource_policy(driver=driver)
+                # Same site as the cart page, so both use the same partition of the cache and the connections
+                driver.get(self.base_url)
+            else:
+                driver.switch_to.window(standby_handle)
+            driver.set_script_timeout(30)
+            return driver.execute_async_script(JS_PRELOAD_ASSETS, [urljoin(self.base_url, asset) for asset in assets])
+        finally:
+            driver.switch_to.window(main_handle)
+
+    # Adds the scripts and stylesheets of a cart page to the assets of the warm standby
+    def learn_assets(self, driver):
+        try:
+            assets = set(driver.execute_script(JS_PAGE_ASSETS) or [])
+        except WebDriverException:
+            return
+        with self.warm_assets_lock:
+            self.warm_assets |= assets
+            self.cart_assets_learned = True
+        self.LOGGER.info(f"Warm standby assets: {len(self.warm_assets)}")
 
     # Checkout a ticket after matching
-    def checkout_ticket(self, driver, section_to_buy, row_to_buy, seats_to_buy):
-        # Wait and check till the tickets gets available
-        wait_for_ticket = self.settings["Settings"]["WaitForTicket"]
-        # 5 minutes from now
-        timeout = time.time() + wait_for_ticket * 60
-        tickets_checked = 0
+    def checkout_ticket(self, driver, order, refresh=None):
+        # Wait and check till the tickets gets available, until the order expires
+        timeout = order.deadline or time.time() + self.settings["Settings"]["WaitForTicket"] * 60
+        # Watch mode gets the new tickets pushed from the page instead of polling the tickets table
+        watch_mode = self.settings["Settings"].get("WatchMode", False)
+        watch_timeout = self.settings["Settings"].get("WatchTimeout", 10)
+        # A tab shares its browser with the other tabs, it only holds it for short waits
+        if isinstance(driver, BrowserTab):
+            watch_timeout = min(watch_timeout, driver.max_script_wait)
+        refresh = refresh or RefreshScheduler.from_settings(order=order, settings=self.settings["Settings"])
+        # The watchers of an order refresh in turns
+        sleep(order.get_phase(refresh.interval))
+        next_refresh = time.time() + refresh.next_delay()
+        inventory = InventoryTracker()
+        first_row = True
         while True:
+            self.watchdog.beat(order)
+            if order.race.is_lost(order):
+                self.LOGGER.info(f"Another instance is checking out the order, watcher {order.replica} stopped")
+                return
             try:
-                # self.LOGGER.info(f"Waiting for the tickets list")
-                # Waiting for the tickets table
-                self.wait_until_visible(driver=driver, css_selector='tr[id*="ticket_"]', duration=1)
-                # self.LOGGER.info(f"Tickets list is visible")
-
-                # Check if ticket list has new tickets came in
-                ticket_list = driver.find_elements(By.CSS_SELECTOR, 'tr[id*="ticket_"]')
-                if ticket_list > tickets_checked:
-                    tickets_checked = ticket_list
-                    # Checking out a ticket based on the price and other information provided
-                    for ticket in driver.find_elements(By.CSS_SELECTOR, 'tr[id*="ticket_"]'):
-                        qty, section, row, seats, cost, price = '', '', '', '', '', ''
-
-                        # Scroll ticket into view
-                        driver.execute_script("arguments[0].scrollIntoView();", ticket)
-
-                        # Get ticket ID
-                        ticket_id = ticket.get_attribute('id')[7:]
-
-                        # Get tickets quantity
-                        # try:
-                        #     self.LOGGER.info(f"Getting quantity")
-                        #     qty = ticket.find_element(By.CSS_SELECTOR, '[class*="column_quantity"]').text
-                        #     # tickets_available = qty.split('/')[0].strip()
-                        #     # tickets_total = qty.split('/')[1].strip()
-                        # except:
-                        #     self.LOGGER.info(f'Error while getting quantity')
-
-                        # Get section
-                        try:
-                            # self.LOGGER.info(f"Getting section")
-                            # Waiting for the tickets table
-                            # self.wait_until_visible(driver=ticket, css_selector='[class*="column_section"]', duration=3)
-                            section = str(
-                                ticket.find_element(By.CSS_SELECTOR, '[class*="column_section"]').text).strip()
-                        except:
-                            self.LOGGER.info(f'Error while getting section')
-
-                        # Get row
-                        try:
-                            # self.LOGGER.info(f"Getting row")
-                            row = str(ticket.find_element(By.CSS_SELECTOR, '[class*="column_row"]').text).strip()
-                        except:
-                            self.LOGGER.info(f'Error while getting row')
-
-                        # Get seats
-                        try:
-                            # self.LOGGER.info(f"Getting seats")
-                            seats = str(ticket.find_element(By.CSS_SELECTOR, '[class*="column_seats"]').text).strip()
-                        except:
-                            self.LOGGER.info(f'Error while getting seats')
-
-                        # # Get cost
-                        # try:
-                        #     self.LOGGER.info(f"Getting cost")
-                        #     cost = str(ticket.find_element(By.CSS_SELECTOR, '[class*="column_cost"]').text).strip()
-                        # except:
-                        #     self.LOGGER.info(f'Error while getting cost')
-
-                        try:
-                            # Get price
-                            # self.LOGGER.info(f"Getting price")
-                            price = float(
-                                str(ticket.find_element(By.CSS_SELECTOR, '[class*="column_price"]').text).strip("$"))
-                        except:
-                            self.LOGGER.info(f'Error while getting price')
-
-                        # Print ticket information
-                        ticket_dict = {"Qty": qty, "Section": section, "Row": row, "Seats": seats, "Cost": cost,
-                                       "Price": price}
-                        self.LOGGER.info(
-                            f"Ticket: {ticket_id} | {ticket_dict} | Ticket matched: {(section_to_buy in section) and (row_to_buy in row) and (seats_to_buy in seats)}")
-                        # sleep(5000)
-                        # Checkout ticket if it matches the section_to_buy, row_to_buy, seats_to_buy and price is between price_from and price_to
-                        if (section_to_buy in section) and (row_to_buy in row) and (seats_to_buy in seats):
-                            # Checkout the ticket
-                            self.LOGGER.info(f"Checking out ticket")
-                            # Click buy button
-                            try:
-                                # self.LOGGER.info(f"Clicking buy button")
-                                ticket.find_element(By.CSS_SELECTOR,
-                                                    '[class="button special no__border to__cart clickable"]').click()
-                                # self.LOGGER.info(f"Buy button clicked")
-                            except:
-                                self.LOGGER.info(f'Error while clicking buy button')
-                            # # Add to the cart
-                            # self.LOGGER.info(f"Clicking buy button")
-                            #
-                            # # Add ticket to the cart
-                            # try:
-                            #     # Click Add to cart button
-                            #     self.LOGGER.info(f"Adding ticket {ticket_id} to the cart")
-                            #     self.wait_until_visible(driver=driver, css_selector='[class="button special purchase_send"]')
-                            #     driver.find_element(By.CSS_SELECTOR, '[class="button special purchase_send"]').click()
-                            #     self.LOGGER.info(f"Ticket {ticket_id} has been added to the cart")
-                            # except:
-                            #     self.LOGGER.info(f"Error while adding ticket {ticket_id} to the cart")
-
-                            # Click checkout button
-                            try:
-                                # self.LOGGER.info(f"Clicking checkout button")
-                                self.wait_until_visible(driver=driver,
-                                                        css_selector='[class="button positive purchase_send_checkout"]')
-                                driver.find_element(By.CSS_SELECTOR,
-                                                    '[class="button positive purchase_send_checkout"]').click()
-                                # self.LOGGER.info(f"Checkout button has been clicked")
-                            except:
-                                self.LOGGER.info(f"Error while clicking checkout button")
-
-                            # wait and check for pop-up error message, if any
-                            # try:
-                            #     self.LOGGER.info(f"Waiting for pop-up message")
-                            #     self.wait_until_visible(driver=driver, css_selector='[id="messages-popup-content"]', duration=3)
-                            #     msg_text = driver.find_element(By.CSS_SELECTOR, '[id="messages-popup-content"]').text
-                            #
-                            #     # If error message says: "Quantity not selected", close the pop-up and select quantity
-                            #     if 'Quantity not selected' in msg_text:
-                            #         self.LOGGER.info(f"Error while checking out ticket: {ticket_id}, Msg: {msg_text}")
-                            #
-                            #         # Close the error message
-                            #         try:
-                            #             self.LOGGER.info(f"Closing the error message")
-                            #             self.wait_until_visible(driver=driver, css_selector='[id="messages-close"]')
-                            #             driver.find_element(By.CSS_SELECTOR, '[id="messages-close"]').click()
-                            #             self.LOGGER.info(f"Error message closed")
-                            #         except:
-                            #             self.LOGGER.info(f"Error while closing the error message")
-                            #
-                            #         # Select ticket quantity
-                            #         try:
-                            #             self.LOGGER.info(f"Selecting tickets quantity: {qty_to_buy}")
-                            #             # Select ticket quantity to buy
-                            #             self.wait_until_visible(driver=driver, css_selector=f'[id*="ticket_quantity"]', duration=3)
-                            #             selector = Select(webelement=driver.find_element(By.CSS_SELECTOR, f'[id*="ticket_quantity"]'))
-                            #             selector.select_by_visible_text(text=qty_to_buy)
-                            #             self.LOGGER.info(f"Tickets quantity has been selected: {qty_to_buy}")
-                            #         except:
-                            #             self.LOGGER.info(f"Error while selecting tickets quantity")
-                            #             self.LOGGER.info(f"Selecting next ticket")
-                            #             continue
-                            #
-                            #     # If error message says: "Could not add ticket to cart", just pass
-                            #     if 'Could not add ticket to cart' in msg_text or 'Quantity not selected' in msg_text:
-                            #         self.LOGGER.info(f"Error while checking out: {ticket_id}")
-                            #         self.LOGGER.info(f"{msg_text}: {ticket_id}")
-                            #         self.LOGGER.info(f"Selecting next ticket")
-                            #         continue
-                            #     else:
-                            #         self.LOGGER.info(f"Ticket has been added to the cart: {ticket_id}")
-                            # except:
-                            #     self.LOGGER.info(f"Error while waiting for pup-up message: {ticket_id}")
-
-                            # Handle the checkout page
-                            # Wait for the cart page
-                            try:
-                                # self.LOGGER.info(f"Waiting for the cart page")
-                                self.wait_until_visible(driver=driver, css_selector='[id="purchase"]')
-                                # self.LOGGER.info(f"Cart page has been visible")
-                            except:
-                                self.LOGGER.info(f"Error while waiting for the cart page")
-
-                            # Get the ticket price in the cart page
-                            try:
-                                # self.LOGGER.info(f"Waiting for the ticket price")
-                                # self.LOGGER.info(f"Getting price")
-                                price = float(
-                                    str(driver.find_element(By.CSS_SELECTOR, '[dataformat="price"]').text).strip("$"))
-                            except:
-                                self.LOGGER.info(f'Error while getting price')
-
-                            # Scroll to the end of the cart page
-                            try:
-                                # self.LOGGER.info(f"Scrolling to the end of the cart")
-                                driver.find_element(By.TAG_NAME, 'html').send_keys(Keys.END)
-                                driver.find_element(By.TAG_NAME, 'html').send_keys(Keys.END)
-                                driver.find_element(By.TAG_NAME, 'html').send_keys(Keys.END)
-                                # self.LOGGER.info(f"Scrolled to the end")
-                            except:
-                                self.LOGGER.info(f"Error while scrolling")
-
-                            # Cancel the order if the ticket price is not in range of priceFrom - priceTo
-                            if price_from <= price <= price_to:
-                                # Cancel the order
-                                try:
-                                    # Click on cancel button
-                                    # self.LOGGER.info(f"Cancelling order of the ticket: {ticket_id}")
-                                    self.wait_until_visible(driver=driver, css_selector='[id="cancel"]')
-                                    cancel_order_btn = driver.find_element(By.CSS_SELECTOR, '[id="cancel"]')
-                                    driver.execute_script("arguments[0].click();", cancel_order_btn)
-                                    # self.LOGGER.info(f"Ticket order has been cancelled: {ticket_id}")
-                                except WebDriverException as exc:
-                                    self.LOGGER.info(
-                                        f"Error while cancelling order of the ticket: {ticket_id}, {exc.msg}")
-
-                                # Click Yes to confirm cancellation of the order
-                                try:
-                                    # Click on cancel button
-                                    # self.LOGGER.info(f"Cancelling order of the ticket: {ticket_id}")
-                                    self.wait_until_visible(driver=driver, css_selector='[class="action yes"]')
-                                    cancel_order_btn = driver.find_element(By.CSS_SELECTOR, '[class="action yes"]')
-                                    driver.execute_script("arguments[0].click();", cancel_order_btn)
-                                    # self.LOGGER.info(f"Ticket order has been cancelled: {ticket_id}")
-                                    sleep(20)
-                                except WebDriverException as exc:
-                                    self.LOGGER.info(
-                                        f"Error while cancelling order of the ticket: {ticket_id}, {exc.msg}")
-                                    sleep(20)
-
-                            # Wait for the "Paying with card" to be visible on the cart page
-                            try:
-                                # self.LOGGER.info(f"Waiting for the card to be loaded")
-                                self.wait_until_visible(driver=driver,
-                                                        css_selector='[class="braintree-methods braintree-methods-initial"]')
-                                # self.LOGGER.info(f"Card has been loaded")
-                            except:
-                                self.LOGGER.info(f"Error while waiting for the card to load")
-
-                            # Complete the transaction
-                            try:
-                                # Click on Complete Transaction button
-                                # self.LOGGER.info(f"Completing the transaction for the ticket: {ticket_id}")
-                                self.wait_until_visible(driver=driver, css_selector='[id="proceed"]')
-                                cancel_order_btn = driver.find_element(By.CSS_SELECTOR, '[id="proceed"]')
-                                driver.execute_script("arguments[0].click();", cancel_order_btn)
-                                # actions.move_to_element(complete_transaction_btn).click()
-                                # self.LOGGER.info(f"Ticket has been successfully checked out: {ticket_id}")
-                                sleep(60)
-                                # Break from the loop
-                            except WebDriverException as exc:
-                                self.LOGGER.info(f"Error while completing the transaction for the ticket: {ticket_id}, {exc.msg}")
-                                sleep(60)
-
-                # Refresh Inventory if ticket_list is smaller than the checked tickets
+                if watch_mode:
+                    # Wait for the tickets the page reports as added or changed
+                    new_tickets = self.watch_new_tickets(driver=driver, inventory=inventory,
+                                                         timeout=min(watch_timeout, max(next_refresh - time.time(), 0.05), max(timeout - time.time(), 0.1)))
                 else:
-                    self.LOGGER.info(f"No New tickets found, selecting all Inventory")
-                    driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
-                    driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
-                    sleep(0.5)
-            except:
-                self.LOGGER.info(f"Tickets are not yet available, selecting all Inventory")
-                driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
-                driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
-                sleep(0.5)
+                    # Get a snapshot of all the ticket rows in a single round trip
+                    ticket_rows = self.get_ticket_rows(driver=driver)
+                    if not ticket_rows:
+                        # Waiting for the tickets table
+                        self.wait_until_visible(driver=driver, css_selector='tr[id*="ticket_"]', duration=1)
+                        ticket_rows = self.get_ticket_rows(driver=driver)
+                    new_tickets = inventory.update(ticket_rows)
+
+                # Check if ticket list has new or changed tickets came in
+                if new_tickets:
+                    # The event is hot, keep refreshing it fast
+                    next_refresh = time.time() + refresh.next_delay(changed=True)
+                    if first_row:
+                        order.mark("first row")
+                        first_row = False
+                    self.LOGGER.info(f"Inventory updated: {inventory}", extra={"sample": True})
+                    # Checkout the tickets matching the section, row, seats, qty and price window, the cheapest first
+                    candidates = order.rank(new_tickets)
+                    matched_ids = {ticket_dict["ID"] for ticket_dict in candidates}
+                    for ticket_dict in new_tickets:
+                        # Print ticket information, the unmatched tickets are sampled as it runs for every new ticket
+                        matched = ticket_dict["ID"] in matched_ids
+                        self.LOGGER.info(f"Ticket: {ticket_dict['ID']} | {ticket_dict} | Ticket matched: {matched}",
+                                         extra={"ticket_id": ticket_dict["ID"]} if matched else {"sample": True})
+                    for ticket_dict in candidates:
+                        ticket_id = ticket_dict["ID"]
+                        # Another watcher bought the order meanwhile
+                        if order.race.is_lost(order):
+                            break
+                        # Checkout the ticket
+                        order.mark("match", ticket_id=ticket_id)
+                        self.LOGGER.info(f"Checking out ticket: {ticket_id} | {ticket_dict}", extra={"ticket_id": ticket_id})
+                        self.scheduler.set_state(order, OrderScheduler.CHECKING_OUT)
+                        # Give the driver back as soon as the order is checked out
+                        if self.cart_ticket(driver=driver, order=order, ticket_dict=ticket_dict) in CheckoutFlow.ENDED:
+                            return
+                        # Back to the event page to try the next candidate and watch for the next ticket
+                        self.scheduler.set_state(order, OrderScheduler.WATCHING)
+                        self.open_event(driver=driver, order=order)
+
+                # Nothing has been pushed until the next refresh is due, refresh the inventory once
+                elif watch_mode:
+                    if time.time() >= next_refresh:
+                        self.LOGGER.info(f"No New tickets pushed, refreshing all Inventory", extra={"sample": True})
+                        self.refresh_inventory(driver=driver, order=order, refresh=refresh)
+                        next_refresh = time.time() + refresh.next_delay()
+                # Refresh Inventory if no new or changed tickets came in
+                else:
+                    self.LOGGER.info(f"No New tickets found, selecting all Inventory", extra={"sample": True})
+                    self.refresh_inventory(driver=driver, order=order, refresh=refresh)
+                    sleep(refresh.next_delay())
+            # A dead driver fails the refresh as well and the order is requeued by run_order
+            except WebDriverException:
+                self.LOGGER.info(f"Tickets are not yet available, selecting all Inventory", extra={"sample": True})
+                self.refresh_inventory(driver=driver, order=order, refresh=refresh)
+                sleep(refresh.next_delay())
 
             # If wait_for_ticket time expires, exit the round
             if time.time() > timeout:
                 self.LOGGER.info(f"Timeout while waiting for the ticket !")
                 break
 
-    # Get tickets via driver
-    def get_ticket(self, driver, event_url):
-        self.LOGGER.info(f"Checking out tickets from event: {event_url}")
-        base_url = "https://tradedesk.ticketmaster.com/"
-        cart_url = "https://tradedesk.ticketmaster.com/purchase"
-
-        actions = ActionChains(driver=driver)
-
-        qty_to_buy = 1
-
-        # Extract event ID from event_url
-        # event_id = event_url[53:70].split('?')[0]
-
-        # Extract section, row and seats values from the event URL
-        section_to_buy = re.findall(r'(?<=section=)(.+)(?=&row)', event_url)[0]
-        row_to_buy = re.findall(r'(?<=row=)(.+)(?=&seats)', event_url)[0]
-        seats_to_buy = re.findall(r'(?<=seats=)(.+)(?=&all_inv)', event_url)[0]
-        price_from = float(re.findall(r'(?<=priceFrom=)(.+)(?=&priceTo)', event_url)[0])
-        price_to = float(re.findall(r'(?<=priceTo=)(.+)', event_url)[0])
+    # Watches the inventory of an order over HTTP and only takes a driver to checkout a matched ticket
+    def poll_ticket(self, order, stop):
+        """
+        :param stop: event set by the Watchdog once the order was requeued, the loop leaves the order as soon as it sees it
+        """
+        self.LOGGER.info(f"Polling tickets over HTTP from event: {order.event_url}")
+        self.scheduler.set_state(order, OrderScheduler.WATCHING)
+        refresh = RefreshScheduler.from_settings(order=order, settings=self.settings["Settings"],
+                                                 interval=self.settings["Settings"].get("FastPathInterval", 0.25))
+        # The watchers of an order poll in turns
+        sleep(order.get_phase(refresh.interval))
+        inventory = InventoryTracker()
+        while not self.scheduler.is_expired(order):
+            if stop.is_set():
+                self.LOGGER.warning(f"Poll of the order stuck, watcher {order.replica} stopped: {order.event_url}")
+                return
+            self.watchdog.beat(order)
+            if order.race.is_lost(order):
+                self.LOGGER.info(f"Another instance is checking out the order, watcher {order.replica} stopped")
+                return
+            self.request_budget.acquire(hot=refresh.is_hot())
+            try:
+                new_tickets = inventory.update(self.inventory_poller.poll(order=order))
+            except (requests.RequestException, ValueError) as exc:
+                self.LOGGER.warning(f"Error while polling tickets: {exc}")
+                sleep(refresh.next_delay())
+                continue
+            # The cheapest matched ticket is tried first, the next one if its checkout fails
+            for ticket_dict in order.rank(new_tickets):
+                if order.race.is_lost(order) or stop.is_set():
+                    break
+                order.mark("match", ticket_id=ticket_dict["ID"])
+                self.LOGGER.info(f"Ticket: {ticket_dict['ID']} | {ticket_dict} | Ticket matched: True", extra={"ticket_id": ticket_dict["ID"]})
+                self.scheduler.set_state(order, OrderScheduler.CHECKING_OUT)
+                # Hand off to a signed in driver for the checkout
+                driver = self.driver_pool.acquire()
+                if driver is None:
+                    self.LOGGER.warning(f"No driver available to checkout ticket: {ticket_dict['ID']}")
+                    self.scheduler.set_state(order, OrderScheduler.WATCHING)
+                    continue
+                self.watchdog.attach(order, driver)
+                checkout_state = CheckoutFlow.FAILED
+                try:
+                    driver.get(order.event_url)
+                    order.mark("page load")
+                    self.wait_until_visible(driver=driver, css_selector='[class*="filter_tm"]', duration=10)
+                    driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
+                    self.wait_until_visible(driver=driver, css_selector=f'tr[id="ticket_{ticket_dict["ID"]}"]', duration=10)
+                    order.mark("first row")
+                    checkout_state = self.cart_ticket(driver=driver, order=order, ticket_dict=ticket_dict)
+                except WebDriverException as exc:
+                    self.LOGGER.warning(f"Error while checking out ticket: {ticket_dict['ID']}, {exc.msg}")
+                finally:
+                    self.watchdog.attach(order, None)
+                    self.driver_pool.release(driver)
+                if checkout_state in CheckoutFlow.ENDED:
+                    return
+                self.scheduler.set_state(order, OrderScheduler.WATCHING)
+            else:
+                sleep(refresh.next_delay(changed=bool(new_tickets)))
+        self.LOGGER.info(f"Timeout while waiting for the ticket !")
 
+    # Gets to the event page, selects All Inventory and fills the filters of the order
+    def open_event(self, driver, order):
         # # Get to the event page and click All Events
         # try:
         #     # Click All Events
@@ -655,7 +3490,8 @@ class TradeDeskBot:
 
         # Get to the event page and click All Inventory
         try:
-            driver.get(event_url)
+            driver.get(order.event_url)
+            order.mark("page load")
             # Click All Inventory
             # self.LOGGER.info(f"Waiting for the Inventory")
             self.wait_until_visible(driver=driver, css_selector='[class*="filter_tm"]')
@@ -663,38 +3499,50 @@ class TradeDeskBot:
             driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
             # driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
             # self.LOGGER.info(f"All Inventory selected")
-        except:
-            self.LOGGER.info(f"Error while selecting all inventory")
+        except (TimeoutException, WebDriverException):
+            self.LOGGER.warning(f"Error while selecting all inventory")
+
+        if not order.is_filtered():
+            order.mark("filters")
+            return
 
         # Filling filter: Section
         try:
             # self.LOGGER.info(f"Filling filter: Section")
             # Waiting for the tickets table
             self.wait_until_visible(driver=driver, css_selector='[name="filter_ticket_section"]')
-            driver.find_element(By.CSS_SELECTOR, '[name="filter_ticket_section"]').send_keys(section_to_buy)
+            driver.find_element(By.CSS_SELECTOR, '[name="filter_ticket_section"]').send_keys(order.section)
             # self.LOGGER.info(f"Filled filter: Section")
-        except:
-            self.LOGGER.info(f"Error while filling filter: Section")
+        except (TimeoutException, WebDriverException):
+            self.LOGGER.warning(f"Error while filling filter: Section")
 
         # Filling filter: Row
         try:
             # self.LOGGER.info(f"Filling filter: Row")
             # Waiting for the tickets table
             self.wait_until_visible(driver=driver, css_selector='[name="filter_ticket_row"]')
-            driver.find_element(By.CSS_SELECTOR, '[name="filter_ticket_row"]').send_keys(row_to_buy)
+            driver.find_element(By.CSS_SELECTOR, '[name="filter_ticket_row"]').send_keys(order.row)
             # self.LOGGER.info(f"Filled filter: Row")
-        except:
-            self.LOGGER.info(f"Error while filling filter: Row")
+        except (TimeoutException, WebDriverException):
+            self.LOGGER.warning(f"Error while filling filter: Row")
 
         # Filling filter: Seats
         try:
             # self.LOGGER.info(f"Filling filter: Seats")
             # Waiting for the tickets table
             self.wait_until_visible(driver=driver, css_selector='[name="filter_ticket_seat"]')
-            driver.find_element(By.CSS_SELECTOR, '[name="filter_ticket_seat"]').send_keys(seats_to_buy)
+            driver.find_element(By.CSS_SELECTOR, '[name="filter_ticket_seat"]').send_keys(order.seats)
             # self.LOGGER.info(f"Filled filter: Seats")
-        except:
-            self.LOGGER.info(f"Error while filling filter: Seats")
+        except (TimeoutException, WebDriverException):
+            self.LOGGER.warning(f"Error while filling filter: Seats")
+        order.mark("filters")
+
+    # Get tickets via driver
+    def get_ticket(self, driver, order):
+        self.LOGGER.info(f"Checking out tickets from event: {order.event_url}")
+
+        # Get to the event page and fill the filters of the order
+        self.open_event(driver=driver, order=order)
 
         # Waiting for the tickets inventory
         # try:
@@ -705,8 +3553,12 @@ class TradeDeskBot:
         # except:
         #     self.LOGGER.info(f"Error while waiting for the marketplace list")
 
-        # Constantly click All Inventory until there are tickets in the inventory
-        while True:
+        # Constantly click All Inventory until there are tickets in the inventory, the watch mode waits
+        # for the tickets to be pushed by the page inside checkout_ticket instead
+        self.scheduler.set_state(order, OrderScheduler.WATCHING)
+        refresh = RefreshScheduler.from_settings(order=order, settings=self.settings["Settings"])
+        while not self.settings["Settings"].get("WatchMode", False):
+            self.watchdog.beat(order)
             try:
                 # self.LOGGER.info(f"Waiting for the tickets list")
                 # Waiting for the tickets table
@@ -717,82 +3569,360 @@ class TradeDeskBot:
 
                 # Break if the tickets get available
                 break
-            except:
-                self.LOGGER.info(f"Tickets are not yet available, selecting all Inventory")
-                driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
-                driver.find_element(By.CSS_SELECTOR, '[class*="filter_tm"]').click()
-                sleep(0.5)
+            except TimeoutException:
+                self.LOGGER.info(f"Tickets are not yet available, selecting all Inventory", extra={"sample": True})
+                self.refresh_inventory(driver=driver, order=order, refresh=refresh)
+                sleep(refresh.next_delay())
+                # Give the instance back when the order expires or another watcher checks it out
+                if self.scheduler.is_expired(order) or order.race.is_lost(order):
+                    self.LOGGER.info(f"Timeout while waiting for the ticket !")
+                    return
 
         # Try to checkout a ticket
-        self.checkout_ticket(driver=driver, section_to_buy=section_to_buy, row_to_buy=row_to_buy, seats_to_buy=seats_to_buy, price_from=price_from, price_to=price_to)
+        self.checkout_ticket(driver=driver, order=order, refresh=refresh)
+
+    # Checks if a process of this host is running
+    @staticmethod
+    def is_process_running(pid):
+        import psutil
+        return psutil.pid_exists(pid)
+
+    # Gets the PubNub configuration of the bot
+    @staticmethod
+    def get_pnconfig():
+        from pubnub.pnconfiguration import PNConfiguration
+        pnconfig = PNConfiguration()
+        pnconfig.subscribe_key = 'sub-06059d87-ebbe-11e1-8247-37c456d16340'
+        pnconfig.publish_key = 'pub-f59b296a-9c78-45fc-b592-d5e6f9e839b4'
+        pnconfig.user_id = "Channel-TradeDeskBot"
+        return pnconfig
+
+    # Gets the PubNub channel to listen to, PubNubChannel overrides the channel of this machine
+    def get_channel(self):
+        return self.settings["Settings"].get("PubNubChannel") or self.settings["Settings"]["PubNubKeyChannelInstance_2"]
 
     # Subscribes and listens to pubnub channel to get EventURL
     def start_pubnub_listener(self):
-        channel_machine = self.settings["Settings"]["PubNubKeyChannelInstance_2"]
+        # The PubNub client is built here, on the listener thread, rather than at import time
+        from pubnub.pubnub import PubNub
+        pubnub = PubNub(self.get_pnconfig())
+        channel_machine = self.get_channel()
         self.LOGGER.info(f'Starting PubNub Listener for: {channel_machine}')
         # Add EventURLHandler as an event listener
-        pubnub.add_listener(EventURLHandler())
+        pubnub.add_listener(EventURLHandler(dispatcher=self.event_urls, tracer=self.tracer))
         # Subscribe to the channel to get messages i.e. EventURLs
         pubnub.subscribe().channels(channel_machine).execute()
 
-    # Gets EventURL from local file
-    def get_event_url(self):
-        event_df = pd.read_csv(self.file_event_urls, index_col=None)
-        last_url = event_df.iloc[-1]
-        if last_url["Processed"] == "No":
-            event_df.loc[event_df.Processed == "No", "Processed"] = "Yes"
-            event_df.to_csv(self.file_event_urls, index=False)
-            return last_url["EventURL"]
-        else:
-            return None
+    # Waits for the next EventURL received by the PubNub listener
+    def get_event_url(self, timeout=None):
+        """
+        :return: (event_url, trace, instances)
+        """
+        return self.event_urls.get(timeout=timeout)
+
+    # Parses the received EventURLs into orders and queues them to the scheduler
+    def dispatch_orders(self, ready=None):
+        # The orders wait for the startup checks, the drivers warm up meanwhile
+        if ready is not None and not ready.result():
+            return
+        while True:
+            event_url, trace, instances = self.get_event_url()
+            self.LOGGER.info(f"EvenURL Received: {event_url}")
+            # Extract section, row, seats and price values from the event URL
+            try:
+                order = EventOrder(event_url=event_url)
+            except ValueError as exc:
+                self.LOGGER.warning(f"Error while parsing event URL: {exc}")
+                if self.ledger is not None:
+                    self.ledger.finish(OrderLedger.hash_url(event_url), "invalid")
+                continue
+            # A resumed order keeps the time it was first received at
+            if self.ledger is not None:
+                order.received_at = self.ledger.get(order.url_hash)["received_at"]
+            order.trace = trace
+            order.mark("queue pickup")
+            self.LOGGER.info(f"Order: {order} | Instances: {instances}")
+            self.submit_order(order=order, instances=instances)
+
+    # Queues the watchers of an order, no more than the instances there are
+    def submit_order(self, order, instances=1):
+        for watcher in order.fan_out(min(instances, len(self.scheduler.states))):
+            self.scheduler.submit(watcher)
+
+    # Records the outcome of a watcher, the outcome of the order is recorded once its last watcher finished
+    def finish_watcher(self, order, outcome):
+        outcome = order.race.finish(order, outcome)
+        if outcome is None:
+            return
+        if self.broker is not None:
+            self.acks.put((order.event_url, outcome))
+        elif self.ledger is not None:
+            self.ledger.finish(order.url_hash, outcome)
+
+    # Gets the broker of the consumer group: the coordinator serves it, the workers connect to it
+    def get_broker(self):
+        address = self.settings["Settings"].get("BrokerAddress", "127.0.0.1:7465")
+        if self.role == "coordinator":
+            broker = MemoryBroker(worker_timeout=self.settings["Settings"].get("WorkerTimeout", 10),
+                                  on_ack=self.finish_order if self.ledger is not None else None)
+            BrokerServer(broker=broker, address=address, secret=self.settings["Settings"].get("BrokerSecret"),
+                         logger=self.LOGGER).start()
+            self.LOGGER.info(f"Broker listening on: {address}")
+            return broker
+        if self.role == "worker":
+            self.LOGGER.info(f"Worker {self.worker_id} joining the broker: {address}")
+            return SocketBroker(address=address, timeout=self.settings["Settings"].get("WorkerTimeout", 10),
+                                secret=self.settings["Settings"].get("BrokerSecret"))
+        raise ValueError(f"Invalid Role: {self.role}")
+
+    # Records the outcome a worker acked in the ledger
+    def finish_order(self, event_url, outcome):
+        self.ledger.finish(OrderLedger.hash_url(event_url), outcome)
+
+    # Publishes the received EventURLs to the workers, the coordinator owns the ledger so each order is published once
+    def publish_orders(self):
+        while True:
+            event_url, _, instances = self.get_event_url()
+            received_at = time.time()
+            if self.ledger is not None:
+                url_hash = OrderLedger.hash_url(event_url)
+                self.ledger.claim(url_hash, worker=OrderLedger.get_worker("broker"))
+                received_at = self.ledger.get(url_hash)["received_at"]
+            self.LOGGER.info(f"EvenURL Published: {event_url}")
+            self.broker.publish(event_url, received_at=received_at, instances=instances)
+
+    # Fetches orders from the broker while an instance is idle and queues them to the scheduler
+    def consume_orders(self, ready=None):
+        if ready is not None and not ready.result():
+            return
+        while True:
+            capacity = self.scheduler.wait_capacity(timeout=1.0)
+            if capacity <= 0:
+                continue
+            try:
+                message = self.broker.fetch(worker_id=self.worker_id, capacity=capacity, timeout=1.0)
+            # An error answered by the broker is retried like an unreachable broker
+            except (ConnectionError, ValueError) as exc:
+                self.LOGGER.warning(f"Error while fetching orders: {exc}")
+                sleep(self.settings["Settings"].get("HeartbeatInterval", 2))
+                continue
+            if message is None:
+                continue
+            event_url = message["event_url"]
+            self.LOGGER.info(f"EvenURL Received: {event_url}")
+            with self.in_flight_lock:
+                self.in_flight.add(event_url)
+            try:
+                order = EventOrder(event_url=event_url)
+            except ValueError as exc:
+                self.LOGGER.warning(f"Error while parsing event URL: {exc}")
+                self.acks.put((event_url, "invalid"))
+                continue
+            # The order keeps the time the coordinator received it at
+            order.received_at = message["received_at"]
+            order.trace = self.tracer.start(event_url=event_url, started_at=order.received_at)
+            order.mark("broker")
+            order.mark("queue pickup")
+            instances = message.get("instances", 1)
+            self.LOGGER.info(f"Order: {order} | Instances: {instances}")
+            self.submit_order(order=order, instances=instances)
+
+    # Sends the finished orders to the broker, retrying while it is unreachable so no outcome is lost
+    def ack_orders(self):
+        while True:
+            event_url, outcome = self.acks.get()
+            while True:
+                try:
+                    self.broker.ack(worker_id=self.worker_id, event_url=event_url, outcome=outcome)
+                    break
+                except (ConnectionError, ValueError) as exc:
+                    self.LOGGER.warning(f"Error while acking order: {exc}")
+                    sleep(self.settings["Settings"].get("HeartbeatInterval", 2))
+            with self.in_flight_lock:
+                self.in_flight.discard(event_url)
+
+    # Reports the capacity and the orders in flight of this worker, the coordinator logs the consumer group
+    def report_capacity(self):
+        last_status = None
+        while True:
+            with self.in_flight_lock:
+                in_flight = list(self.in_flight)
+            try:
+                self.broker.heartbeat(worker_id=self.worker_id, capacity=max(self.scheduler.capacity(), 0), in_flight=in_flight)
+            except (ConnectionError, ValueError) as exc:
+                self.LOGGER.warning(f"Error while sending heartbeat: {exc}")
+            if self.role == "coordinator" and str(self.broker) != last_status:
+                last_status = str(self.broker)
+                self.LOGGER.info(f"Broker: {last_status}")
+            sleep(self.settings["Settings"].get("HeartbeatInterval", 2))
+
+    # Leaves the consumer group so the orders in flight fail over right away
+    def leave_broker(self):
+        with contextlib.suppress(ConnectionError, ValueError):
+            self.broker.leave(worker_id=self.worker_id)
 
     def start_tradedesk_instance(self, instance_id):
+        LOG_CONTEXT.set({"instance": instance_id})
         self.LOGGER.info(f"Launching Instance: {instance_id}")
 
-        # Initialize driver
-        driver = self.get_driver(headless=False)
-
-        # Get email_id and password for TradeDesk
-        email_id = self.settings["Settings"]["Email"]
-        password = self.settings["Settings"]["Password"]
-
-
-        # Check if already logged in
-        if not self.logged_in:
-            self.login_trade_desk(driver=driver, email_id=email_id, password=password)
-            self.logged_in = True
-        # Continuously wait for the event url to be pasted and checked out
+        # Continuously wait for the orders assigned to this instance and check them out
         self.LOGGER.info(f"Waiting for event URL")
         while True:
-            event_url = self.get_event_url()
-            if event_url is not None:
-                self.LOGGER.info(f"EvenURL Received: {event_url}")
-                self.get_ticket(driver=driver, event_url=event_url)
-                self.LOGGER.info(f"Waiting for next event URL")
+            order = self.scheduler.next_order(instance_id=instance_id)
+            # Another process of the bot may have taken it already, the broker hands each order to one worker
+            if self.broker is None and self.ledger is not None and not order.race.claim(
+                    lambda: self.ledger.claim(order.url_hash, worker=OrderLedger.get_worker(instance_id))):
+                self.LOGGER.info(f"Order already claimed: {order.event_url}")
+                self.scheduler.finish(order)
+                continue
+            order.mark("assigned")
+            with log_context(order=order.event_id):
+                self.run_order(instance_id=instance_id, order=order)
+            self.LOGGER.info(f"Waiting for next event URL")
+
+    # Watches and checks out an order assigned to an instance
+    def run_order(self, instance_id, order):
+        self.LOGGER.info(f"Instance {instance_id} assigned: {order.event_url} | {self.scheduler}")
+        outcome = "error"
+        stop = None
+        try:
+            # The HTTP fast path only takes a driver once a ticket matched
+            if self.inventory_poller is not None:
+                stop = self.watchdog.start(instance_id=instance_id, order=order)
+                self.poll_ticket(order=order, stop=stop)
+            else:
+                # Take a pre-warmed and logged in driver from the pool
+                driver = self.driver_pool.acquire()
+                if driver is None:
+                    # The order goes back to the queue, an instance may find a driver once the pool relaunched them
+                    self.LOGGER.warning(f"No driver available for order: {order.event_url}")
+                    self.watchdog.fail(order)
+                    return
+                self.watchdog.start(instance_id=instance_id, order=order, driver=driver)
+                try:
+                    self.get_ticket(driver=driver, order=order)
+                finally:
+                    self.driver_pool.release(driver)
+            outcome = order.outcome if order.outcome in CheckoutFlow.ENDED else "expired"
+        except Exception as exc:
+            # A crashed driver is recovered like a stuck one, the pool replaces it and the order runs again
+            self.LOGGER.error(f"Error while running order: {exc!r}")
+            self.watchdog.fail(order)
+        finally:
+            self.watchdog.stop(instance_id)
+            # The Watchdog already requeued the order of a hung poll, maybe to another instance
+            if stop is not None and stop.is_set():
+                self.scheduler.release(instance_id)
             else:
-                sleep(1)
+                self.scheduler.finish(order)
+                self.end_order(order=order, outcome=outcome)
+
+    # Requeues a failed order while it has requeues left, records the outcome of its watcher otherwise
+    def end_order(self, order, outcome):
+        if order.failed_at is not None and order.outcome not in CheckoutFlow.ENDED and order.requeues < self.watchdog.max_requeues:
+            self.requeue_order(order)
+        else:
+            self.finish_watcher(order=order, outcome=outcome)
+
+    # Puts the order of a failed instance back in the queue, it expires there once the deadline of its first run is over
+    def requeue_order(self, order):
+        order.instance_id = None
+        order.requeues += 1
+        self.scheduler.submit(order)
+        self.LOGGER.warning(f"Order requeued: {order.event_url} | {self.watchdog}")
+
+    # Starts the scheduler, the driver pool and the instances, each instance in a thread
+    def start_instances(self, ready=None):
+        """
+        :param ready: future of the startup checks, no order is dispatched until it is True
+        :return: futures of the running instances
+        """
+        number_of_instances = self.settings["Settings"]["NumberOfInstancesToRun"]
+        if self.role != "standalone":
+            self.broker = self.get_broker()
+        # Assign the received orders to the idle instances
+        self.scheduler = OrderScheduler(number_of_instances=number_of_instances,
+                                        wait_for_ticket=self.settings["Settings"]["WaitForTicket"] * 60,
+                                        priority=self.settings["Settings"].get("SchedulerPriority", "deadline"),
+                                        on_expired=lambda order: self.finish_watcher(order=order, outcome="expired"))
+        # Resume the orders a crashed or stopped run left behind
+        if self.ledger is not None:
+            event_urls = self.ledger.recover(max_age=self.settings["Settings"]["WaitForTicket"] * 60, is_running=self.is_process_running)
+            # The workers re-announce the orders they kept working on first, the broker skips those
+            grace = self.settings["Settings"].get("WorkerTimeout", 10) if self.broker is not None else 0
+            threading.Timer(grace, lambda: [self.event_urls.resume(event_url) for event_url in event_urls]).start()
+            self.LOGGER.info(f"Orders resumed from the ledger: {len(event_urls)}")
+        if self.broker is None:
+            threading.Thread(target=self.dispatch_orders, args=(ready,), daemon=True).start()
+        else:
+            if self.role == "coordinator":
+                threading.Thread(target=self.publish_orders, daemon=True).start()
+            threading.Thread(target=self.consume_orders, args=(ready,), daemon=True).start()
+            threading.Thread(target=self.ack_orders, daemon=True).start()
+            threading.Thread(target=self.report_capacity, daemon=True).start()
+            atexit.register(self.leave_broker)
+        # Launch and sign in the drivers before any EventURL arrives
+        self.driver_pool = DriverPool(bot=self, size=self.settings["Settings"].get("DriverPoolSize", number_of_instances),
+                                      health_check_interval=self.settings["Settings"].get("DriverHealthCheckInterval", 30),
+                                      tabs_per_browser=self.settings["Settings"].get("TabsPerBrowser", 1),
+                                      max_script_wait=self.settings["Settings"].get("TabWatchTimeout", 0.5),
+                                      acquire_timeout=self.settings["Settings"].get("DriverAcquireTimeout", 60))
+        self.driver_pool.start()
+        self.watchdog = Watchdog.from_settings(bot=self, settings=self.settings["Settings"])
+        if self.settings["Settings"].get("Watchdog", {}).get("Enabled", True):
+            threading.Thread(target=self.watchdog.run, daemon=True).start()
+        threading.Thread(target=self.resource_monitor.run, daemon=True).start()
+        # Launch TradeDeskBot instances in scalable way, each in a thread
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=number_of_instances)
+        return [executor.submit(self.start_tradedesk_instance, instance_id) for instance_id in range(number_of_instances)]
 
     def main(self):
         freeze_support()
         self.enable_cmd_colors()
         self.banner()
         trial_date = datetime.strptime('2023-02-05 23:59:59', '%Y-%m-%d %H:%M:%S')
-        if self.trial(trial_date=trial_date):
-            self.LOGGER.info(f'TradeDeskBot launched')
-            # Start pubnub listener in a separate thread
-            threading.Thread(target=self.start_pubnub_listener).start()
-
-            number_of_instances = self.settings["Settings"]["NumberOfInstancesToRun"]
-            instance_ids = [instance_id for instance_id in range(number_of_instances)]
-            # Launch TradeDeskBot instances in scalable way, each in a thread
-            with concurrent.futures.ThreadPoolExecutor(max_workers=number_of_instances) as executor:
-                results = executor.map(self.start_tradedesk_instance, instance_ids)
+        # The NTP check runs while the listener and the drivers start, the orders wait for its result
+        trial = concurrent.futures.ThreadPoolExecutor(max_workers=1).submit(self.trial, trial_date=trial_date)
+        # The asyncio engine runs everything in one event loop over the DevTools protocol
+        if self.settings["Settings"].get("Engine", "selenium") == "async":
+            asyncio.run(AsyncEngine(bot=self).run(ready=trial))
+            return
+        # Start pubnub listener in a separate thread, the workers get their orders from the coordinator
+        if self.role != "worker":
+            threading.Thread(target=self.start_pubnub_listener, daemon=True).start()
+        futures = self.start_instances(ready=trial)
+        if not trial.result():
+            # Nothing was dispatched, close the warming up drivers and leave
+            for driver in list(self.driver_pool.drivers):
                 try:
-                    for x, result in results:
-                        self.LOGGER.info(f'Results: {result}')
-                except Exception as e:
-                    self.LOGGER.info(e)
+                    driver.quit()
+                except Exception:
+                    pass
+            # os._exit skips the atexit hooks
+            self.tracer.close()
+            self.stop_logging()
+            os._exit(0)
+        self.LOGGER.info(f'TradeDeskBot launched')
+        confirmation = self.settings["Settings"].get("Confirmation") or {}
+        if not confirmation.get("URL") and not confirmation.get("Selector"):
+            self.LOGGER.warning(f"Confirmation is not set in Settings, every autocheckout will end unconfirmed")
+        for result in concurrent.futures.as_completed(futures):
+            try:
+                self.LOGGER.info(f'Results: {result.result()}')
+            except Exception as e:
+                self.LOGGER.error(e)
 
 
 if __name__ == '__main__':
-    TradeDeskBot().main()
+    parser = argparse.ArgumentParser(description='TradeDeskBot: A TradeDesk Ticket Checkout Bot')
+    parser.add_argument('--trace-report', nargs='?', const=str(PROJECT_ROOT / 'BotRes/Traces.jsonl'), metavar='TRACES_FILE',
+                        help='print p50/p95/p99 latency per stage of the traced orders and exit')
+    parser.add_argument('--resource-report', nargs='?', const=str(PROJECT_ROOT / 'BotRes/Resources.jsonl'), metavar='RESOURCES_FILE',
+                        help='print the browser memory and CPU per order and the room left on the host and exit')
+    args = parser.parse_args()
+    if args.trace_report:
+        Tracer.report(file_traces=args.trace_report)
+    elif args.resource_report:
+        ResourceMonitor.report(file_resources=args.resource_report)
+    else:
+        TradeDeskBot().main()